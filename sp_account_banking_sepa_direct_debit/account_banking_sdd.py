@@ -27,15 +27,39 @@ from datetime import datetime
 from datetime import date
 from openerp.tools.misc import DEFAULT_SERVER_DATE_FORMAT
 from dateutil.relativedelta import relativedelta
+import base64
 import logging
 import workdays
 from openerp import netsvc
 
 NUMBER_OF_UNUSED_MONTHS_BEFORE_EXPIRY = 36
+# Rows inserted per INSERT statement by insert_rows
+BULK_INSERT_CHUNK_SIZE = 1000
 
 logger = logging.getLogger(__name__)
 
 
+def next_ids(cr, table, count):
+    """ Take count ids from the id sequence of table, in one query """
+    if not count:
+        return []
+    cr.execute("SELECT nextval(%s) FROM generate_series(1, %s)",
+               ('%s_id_seq' % table, count))
+    return [row[0] for row in cr.fetchall()]
+
+
+def insert_rows(cr, table, columns, rows):
+    """ Insert rows, tuples of values of columns, into table with
+    multi-row INSERTs of BULK_INSERT_CHUNK_SIZE rows
+    """
+    template = '(%s)' % ', '.join(['%s'] * len(columns))
+    for index in xrange(0, len(rows), BULK_INSERT_CHUNK_SIZE):
+        cr.execute('INSERT INTO %s (%s) VALUES %s' % (
+            table, ', '.join(columns),
+            ', '.join(cr.mogrify(template, row)
+                      for row in rows[index:index + BULK_INSERT_CHUNK_SIZE])))
+
+
 def acceptgiro_compute(number):
     """
     Create a valid betalingskenmerk for the Dutch rabobank.
@@ -141,12 +165,47 @@ class banking_export_sdd(orm.Model):
             ('sent', 'Sent'),
             ('done', 'Reconciled'),
         ], 'State', readonly=True),
+        'validation_state': fields.selection([
+            ('pending', 'Pending'),
+            ('valid', 'Valid'),
+            ('invalid', 'Invalid'),
+        ], 'XML Validation', readonly=True,
+            help="Validation of the file against the XML Schema Definition "
+                 "of its pain version. Pending files are validated by a "
+                 "scheduled action."),
+        'validation_error': fields.text('XML Validation Error', readonly=True),
     }
 
     _defaults = {
         'state': 'draft',
     }
 
+    def _scheduler_validate_files(self, cr, uid, context=None):
+        """ Validate the SEPA files stored without being validated """
+        wizard_obj = self.pool['banking.export.sdd.wizard']
+        file_ids = self.search(
+            cr, uid, [('validation_state', '=', 'pending')], context=context)
+        logger.info('Validating %d pending SEPA files', len(file_ids))
+        for sepa_file in self.browse(cr, uid, file_ids, context=context):
+            pain_flavor = sepa_file.payment_order_ids[0].mode.type.code
+            gen_args = {
+                'pain_flavor': pain_flavor,
+                'pain_xsd_file': wizard_obj._get_pain_xsd_file(pain_flavor),
+            }
+            try:
+                wizard_obj._assert_valid_xml(
+                    cr, uid, base64.decodestring(sepa_file.file), gen_args,
+                    context=context)
+            except orm.except_orm, e:
+                logger.warning('SEPA file %s is invalid', sepa_file.filename)
+                vals = {'validation_state': 'invalid',
+                        'validation_error': e.value}
+            else:
+                vals = {'validation_state': 'valid',
+                        'validation_error': False}
+            self.write(cr, uid, sepa_file.id, vals, context=context)
+        return True
+
 
 class sdd_mandate(orm.Model):
     '''SEPA Direct Debit Mandate'''
@@ -513,9 +572,281 @@ class payment_order_create(orm.TransientModel):
 class account_invoice(orm.Model):
     _inherit = 'account.invoice'
 
+    def _recompute_stored_fields(self, cr, uid, model, ids, field_names,
+                                 context=None):
+        """ Recompute the stored function fields depending on field_names of
+        the records ids of model, as the ORM does after a write, for records
+        written with SQL
+        """
+        done = {}
+        for priority, model_name, ids_to_update, fields_to_recompute in \
+                self.pool[model]._store_get_values(
+                    cr, uid, ids, field_names, context):
+            key = (model_name, tuple(fields_to_recompute))
+            done.setdefault(key, set())
+            todo = [record_id for record_id in ids_to_update
+                    if record_id not in done[key]]
+            if todo:
+                done[key].update(todo)
+                self.pool[model_name]._store_set_values(
+                    cr, uid, todo, fields_to_recompute, context)
+
+    def _write_move_related_field(self, cr, uid, move_id, field_name, value,
+                                  context=None):
+        """ Creating a move line through the ORM writes the value of a field
+        related to its move on the move and its lines; do the same with SQL
+        """
+        column = self.pool['account.move.line']._columns.get(field_name)
+        if not isinstance(column, fields.related) or \
+                tuple(column.arg) != ('move_id', field_name):
+            return
+        cr.execute('UPDATE account_move SET %s = %%s '
+                   'WHERE id = %%s AND %s IS DISTINCT FROM %%s'
+                   % (field_name, field_name), (value, move_id, value))
+        if cr.rowcount:
+            cr.execute('UPDATE account_move_line SET %s = %%s '
+                       'WHERE move_id = %%s' % field_name, (value, move_id))
+
+    def _get_crm_payment_rec_lines(self, cr, uid, invoices, context=None):
+        """ Move line of each invoice to reconcile with its payment, the
+        same one as _validate_crm_payment_orm takes
+
+        :param invoices: values of the invoices as read by
+                         _validate_crm_payment_bulk
+        :return: dict invoice id -> values of the move line
+        """
+        if not invoices:
+            return {}
+        cr.execute("""
+            SELECT DISTINCT ON (inv.id)
+                   inv.id, aml.id, aml.debit, aml.credit, aml.partner_id,
+                   aml.state, aml.reconcile_id, aml.reconcile_partial_id
+            FROM account_invoice inv
+            JOIN account_move_line aml
+                ON aml.move_id = inv.move_id
+               AND aml.account_id = inv.account_id
+            WHERE inv.id IN %s
+            ORDER BY inv.id, aml.date, aml.id
+            """, (tuple(invoice['id'] for invoice in invoices),))
+        return dict(
+            (row[0], {
+                'id': row[1],
+                'balance': (row[2] or 0.0) - (row[3] or 0.0),
+                'partner_id': row[4],
+                'state': row[5],
+                'reconcile_id': row[6],
+                'reconcile_partial_id': row[7],
+            })
+            for row in cr.fetchall())
+
+    def _crm_payment_account_allowed(self, account, journal):
+        """ Whether account.move.line.create accepts a line of account in
+        journal: the account is active and passes the entry controls (types
+        and accounts) of the journal
+        """
+        if not account.active:
+            return False
+        if not (journal.type_control_ids or journal.account_control_ids):
+            return True
+        if account.user_type.code in [
+                account_type.code
+                for account_type in journal.type_control_ids]:
+            return True
+        return account.id in [
+            control.id for control in journal.account_control_ids]
+
+    def _validate_crm_payment_bulk(self, cr, uid, invoices, order, period_id,
+                                   context=None):
+        """ Book the payment of the open invoices by the direct debit order
+        with SQL: the debit and credit lines of all the invoices are
+        inserted in the move of the order with multi-row INSERTs, then each
+        credit line is reconciled with the move line of its invoice.
+
+        The lines are booked in the journal and checked against the entry
+        controls of the journal as account.move.line.create does for
+        _validate_crm_payment_orm, so the end result is the same. The
+        invoices for which it would not be, because an account is inactive,
+        refused by the journal, of another company or has a secondary
+        currency, or because the reconciliation needs a write-off or would
+        be refused, are not booked: the ORM gives them the same errors.
+
+        :param invoices: values of the invoices as read by
+                         validate_crm_payment
+        :return: list of the ids of the invoices not booked
+        """
+        account_obj = self.pool['account.account']
+        currency_obj = self.pool['res.currency']
+        partner_obj = self.pool['res.partner']
+        mv_line_obj = self.pool['account.move.line']
+        wf_service = netsvc.LocalService('workflow')
+
+        move = order.sdd_move_id
+        # account.move.line.create takes the journal from the context, and
+        # only without one the journal and period of the move
+        if context and context.get('journal_id'):
+            journal = self.pool['account.journal'].browse(
+                cr, uid, context['journal_id'], context=context)
+            check_period_id = period_id
+        else:
+            journal = move.journal_id
+            check_period_id = move.period_id.id
+
+        account_ids = set(invoice['account_id'] for invoice in invoices)
+        account_ids.add(order.mode.transfer_account_id.id)
+        accounts = dict(
+            (account.id, account) for account in account_obj.browse(
+                cr, uid, list(account_ids), context=context))
+        transfer_account = accounts[order.mode.transfer_account_id.id]
+        if transfer_account.currency_id or \
+                not self._crm_payment_account_allowed(
+                    transfer_account, journal) or \
+                (move.company_id and
+                 move.company_id != transfer_account.company_id):
+            return [invoice['id'] for invoice in invoices]
+        rec_lines = self._get_crm_payment_rec_lines(
+            cr, uid, invoices, context=context)
+
+        left_ids = []
+        to_book = []
+        for invoice in invoices:
+            rec_line = rec_lines.get(invoice['id'])
+            account = accounts[invoice['account_id']]
+            if not rec_line or account.currency_id or \
+                    not account.reconcile or \
+                    not self._crm_payment_account_allowed(
+                        account, journal) or \
+                    account.company_id != transfer_account.company_id or \
+                    rec_line['state'] != 'valid' or \
+                    rec_line['reconcile_id'] or \
+                    not currency_obj.is_zero(
+                        cr, uid, account.company_id.currency_id,
+                        rec_line['balance'] - invoice['residual']) or \
+                    (account.type in ('receivable', 'payable') and
+                     rec_line['partner_id'] != invoice['partner_id']):
+                left_ids.append(invoice['id'])
+            else:
+                to_book.append((invoice, rec_line))
+        if not to_book:
+            return left_ids
+
+        ref = move.name.replace('/', '')
+        # As the related fields of the lines created by the ORM would
+        self._write_move_related_field(
+            cr, uid, move.id, 'ref', ref, context=context)
+        self._write_move_related_field(
+            cr, uid, move.id, 'date', order.date_sent, context=context)
+        mv_line_obj._update_journal_check(
+            cr, uid, journal.id, check_period_id, context=context)
+
+        cr.execute("SELECT now() AT TIME ZONE 'UTC'")
+        now = cr.fetchone()[0]
+        today = fields.date.context_today(self, cr, uid, context=context)
+        columns = ['id', 'create_uid', 'create_date', 'write_uid',
+                   'write_date', 'move_id', 'journal_id', 'period_id', 'date',
+                   'ref', 'name', 'partner_id', 'account_id', 'company_id',
+                   'debit', 'credit', 'quantity', 'amount_currency', 'state',
+                   'blocked', 'centralisation', 'date_created']
+        line_ids = next_ids(cr, 'account_move_line', 2 * len(to_book))
+        rows = []
+        for index, (invoice, rec_line) in enumerate(to_book):
+            common = (uid, now, uid, now, move.id, journal.id,
+                      period_id, order.date_sent, ref, invoice['number'],
+                      invoice['partner_id'])
+            rows.append((line_ids[2 * index],) + common + (
+                transfer_account.id, transfer_account.company_id.id,
+                invoice['residual'], 0.0, None, None, 'valid', False,
+                'normal', today))
+            rows.append((line_ids[2 * index + 1],) + common + (
+                invoice['account_id'],
+                accounts[invoice['account_id']].company_id.id,
+                0.0, invoice['residual'], 1, None, 'valid', False,
+                'normal', today))
+        insert_rows(cr, 'account_move_line', columns, rows)
+        self._recompute_stored_fields(
+            cr, uid, 'account.move.line', line_ids, columns[1:],
+            context=context)
+
+        # One reconciliation per invoice, of its credit line and its line
+        seq_obj = self.pool['ir.sequence']
+        reconcile_ids = next_ids(cr, 'account_move_reconcile', len(to_book))
+        insert_rows(
+            cr, 'account_move_reconcile',
+            ['id', 'create_uid', 'create_date', 'write_uid', 'write_date',
+             'name', 'type'],
+            [(reconcile_id, uid, now, uid, now,
+              seq_obj.get(cr, uid, 'account.reconcile', context=context)
+              or '/', 'auto')
+             for reconcile_id in reconcile_ids])
+        reconciled_line_ids = []
+        values = []
+        for index, (invoice, rec_line) in enumerate(to_book):
+            for line_id in (line_ids[2 * index + 1], rec_line['id']):
+                reconciled_line_ids.append(line_id)
+                values.append(cr.mogrify(
+                    '(%s, %s)', (line_id, reconcile_ids[index])))
+        for index in xrange(0, len(values), BULK_INSERT_CHUNK_SIZE):
+            cr.execute("""
+                UPDATE account_move_line aml
+                SET reconcile_id = rec.reconcile_id,
+                    reconcile_partial_id = NULL,
+                    write_uid = %%s, write_date = %%s
+                FROM (VALUES %s) AS rec(line_id, reconcile_id)
+                WHERE aml.id = rec.line_id
+                """ % ', '.join(values[index:index + BULK_INSERT_CHUNK_SIZE]),
+                (uid, now))
+        self._recompute_stored_fields(
+            cr, uid, 'account.move.line', reconciled_line_ids,
+            ['reconcile_id', 'reconcile_partial_id'], context=context)
+        self._recompute_stored_fields(
+            cr, uid, 'account.move.reconcile', reconcile_ids,
+            ['name', 'type', 'line_id'], context=context)
+        # As reconcile does, the invoices are set to paid by their workflow
+        for line_id in reconciled_line_ids:
+            wf_service.trg_trigger(uid, 'account.move.line', line_id, cr)
+        for partner_id in set(invoice['partner_id']
+                              for invoice, rec_line in to_book):
+            if partner_id and not partner_obj.has_something_to_reconcile(
+                    cr, uid, partner_id, context=context):
+                partner_obj.mark_as_reconciled(
+                    cr, uid, [partner_id], context=context)
+        logger.debug('Direct Debit payments of %s invoices booked with SQL',
+                     len(to_book))
+        return left_ids
+
     def validate_crm_payment(self, cr, uid, ids, order, context=None):
+        """ Book the payment of the open invoices ids by the direct debit
+        order in the move of the order, and reconcile them.
+
+        The invoices are booked together by _validate_crm_payment_bulk, the
+        ones it can't book are booked one by one through the ORM.
+        """
+        invoices = [invoice for invoice in self.read(
+            cr, uid, ids, ['state', 'number', 'partner_id', 'account_id',
+                           'residual', 'move_id'],
+            context=context, load='_classic_write')
+            if invoice['state'] == 'open']
+        left_ids = []
+        if invoices:
+            c = dict(context or {}, novalidate=True)
+            period_id = self.pool.get('account.period').find(cr, uid, dt=order.date_sent, context=c)
+            if len(period_id) != 1:
+                raise osv.except_osv(_('Configuration Error !'), _('More then one period found for this date'))
+            left_ids = self._validate_crm_payment_bulk(
+                cr, uid, invoices, order, period_id[0], context=c)
+        if left_ids:
+            self._validate_crm_payment_orm(
+                cr, uid, left_ids, order, context=context)
+        if len(ids) > 1:
+            logger.info('Direct Debit payment validated for %s of %s invoices', len(invoices), len(ids))
+
+    def _validate_crm_payment_orm(self, cr, uid, ids, order, context=None):
+        """ Book the payment of the invoices ids one by one through the ORM.
+
+        :return: the number of invoices booked
+        """
         mv_obj = self.pool.get('account.move')
         mv_line_obj = self.pool.get('account.move.line')
+        reconciled = 0
         for invoice in self.browse(cr, uid, ids, context):
             c = context.copy()
             c['novalidate'] = True
@@ -529,7 +860,7 @@ class account_invoice(orm.Model):
 
                 mv = order.sdd_move_id
                 mv_id = order.sdd_move_id.id
-                logger.info('Creating moves, first debit')
+                logger.debug('Creating moves, first debit')
                 debit_mv_line_vals = {
                     'period_id': period_id[0],
                     'date': order.date_sent,
@@ -542,7 +873,7 @@ class account_invoice(orm.Model):
                     'state': 'valid',  # This state: valid is a dirty dirty hack (See below)
                 }
                 debit_mv_line_id = mv_line_obj.create(cr, uid, debit_mv_line_vals, context=c)
-                logger.info('Creating moves, nog credit')
+                logger.debug('Creating moves, nog credit')
                 credit_mv_line_vals = {
                     'period_id': period_id[0],
                     'date': order.date_sent,
@@ -561,7 +892,7 @@ class account_invoice(orm.Model):
                 # If the state is not valid for the recociliation we cannot reconcile the entry
                 credit_mv_line_id = mv_line_obj.create(cr, uid, credit_mv_line_vals, context=c)
 
-                logger.info('Invoice move lines %s created' % (invoice.number,))
+                logger.debug('Invoice move lines %s created', invoice.number)
 
                 # Find the invoice move line to reconcile
                 rec_line_id = False
@@ -576,7 +907,9 @@ class account_invoice(orm.Model):
 
                 # Reconcile the journal entry
                 mv_line_obj.reconcile(cr, uid, reconcile_ids, 'auto', False, False, False, context=context)
-                logger.info('Diret Debit Invoice Reconciliation done for invoice %s' % (invoice.number,))
+                logger.debug('Direct Debit Invoice Reconciliation done for invoice %s', invoice.number)
+                reconciled += 1
+        return reconciled
 
 
 
@@ -644,9 +977,8 @@ class account_invoice(orm.Model):
     def create(self, cr, uid, vals, context=None):
         invoice_id = super(account_invoice, self).create(cr, uid, vals, context=context)
         inv_id = str(invoice_id).zfill(15)
-        print "INVID:", inv_id
         agiro = acceptgiro_compute(inv_id)
-        print "AGIRO:", agiro
+        logger.debug('Invoice %s acceptgiro code %s', inv_id, agiro)
         self.write(cr, uid, [invoice_id], {'acceptgiro_code': agiro})
         return invoice_id
 
@@ -678,7 +1010,7 @@ class account_voucher(orm.Model):
         ctx.update({'date': voucher_1.date})
         # Create the account move record.
         move_id = move_pool.create(cr, uid, self.account_move_get(cr, uid, voucher_1.id, context=context), context=context)
-        print "creating new move_id in action_single_move_line_create", move_id
+        logger.debug('Created move %s in action_single_move_line_create', move_id)
         # Get the name of the account_move just created
         name = move_pool.browse(cr, uid, move_id, context=context).name
         # Disable validating every new move line
@@ -688,7 +1020,7 @@ class account_voucher(orm.Model):
         for voucher in self.browse(cr, uid, ids, context=context):
             # Create the first line of the voucher
             move_line_id = move_line_pool.create(cr, uid, self.first_move_line_get(cr,uid,voucher.id, move_id, company_currency, current_currency, local_context), local_context)
-            print "Creating a new move line A: ", move_line_id
+            logger.debug('Voucher %s: created first move line %s', voucher.id, move_line_id)
             move_line_brw = move_line_pool.browse(cr, uid, move_line_id, context=context)
             line_total = move_line_brw.debit - move_line_brw.credit
             rec_list_ids = []
@@ -700,14 +1032,12 @@ class account_voucher(orm.Model):
             # Create one move line per voucher line where amount is not 0.0
             # Deze ondeste dus vaker aanroepen per voicher?
             line_total, rec_list_ids = self.voucher_move_line_create(cr, uid, voucher.id, line_total, move_id, company_currency, current_currency, context)
-            print "Creating a new move line B: line_total, "
-            print "created line_total", line_total
-            print "rec_list_ids ", rec_list_ids
+            logger.debug('Voucher %s: created voucher move lines, line_total %s, rec_list_ids %s',
+                         voucher.id, line_total, rec_list_ids)
             total_rec_list_ids.append(rec_list_ids[0])
             # Create the writeoff line if needed
-            print "line total", line_total
             ml_writeoff = self.writeoff_move_line_get(cr, uid, voucher.id, line_total, move_id, name, company_currency, current_currency, local_context)
-            print "ml_writeoff", ml_writeoff
+            logger.debug('Voucher %s: writeoff %s', voucher.id, ml_writeoff)
             if ml_writeoff:
                 move_line_pool.create(cr, uid, ml_writeoff, local_context)
             # We post the voucher.
@@ -720,9 +1050,10 @@ class account_voucher(orm.Model):
         del(local_context['novalidate'])
 
         if voucher.journal_id.entry_posted:
-            print "Posting move id", move_id
+            logger.debug('Posting move id %s', move_id)
             move_pool.post(cr, uid, [move_id], context={})
         # We automatically reconcile the account move lines.
+        logger.info('Move %s created for %s vouchers', move_id, len(ids))
         reconcile = False
         for rec_ids in total_rec_list_ids:
             if len(rec_ids) >= 2:
@@ -737,8 +1068,21 @@ class payment_order(orm.Model):
         'sdd_move_id': fields.many2one('account.move', 'Overschrijf boeking', readonly=True),
         'first_move_id': fields.many2one('account.move', 'Incasso boeking, First', readonly=True),
         'rcur_move_id': fields.many2one('account.move', 'Incasso boeking, Recurring', readonly=True),
+        'sdd_checkpoint_line_id': fields.integer(
+            'Last confirmed line', readonly=True,
+            help="Id of the last payment line of the last chunk of lines "
+                 "confirmed. Confirming the order again starts after it."),
     }
 
+    _defaults = {
+        'sdd_checkpoint_line_id': 0,
+    }
+
+    def copy_data(self, cr, uid, id, default=None, context=None):
+        default = dict(default or {}, sdd_checkpoint_line_id=0)
+        return super(payment_order, self).copy_data(
+            cr, uid, id, default=default, context=context)
+
     def payment_order_split(self, cr, uid, ids, context=None):
         icp_obj = self.pool['ir.config_parameter']
 
@@ -747,17 +1091,19 @@ class payment_order(orm.Model):
         for po in self.browse(cr, uid, ids):
             line_ids = po.line_ids
             line_ids = self.read(cr, uid, [po.id], fields=['line_ids'], context=context)[0]['line_ids']
-            print "LINE IDS:", line_ids
+            logger.debug('Payment order %s lines %s', po.id, line_ids)
 
             if len(line_ids) > split_count:
                 lines = map(None, *([iter(line_ids)] * split_count))
+                logger.info('Splitting payment order %s of %s lines in %s orders',
+                            po.id, len(line_ids), len(lines))
                 orig = True
                 for l in lines:
                     if orig:
                         orig = False
                         continue
                     l_ids = list(filter(None, l))
-                    print "L_IDS:", l_ids
+                    logger.debug('Moving lines %s to a new payment order', l_ids)
                     new_po_id = self.copy(cr, uid, po.id, {})
                     self.pool.get('payment.line').write(cr, uid, l_ids, {'order_id': new_po_id})
 
@@ -801,13 +1147,13 @@ class sdd_add_payment(orm.TransientModel):
     def _set_due_date(self, cr, uid, inv, context):
         # And, now we have to set the date_due to compy with Sepa stuff.
         # We do this for every invoice
-        print "date-due now is", inv.date_due
+        logger.debug('Invoice %s date_due now is %s', inv.id, inv.date_due)
         if inv.sdd_mandate_id.recurrent_sequence_type == 'recurring':
             # Recurring mandate, setting date to to invoice data, but only if the invoice date is
             # 3 days into the future! Otherwise add 3 working days
             date_invoice = datetime.strptime(inv.date_invoice, DEFAULT_SERVER_DATE_FORMAT)
             difference = workdays.networkdays(date.today(), date_invoice.date())
-            print "En het verschil is", difference
+            logger.debug('En het verschil is %s', difference)
 
             # If invoicedate == today, difference == 1
             # If invoicedate == tomorrow, difference == 2
@@ -824,16 +1170,15 @@ class sdd_add_payment(orm.TransientModel):
             # that's ten working days.
             date_invoice = datetime.strptime(inv.date_invoice, DEFAULT_SERVER_DATE_FORMAT)
             difference = workdays.networkdays(date.today(), date_invoice.date())
-            print "En het verschil is", difference
+            logger.debug('En het verschil is %s', difference)
             if difference < 7:
                 # Difference isn't enough, setting the difference from today date
                 date_due = workdays.workday(datetime.now(), 7).date()
             else:
                 # Difference is good
                 date_due = date_invoice.date()
-        print "new date due is", date_due
         date_due = date_due.strftime(DEFAULT_SERVER_DATE_FORMAT)
-        print "En als string", date_due
+        logger.debug('Invoice %s new date_due is %s', inv.id, date_due)
         # Setting new date_due on the invoice:
         # inv.write(cr, uid, inv.id, {'date_due': date_due}, context=context)
         inv.write({'date_due': date_due})
@@ -875,19 +1220,18 @@ class sdd_add_payment(orm.TransientModel):
                     ('sdd_payment_sent', '=', False),
                 ])
 
-            print "We have invoice id", inv_ids
+            logger.debug('Found invoices %s', inv_ids)
             for inv_id in inv_ids:
                 inv = self.pool.get('account.invoice').browse(cr, uid, inv_id)
                 if inv.sdd_mandate_id:
-                    print "Invoice state", inv.state
+                    logger.debug('Invoice %s state %s', inv.id, inv.state)
 
                     if inv.state == 'draft':
                         # Confirm invoice
                         wf_service.trg_validate(uid, 'account.invoice', inv.id, 'invoice_open', cr)
-                        # And reread
-                        print "invoice is now in state", inv.state
+                    # And reread
                     inv = self.pool.get('account.invoice').browse(cr, uid, inv_id)
-                    print "After re -read", inv.state
+                    logger.debug('Invoice %s is now in state %s', inv.id, inv.state)
 
                     # reset due date, after the invoice is confirmed otherwise we have no move lines.
                     inv.date_due = self._set_due_date(cr, uid, inv, context)
@@ -900,13 +1244,12 @@ class sdd_add_payment(orm.TransientModel):
                 cr.commit()
 
 
-            print "MOVE IDS:", move_ids
+            logger.info('Payment order %s: %s invoices found, %s receivable move lines to add',
+                        order.payment_order_id.id, len(inv_ids), len(move_ids))
 
             line2bank = move_obj.line2bank(cr, uid, move_ids, None, context)
 
             for line in move_obj.browse(cr, uid, move_ids, context):
-                print "AMT:", line.amount_to_pay
-                print "DEBIT:", line.debit
                 if line.debit > 0.00:
                     if order.payment_order_id.date_prefered == "now":
                         #no payment date => immediate payment
@@ -915,7 +1258,8 @@ class sdd_add_payment(orm.TransientModel):
                         date_to_pay = line.date_maturity
                     elif order.payment_order_id.date_prefered == 'fixed':
                         date_to_pay = order.payment_order_id.date_scheduled
-                    print "Creating with communication", line.ref
+                    logger.debug('Creating payment line for move line %s, communication %s',
+                                 line.id, line.ref)
                     order_line_obj.create(cr, uid, {
                         'move_line_id': line.id,
                         'amount_currency': line.debit,
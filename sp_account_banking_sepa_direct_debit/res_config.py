@@ -26,9 +26,106 @@ class base_config_settings(TransientModel):
         icp = self.pool['ir.config_parameter']
         icp.set_param(cr, uid, 'sp_account_banking_sepa_direct_debit.split_count', config.split_count)
 
+    def get_default_stream_threshold(self, cr, uid, ids, context=None):
+        icp = self.pool['ir.config_parameter']
+
+        try:
+            value = int(icp.get_param(cr, uid, 'sp_account_banking_sepa_direct_debit.stream_threshold', 0))
+        except ValueError:
+            value = 0
+
+        return {
+            'stream_threshold': value
+        }
+
+    def set_stream_threshold(self, cr, uid, ids, context=None):
+        config = self.browse(cr, uid, ids[0], context=context)
+        icp = self.pool['ir.config_parameter']
+        icp.set_param(cr, uid, 'sp_account_banking_sepa_direct_debit.stream_threshold', config.stream_threshold)
+
+    def get_default_parallel_workers(self, cr, uid, ids, context=None):
+        icp = self.pool['ir.config_parameter']
+
+        try:
+            value = int(icp.get_param(cr, uid, 'sp_account_banking_sepa_direct_debit.parallel_workers', 0))
+        except ValueError:
+            value = 0
+
+        return {
+            'parallel_workers': value
+        }
+
+    def set_parallel_workers(self, cr, uid, ids, context=None):
+        config = self.browse(cr, uid, ids[0], context=context)
+        icp = self.pool['ir.config_parameter']
+        icp.set_param(cr, uid, 'sp_account_banking_sepa_direct_debit.parallel_workers', config.parallel_workers)
+
+    def get_default_validation_mode(self, cr, uid, ids, context=None):
+        icp = self.pool['ir.config_parameter']
+
+        value = icp.get_param(cr, uid, 'sp_account_banking_sepa_direct_debit.validation_mode', 'full')
+        if value not in ('full', 'block', 'deferred'):
+            value = 'full'
+
+        return {
+            'validation_mode': value
+        }
+
+    def set_validation_mode(self, cr, uid, ids, context=None):
+        config = self.browse(cr, uid, ids[0], context=context)
+        icp = self.pool['ir.config_parameter']
+        icp.set_param(cr, uid, 'sp_account_banking_sepa_direct_debit.validation_mode', config.validation_mode)
+
+    def get_default_confirm_chunk_size(self, cr, uid, ids, context=None):
+        icp = self.pool['ir.config_parameter']
+
+        try:
+            value = int(icp.get_param(cr, uid, 'sp_account_banking_sepa_direct_debit.confirm_chunk_size', 200))
+        except ValueError:
+            value = 200
+
+        return {
+            'confirm_chunk_size': value
+        }
+
+    def set_confirm_chunk_size(self, cr, uid, ids, context=None):
+        config = self.browse(cr, uid, ids[0], context=context)
+        icp = self.pool['ir.config_parameter']
+        icp.set_param(cr, uid, 'sp_account_banking_sepa_direct_debit.confirm_chunk_size', config.confirm_chunk_size)
+
     # Columns Section
     _columns = {
         'split_count': fields.integer(
             'Split direct debit order in with this many lines',
         ),
+        'stream_threshold': fields.integer(
+            'Stream direct debit files from this many lines (0: never)',
+            help="Direct debit files with at least this many transactions "
+                 "are written block by block to a temporary file, instead "
+                 "of being built in memory first.",
+        ),
+        'parallel_workers': fields.integer(
+            'Generate direct debit files with this many processes (0: off)',
+            help="The transactions of big direct debit files are generated "
+                 "by this many worker processes in parallel. Only used when "
+                 "the server runs with worker processes (the workers "
+                 "option), a threaded server generates them itself.",
+        ),
+        'confirm_chunk_size': fields.integer(
+            'Confirm direct debit orders by chunks of this many lines',
+            help="Confirming a direct debit order commits after each chunk "
+                 "of lines. The lines of a chunk that fails are then "
+                 "confirmed one by one.",
+        ),
+        'validation_mode': fields.selection([
+            ('full', 'Validate the complete file'),
+            ('block', 'Validate each payment info block'),
+            ('deferred', 'Validate once stored'),
+        ], 'Validation of direct debit files',
+            help="When direct debit files are validated against the XML "
+                 "Schema Definition. Streamed files are validated block "
+                 "by block instead of complete. Deferred validation is "
+                 "done by a scheduled action; invalid files can't be "
+                 "confirmed.",
+        ),
     }
@@ -0,0 +1,9 @@
+# -*- encoding: utf-8 -*-
+
+from . import test_export_sdd
+from . import test_validate_crm_payment
+
+checks = [
+    test_export_sdd,
+    test_validate_crm_payment,
+]
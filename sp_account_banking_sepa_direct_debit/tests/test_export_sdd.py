@@ -0,0 +1,121 @@
+# -*- encoding: utf-8 -*-
+import collections
+
+import unittest2
+
+from ..wizard import export_sdd
+from ..wizard.export_sdd import (
+    PaymentInfoValidator, convert_to_ascii, field_accessor)
+
+Record = collections.namedtuple('Record', 'name partner_id')
+
+
+class test_convert_to_ascii(unittest2.TestCase):
+
+    def setUp(self):
+        export_sdd._ascii_values.clear()
+
+    def test_convert(self):
+        self.assertEqual(convert_to_ascii(u'Françoise Müller'),
+                         'Francoise Muller')
+        self.assertEqual(convert_to_ascii(u'A&B [test] #1_2'),
+                         'A-B -test- -1-2')
+
+    def test_memo(self):
+        converted = convert_to_ascii(u'Ærø')
+        self.assertEqual(export_sdd._ascii_values, {u'Ærø': converted})
+        export_sdd._ascii_values[u'Ærø'] = 'cached'
+        self.assertEqual(convert_to_ascii(u'Ærø'), 'cached')
+
+    def test_memo_size(self):
+        """ The memo is emptied when it is full """
+        cache_size = export_sdd.ASCII_VALUES_CACHE_SIZE
+        export_sdd.ASCII_VALUES_CACHE_SIZE = 2
+        try:
+            for value in (u'a', u'b', u'c'):
+                convert_to_ascii(value)
+        finally:
+            export_sdd.ASCII_VALUES_CACHE_SIZE = cache_size
+        self.assertEqual(export_sdd._ascii_values, {u'c': 'c'})
+
+
+class test_field_accessor(unittest2.TestCase):
+
+    def setUp(self):
+        partner = Record('Partner', None)
+        self.eval_ctx = {'line': Record('Line 1', partner), 'amount': 12.5}
+
+    def test_attribute_path(self):
+        self.assertEqual(field_accessor('line')(self.eval_ctx),
+                         self.eval_ctx['line'])
+        self.assertEqual(field_accessor('line.name')(self.eval_ctx),
+                         'Line 1')
+        self.assertEqual(
+            field_accessor('line.partner_id.name')(self.eval_ctx),
+            'Partner')
+
+    def test_expression(self):
+        self.assertEqual(
+            field_accessor("line.name + ' ' + line.partner_id.name")(
+                self.eval_ctx),
+            'Line 1 Partner')
+        self.assertEqual(field_accessor('amount * 2')(self.eval_ctx), 25)
+        self.assertEqual(field_accessor("line.name[:4]")(self.eval_ctx),
+                         'Line')
+
+    def test_cache(self):
+        self.assertIs(field_accessor('line.name'),
+                      field_accessor('line.name'))
+        self.assertIs(field_accessor('amount * 2'),
+                      field_accessor('amount * 2'))
+
+
+class test_payment_info_validator(unittest2.TestCase):
+
+    def setUp(self):
+        self.documents = []
+        self.validator = PaymentInfoValidator(
+            self.documents.append, '<Document>\n', '</Document>\n',
+            slice_size=2)
+
+    def test_validate_payment_info(self):
+        self.validator.validate_payment_info('<PmtInf/>\n')
+        self.assertEqual(self.documents,
+                         ['<Document>\n<PmtInf/>\n</Document>\n'])
+
+    def test_slices(self):
+        """ The transactions of a block are validated by slice_size """
+        self.validator.start_payment_info('<PmtInfId>1</PmtInfId>\n')
+        for transaction in ('<T1/>\n', '<T2/>\n', '<T3/>\n'):
+            self.validator.add_transactions(transaction)
+        self.assertEqual(self.documents, [
+            '<Document>\n<PmtInf>\n<PmtInfId>1</PmtInfId>\n'
+            '<T1/>\n<T2/>\n</PmtInf>\n</Document>\n'])
+        self.validator.flush()
+        self.assertEqual(self.documents[1:], [
+            '<Document>\n<PmtInf>\n<PmtInfId>1</PmtInfId>\n'
+            '<T3/>\n</PmtInf>\n</Document>\n'])
+        self.validator.flush()
+        self.assertEqual(len(self.documents), 2)
+
+    def test_count(self):
+        """ A fragment of several transactions counts for all of them """
+        self.validator.start_payment_info('')
+        self.validator.add_transactions('<T1/>\n<T2/>\n<T3/>\n', count=3)
+        self.assertEqual(self.documents, [
+            '<Document>\n<PmtInf>\n<T1/>\n<T2/>\n<T3/>\n</PmtInf>\n'
+            '</Document>\n'])
+
+    def test_start_flushes(self):
+        """ Starting a block validates the rest of the previous one """
+        self.validator.start_payment_info('<PmtInfId>1</PmtInfId>\n')
+        self.validator.add_transactions('<T1/>\n')
+        self.validator.start_payment_info('<PmtInfId>2</PmtInfId>\n')
+        self.assertEqual(self.documents, [
+            '<Document>\n<PmtInf>\n<PmtInfId>1</PmtInfId>\n'
+            '<T1/>\n</PmtInf>\n</Document>\n'])
+        self.validator.add_transactions('<T2/>\n')
+        self.validator.flush()
+        self.assertEqual(self.documents[1:], [
+            '<Document>\n<PmtInf>\n<PmtInfId>2</PmtInfId>\n'
+            '<T2/>\n</PmtInf>\n</Document>\n'])
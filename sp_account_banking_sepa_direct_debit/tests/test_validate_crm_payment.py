@@ -0,0 +1,151 @@
+# -*- encoding: utf-8 -*-
+import collections
+
+from openerp import netsvc
+from openerp.osv import fields
+from openerp.tests import common
+
+# What _validate_crm_payment_bulk and _validate_crm_payment_orm use of a
+# payment.order
+PaymentOrder = collections.namedtuple(
+    'PaymentOrder', 'date_sent sdd_move_id mode')
+PaymentMode = collections.namedtuple('PaymentMode', 'transfer_account_id')
+
+
+class test_validate_crm_payment(common.TransactionCase):
+    """ The payments booked by _validate_crm_payment_bulk are the same as
+    the ones booked by _validate_crm_payment_orm
+    """
+
+    def setUp(self):
+        super(test_validate_crm_payment, self).setUp()
+        cr, uid = self.cr, self.uid
+        self.invoice_obj = self.registry('account.invoice')
+        self.move_obj = self.registry('account.move')
+        self.move_line_obj = self.registry('account.move.line')
+        self.journal_obj = self.registry('account.journal')
+        data_obj = self.registry('ir.model.data')
+
+        def ref(xml_id):
+            module, name = xml_id.split('.')
+            return data_obj.get_object_reference(cr, uid, module, name)[1]
+        self.ref = ref
+
+        self.today = fields.date.context_today(self.invoice_obj, cr, uid)
+        self.period_id = self.registry('account.period').find(
+            cr, uid, dt=self.today)[0]
+        move_id = self.move_obj.create(cr, uid, {
+            'journal_id': ref('account.bank_journal'),
+            'period_id': self.period_id,
+            'date': self.today,
+        })
+        transfer_account = self.registry('account.account').browse(
+            cr, uid, ref('account.cash'))
+        self.order = PaymentOrder(
+            self.today, self.move_obj.browse(cr, uid, move_id),
+            PaymentMode(transfer_account))
+        # the wizard books the payments in the debit journal of the mode,
+        # not in the journal of the move
+        self.context = {'journal_id': ref('account.miscellaneous_journal')}
+
+    def _create_invoices(self, amounts):
+        cr, uid = self.cr, self.uid
+        wf_service = netsvc.LocalService('workflow')
+        invoice_ids = []
+        for amount in amounts:
+            invoice_id = self.invoice_obj.create(cr, uid, {
+                'partner_id': self.ref('base.res_partner_2'),
+                'account_id': self.ref('account.a_recv'),
+                'journal_id': self.ref('account.sales_journal'),
+                'type': 'out_invoice',
+                'date_invoice': self.today,
+                'invoice_line': [(0, 0, {
+                    'name': 'Contribution',
+                    'account_id': self.ref('account.a_sale'),
+                    'quantity': 1,
+                    'price_unit': amount,
+                })],
+            })
+            wf_service.trg_validate(
+                uid, 'account.invoice', invoice_id, 'invoice_open', cr)
+            invoice_ids.append(invoice_id)
+        return invoice_ids
+
+    def _read_invoices(self, invoice_ids):
+        """ The values validate_crm_payment passes to the bulk path """
+        return self.invoice_obj.read(
+            self.cr, self.uid, invoice_ids,
+            ['state', 'number', 'partner_id', 'account_id', 'residual',
+             'move_id'], load='_classic_write')
+
+    def _get_bookings(self, invoice_ids):
+        """ The payment lines, reconciliation and state of each invoice, in
+        a form that doesn't depend on the invoice
+        """
+        cr, uid = self.cr, self.uid
+        bookings = []
+        for invoice in self.invoice_obj.browse(cr, uid, invoice_ids):
+            line_ids = self.move_line_obj.search(cr, uid, [
+                ('move_id', '=', self.order.sdd_move_id.id),
+                ('name', '=', invoice.number),
+            ], order='debit desc')
+            lines = []
+            reconcile = None
+            for line in self.move_line_obj.browse(cr, uid, line_ids):
+                lines.append((
+                    line.journal_id.id, line.period_id.id, line.date,
+                    line.ref, line.partner_id.id, line.account_id.id,
+                    line.company_id.id, line.debit, line.credit,
+                    line.quantity, line.amount_currency, line.state,
+                    line.blocked, line.centralisation))
+                if line.reconcile_id:
+                    reconcile = (line.reconcile_id.type, sorted(
+                        (rec_line.account_id.id, rec_line.debit,
+                         rec_line.credit, rec_line.move_id.id ==
+                         invoice.move_id.id)
+                        for rec_line in line.reconcile_id.line_id))
+            bookings.append((lines, reconcile, invoice.state,
+                             invoice.reconciled, invoice.residual))
+        return bookings
+
+    def test_bulk_same_as_orm(self):
+        """ Both paths book the same lines and reconciliations, and set the
+        invoices to paid
+        """
+        cr, uid = self.cr, self.uid
+        amounts = [12.5, 30.0, 7.25]
+        orm_ids = self._create_invoices(amounts)
+        bulk_ids = self._create_invoices(amounts)
+
+        self.invoice_obj._validate_crm_payment_orm(
+            cr, uid, orm_ids, self.order, context=dict(self.context))
+        left_ids = self.invoice_obj._validate_crm_payment_bulk(
+            cr, uid, self._read_invoices(bulk_ids), self.order,
+            self.period_id, context=dict(self.context))
+
+        self.assertEqual(left_ids, [])
+        orm_bookings = self._get_bookings(orm_ids)
+        self.assertEqual(self._get_bookings(bulk_ids), orm_bookings)
+        for lines, reconcile, state, reconciled, residual in orm_bookings:
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[0][0], self.context['journal_id'])
+            self.assertTrue(reconcile)
+            self.assertEqual(state, 'paid')
+
+    def test_bulk_journal_controls(self):
+        """ An account refused by the entry controls of the journal is left
+        to the ORM path
+        """
+        cr, uid = self.cr, self.uid
+        self.journal_obj.write(cr, uid, [self.context['journal_id']], {
+            'account_control_ids': [
+                (6, 0, [self.order.mode.transfer_account_id.id])],
+        })
+        invoice_ids = self._create_invoices([10.0])
+
+        left_ids = self.invoice_obj._validate_crm_payment_bulk(
+            cr, uid, self._read_invoices(invoice_ids), self.order,
+            self.period_id, context=dict(self.context))
+
+        self.assertEqual(left_ids, invoice_ids)
+        self.assertEqual(self._get_bookings(invoice_ids)[0][0], [])
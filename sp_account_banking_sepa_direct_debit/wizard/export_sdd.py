@@ -23,13 +23,259 @@
 from openerp.osv import orm, fields, osv
 from openerp.tools.translate import _
 from openerp import netsvc
+from openerp import SUPERUSER_ID
+from openerp import tools
 from datetime import datetime
 from lxml import etree
+from unidecode import unidecode
+import base64
 import collections
+import copy
+import itertools
+import multiprocessing
+import operator
 import psycopg2
+import re
+import signal
+import tempfile
+import threading
 import logging
 LOGGER = logging.getLogger(__name__)
 
+# Characters replaced by '-' by convert_to_ascii, as in banking.export.pain
+UNALLOWED_ASCII_CHARS = ['"', '#', '$', '%', '&', '*', ';', '[', '\\', ']',
+                         '^', '_', '`', '{', '|', '}', '~']
+# Field expressions of _prepare_field that are a plain attribute path
+FIELD_PATH_RE = re.compile(r'^[A-Za-z_]\w*(\.[A-Za-z_]\w*)*$')
+# Accessors of the field expressions of _prepare_field, per expression
+_field_accessors = {}
+# Results of the convert_to_ascii conversion, per value. Names, references
+# and bank accounts repeat a lot between the lines and the files.
+_ascii_values = {}
+ASCII_VALUES_CACHE_SIZE = 100000
+
+
+def field_accessor(field_value):
+    """ Function returning the value of the expression field_value of
+    _prepare_field for an eval context.
+
+    The expression is compiled on first use only. A plain attribute path
+    like 'line.partner_id.name' doesn't go through eval at all.
+    """
+    accessor = _field_accessors.get(field_value)
+    if accessor is None:
+        if FIELD_PATH_RE.match(field_value):
+            root, _dot, path = field_value.partition('.')
+            if path:
+                getter = operator.attrgetter(path)
+                accessor = lambda eval_ctx: getter(eval_ctx[root])
+            else:
+                accessor = lambda eval_ctx: eval_ctx[root]
+        else:
+            code = compile(field_value, '<%s>' % field_value, 'eval')
+            accessor = lambda eval_ctx: eval(code, eval_ctx)
+        _field_accessors[field_value] = accessor
+    return accessor
+
+
+def convert_to_ascii(value):
+    """ value transliterated to ASCII, without the characters banks
+    refuse, memoised
+    """
+    converted = _ascii_values.get(value)
+    if converted is None:
+        converted = unidecode(value)
+        for unallowed_ascii_char in UNALLOWED_ASCII_CHARS:
+            converted = converted.replace(unallowed_ascii_char, '-')
+        if len(_ascii_values) >= ASCII_VALUES_CACHE_SIZE:
+            _ascii_values.clear()
+        _ascii_values[value] = converted
+    return converted
+
+# Number of transactions generated by a worker process per task, when the
+# transactions are generated in parallel
+PARALLEL_CHUNK_SIZE = 1000
+# What the worker processes need to generate the transactions, per key of
+# the task. It is set before the worker processes are forked, so they get
+# it without any serialisation.
+_parallel_contexts = {}
+_parallel_keys = itertools.count()
+
+
+def _init_parallel_worker():
+    """ Give the worker processes the default signal handlers instead of
+    the ones of the server, so the pool can terminate them.
+
+    The database name of the thread is dropped too: without it the
+    translation function doesn't open a cursor, which would share the
+    connections inherited from the parent process.
+    """
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    thread = threading.current_thread()
+    if hasattr(thread, 'dbname'):
+        del thread.dbname
+
+
+def _generate_transactions_fragment(task):
+    """ Generate the DrctDbtTxInf blocks of a slice of the lines of a
+    group, in a worker process.
+
+    The worker doesn't have a cursor: the lines, the previous bank accounts
+    and the creditor blocks are all read beforehand by the parent process.
+
+    :param task: (key of the context, index of the group, start, stop)
+    :return: (None, the blocks serialised to a string) or, when a line
+             can't be exported, ((title, message) of the error, None). The
+             parent process raises the error, translated.
+    """
+    key, group_index, start, stop = task
+    parallel_ctx = _parallel_contexts[key]
+    wizard = parallel_ctx['wizard']
+    sequence_type, lines = parallel_ctx['groups'][group_index]
+    payment_info_2_0 = etree.Element('PmtInf')
+    try:
+        for line in lines[start:stop]:
+            wizard._generate_transaction_info_block(
+                None, parallel_ctx['uid'], payment_info_2_0, line,
+                sequence_type, parallel_ctx['previous_banks'], None,
+                parallel_ctx['creditor_blocks'], parallel_ctx['gen_args'],
+                context=parallel_ctx['context'])
+    except orm.except_orm, e:
+        return (e.name, e.value), None
+    return None, ''.join(
+        etree.tostring(node, pretty_print=True, encoding='UTF-8',
+                       xml_declaration=False)
+        for node in payment_info_2_0)
+
+# Compiled XML schemas of the pain flavours, per xsd file
+_xml_schemas = {}
+_xml_schemas_lock = threading.Lock()
+# Number of transactions validated at once when a file is validated one
+# payment info block at a time
+VALIDATION_SLICE_SIZE = 1000
+
+
+def get_xml_schema(xsd_file):
+    """ Compiled XMLSchema of the xsd_file of the addons, parsed only once
+    per process
+    """
+    schema = _xml_schemas.get(xsd_file)
+    if schema is None:
+        with _xml_schemas_lock:
+            schema = _xml_schemas.get(xsd_file)
+            if schema is None:
+                xsd_file_obj = tools.file_open(xsd_file)
+                try:
+                    schema = etree.XMLSchema(etree.parse(xsd_file_obj))
+                finally:
+                    xsd_file_obj.close()
+                _xml_schemas[xsd_file] = schema
+    return schema
+
+
+class PaymentInfoValidator(object):
+    """ Validates a pain file one PmtInf block at a time while it is
+    generated, instead of the whole file at the end.
+
+    Each block is validated in a document of its own that has the group
+    header of the file. The transactions of a streamed block are validated
+    by slices of slice_size, so the memory used doesn't depend on the size
+    of the blocks.
+    """
+
+    def __init__(self, validate, document_start, document_end,
+                 slice_size=VALIDATION_SLICE_SIZE):
+        """
+        :param validate: function validating an XML string
+        :param document_start: the file up to the end of the group header
+        :param document_end: the end of the file after the last PmtInf
+        """
+        self.validate = validate
+        self.document_start = document_start
+        self.document_end = document_end
+        self.slice_size = slice_size
+        self.payment_info_start = ''
+        self.transactions = []
+        self.transactions_count = 0
+
+    def validate_payment_info(self, payment_info):
+        """ Validate a serialised PmtInf block """
+        self.validate(self.document_start + payment_info + self.document_end)
+
+    def start_payment_info(self, payment_info_start):
+        """ Start a streamed PmtInf block, payment_info_start being its
+        serialised children before the transactions
+        """
+        self.flush()
+        self.payment_info_start = payment_info_start
+
+    def add_transactions(self, transactions, count=1):
+        """ Add count serialised DrctDbtTxInf blocks to the streamed
+        PmtInf block
+        """
+        self.transactions.append(transactions)
+        self.transactions_count += count
+        if self.transactions_count >= self.slice_size:
+            self.flush()
+
+    def flush(self):
+        """ Validate the transactions of the streamed PmtInf block that
+        are not validated yet
+        """
+        if self.transactions:
+            self.validate_payment_info('<PmtInf>\n%s%s</PmtInf>\n' % (
+                self.payment_info_start, ''.join(self.transactions)))
+        self.transactions = []
+        self.transactions_count = 0
+
+# Snapshots of the payment lines and their related records, read by
+# banking_export_sdd_wizard._load_payment_lines. Their attributes have the
+# names of the fields, so they can be used like browse records in the
+# expressions given to _prepare_field.
+class RecordData(object):
+    """ Base of the snapshots: like browse_null, the snapshot of an empty
+    many2one (id False) is false in tests
+    """
+    __slots__ = ()
+
+    def __nonzero__(self):
+        return bool(self.id)
+
+
+def _record_data(name, field_names):
+    """ Snapshot type name with the fields field_names """
+    return type(name, (RecordData, collections.namedtuple(name, field_names)),
+                {'__slots__': ()})
+
+PaymentLineData = _record_data(
+    'PaymentLineData',
+    'id order_id name amount_currency priority date state communication '
+    'struct_communication_type ml_maturity_date currency partner_id bank_id '
+    'sdd_mandate_id ml_inv_ref')
+MandateData = _record_data(
+    'MandateData',
+    'id state type recurrent_sequence_type unique_mandate_reference '
+    'signature_date last_debit_date sepa_migrated '
+    'original_mandate_identification partner_id')
+BankAccountData = _record_data('BankAccountData', 'id acc_number bank')
+BankData = _record_data('BankData', 'id bic')
+PartnerData = _record_data('PartnerData', 'id name')
+CurrencyData = _record_data('CurrencyData', 'id name')
+InvoiceData = _record_data('InvoiceData', 'id number')
+
+
+def _empty_record(record_type):
+    """ Snapshot of an empty many2one, all fields False like browse_null """
+    return record_type(*([False] * len(record_type._fields)))
+
+
+def _m2o_id(value):
+    """ Id of a many2one value returned by read() """
+    if isinstance(value, (tuple, list)):
+        return value[0]
+    return value or False
+
 def checksum(number):
     """
     Create a valid betalingskenmerk for the Dutch rabobank.
@@ -136,6 +382,196 @@ class banking_export_sdd_wizard(orm.TransientModel):
         return super(banking_export_sdd_wizard, self).create(
             cr, uid, vals, context=context)
 
+    def _read_records(self, cr, uid, model, ids, record_type, relations=None,
+                      context=None):
+        """ Read the records ids of model at once into record_type tuples.
+
+        :param relations: dict many2one field -> (dict id -> tuple of the
+                          related records already read, their tuple type)
+        :return: dict id -> record_type tuple
+        """
+        relations = relations or {}
+        ids = list(set(ids) - set([False]))
+        records = {}
+        if not ids:
+            return records
+        fields_to_read = [field for field in record_type._fields
+                          if field != 'id']
+        for values in self.pool[model].read(
+                cr, uid, ids, fields_to_read, context=context,
+                load='_classic_write'):
+            for field, (related, related_type) in relations.iteritems():
+                values[field] = related.get(
+                    _m2o_id(values[field]), _empty_record(related_type))
+            records[values['id']] = record_type(
+                **dict((field, values[field])
+                       for field in record_type._fields))
+        return records
+
+    def _load_payment_lines(self, cr, uid, payment_order_ids, context=None):
+        """ Read the payment lines of the payment orders with their
+        mandates, bank accounts, partners, currencies and invoices, with one
+        read per model instead of one query per line and field.
+
+        :return: dict payment order id -> list of PaymentLineData, in the
+                 order of payment_order.line_ids
+        """
+        line_obj = self.pool['payment.line']
+        line_ids = line_obj.search(
+            cr, uid, [('order_id', 'in', payment_order_ids)], context=context)
+        line_fields = [field for field in PaymentLineData._fields
+                       if field != 'id']
+        lines = line_obj.read(cr, uid, line_ids, line_fields,
+                              context=context, load='_classic_write')
+        for values in lines:
+            for field in ('order_id', 'currency', 'partner_id', 'bank_id',
+                          'sdd_mandate_id', 'ml_inv_ref'):
+                values[field] = _m2o_id(values[field])
+
+        mandate_values = self.pool['sdd.mandate'].read(
+            cr, uid,
+            list(set(values['sdd_mandate_id'] for values in lines) -
+                 set([False])),
+            ['partner_id'], context=context, load='_classic_write')
+        partner_ids = set(values['partner_id'] for values in lines)
+        partner_ids.update(_m2o_id(values['partner_id'])
+                           for values in mandate_values)
+
+        partners = self._read_records(
+            cr, uid, 'res.partner', partner_ids, PartnerData,
+            context=context)
+        mandates = self._read_records(
+            cr, uid, 'sdd.mandate',
+            [values['sdd_mandate_id'] for values in lines], MandateData,
+            relations={'partner_id': (partners, PartnerData)},
+            context=context)
+        bank_account_values = self.pool['res.partner.bank'].read(
+            cr, uid,
+            list(set(values['bank_id'] for values in lines) - set([False])),
+            ['bank'], context=context, load='_classic_write')
+        banks = self._read_records(
+            cr, uid, 'res.bank',
+            [_m2o_id(values['bank']) for values in bank_account_values],
+            BankData, context=context)
+        bank_accounts = self._read_records(
+            cr, uid, 'res.partner.bank',
+            [values['bank_id'] for values in lines], BankAccountData,
+            relations={'bank': (banks, BankData)}, context=context)
+        currencies = self._read_records(
+            cr, uid, 'res.currency',
+            [values['currency'] for values in lines], CurrencyData,
+            context=context)
+        invoices = self._read_records(
+            cr, uid, 'account.invoice',
+            [values['ml_inv_ref'] for values in lines], InvoiceData,
+            context=context)
+
+        related = {
+            'currency': (currencies, CurrencyData),
+            'partner_id': (partners, PartnerData),
+            'bank_id': (bank_accounts, BankAccountData),
+            'sdd_mandate_id': (mandates, MandateData),
+            'ml_inv_ref': (invoices, InvoiceData),
+        }
+        lines_per_order = dict((order_id, []) for order_id in payment_order_ids)
+        for values in lines:
+            for field, (records, record_type) in related.iteritems():
+                values[field] = records.get(
+                    values[field], _empty_record(record_type))
+            lines_per_order[values['order_id']].append(PaymentLineData(
+                **dict((field, values[field])
+                       for field in PaymentLineData._fields)))
+        return lines_per_order
+
+    def _prepare_field(self, cr, uid, field_name, field_value, eval_ctx,
+                       max_size=0, gen_args=None, context=None):
+        """ Same as in banking.export.pain, with the field expressions
+        compiled once and the ASCII conversion memoised, see field_accessor
+        and convert_to_ascii.
+        """
+        if gen_args is None:
+            gen_args = {}
+        assert isinstance(eval_ctx, dict), 'wrong type for eval_ctx'
+        try:
+            value = field_accessor(field_value)(eval_ctx)
+            if gen_args.get('convert_to_ascii'):
+                value = convert_to_ascii(value)
+        except Exception:
+            line = eval_ctx.get('line')
+            if line:
+                raise orm.except_orm(
+                    _('Error:'),
+                    _("Cannot compute the '%s' of the Payment Line with "
+                      "reference '%s'.")
+                    % (field_name, line.name))
+            else:
+                raise orm.except_orm(
+                    _('Error:'),
+                    _("Cannot compute the '%s'.") % field_name)
+        if not isinstance(value, (str, unicode)):
+            raise orm.except_orm(
+                _('Field type error:'),
+                _("The type of the field '%s' is %s. It should be a string "
+                  "or unicode.")
+                % (field_name, type(value)))
+        if not value:
+            raise orm.except_orm(
+                _('Error:'),
+                _("The '%s' is empty or 0. It should have a non-null value.")
+                % field_name)
+        if max_size and len(value) > max_size:
+            value = value[0:max_size]
+        return value
+
+    def _get_previous_banks(self, cr, uid, lines, context=None):
+        """ Same as _get_previous_bank for many payment lines at once: the
+        bank account of the most recently sent payment line of each mandate
+        that has another bank account than the line, in one query.
+
+        :param lines: PaymentLineData
+        :return: dict (mandate id, bank account id or False) of the lines ->
+                 BankAccountData of the previous bank account, the lines
+                 without one are not in the dict
+        """
+        current_banks = set((line.sdd_mandate_id.id, line.bank_id.id)
+                            for line in lines if line.sdd_mandate_id.id)
+        if not current_banks:
+            return {}
+        values = ','.join(cr.mogrify('(%s, %s::integer)', (mandate_id, bank_id or None))
+                          for mandate_id, bank_id in current_banks)
+        cr.execute("""
+            SELECT mandate_id, current_bank_id, bank_id FROM (
+                SELECT current.mandate_id, current.bank_id AS current_bank_id,
+                       pl.bank_id,
+                       row_number() OVER (
+                           PARTITION BY current.mandate_id, current.bank_id
+                           ORDER BY po.date_sent DESC, pl.id) AS row_rank
+                FROM payment_line pl
+                JOIN payment_order po ON po.id = pl.order_id
+                JOIN (VALUES %s) AS current(mandate_id, bank_id)
+                    ON current.mandate_id = pl.sdd_mandate_id
+                WHERE pl.bank_id IS DISTINCT FROM current.bank_id
+                  AND po.date_sent IS NOT NULL
+            ) AS previous
+            WHERE row_rank = 1 AND bank_id IS NOT NULL
+            """ % values)
+        previous_bank_ids = dict(
+            ((mandate_id, current_bank_id or False), bank_id)
+            for mandate_id, current_bank_id, bank_id in cr.fetchall())
+        bank_account_values = self.pool['res.partner.bank'].read(
+            cr, uid, previous_bank_ids.values(), ['bank'], context=context,
+            load='_classic_write')
+        banks = self._read_records(
+            cr, uid, 'res.bank',
+            [_m2o_id(values['bank']) for values in bank_account_values],
+            BankData, context=context)
+        bank_accounts = self._read_records(
+            cr, uid, 'res.partner.bank', previous_bank_ids.values(),
+            BankAccountData, relations={'bank': (banks, BankData)},
+            context=context)
+        return dict((key, bank_accounts[bank_id])
+                    for key, bank_id in previous_bank_ids.iteritems())
+
     def _get_previous_bank(self, cr, uid, payline, context=None):
         payline_obj = self.pool['payment.line']
         previous_bank = False
@@ -199,8 +635,7 @@ class banking_export_sdd_wizard(orm.TransientModel):
             'pain_flavor': pain_flavor,
             'sepa_export': sepa_export,
             'file_obj': self.pool['banking.export.sdd'],
-            'pain_xsd_file':
-            'account_banking_sepa_direct_debit/data/%s.xsd' % pain_flavor,
+            'pain_xsd_file': self._get_pain_xsd_file(pain_flavor),
         }
 
         pain_ns = {
@@ -208,26 +643,27 @@ class banking_export_sdd_wizard(orm.TransientModel):
             None: 'urn:iso:std:iso:20022:tech:xsd:%s' % pain_flavor,
             }
 
-        xml_root = etree.Element('Document', nsmap=pain_ns)
-        pain_root = etree.SubElement(xml_root, root_xml_tag)
-
-        # A. Group header
-        group_header_1_0, nb_of_transactions_1_6, control_sum_1_7 = \
-            self.generate_group_header_block(
-                cr, uid, pain_root, gen_args, context=context)
+        lines_per_order = self._load_payment_lines(
+            cr, uid, [order.id for order in sepa_export.payment_order_ids],
+            context=context)
 
         transactions_count_1_6 = 0
         total_amount = 0.0
         amount_control_sum_1_7 = 0.0
         lines_per_group = {}
         # key = (requested_date, priority, sequence type)
-        # value = list of lines as objects
+        # value = list of lines as PaymentLineData
+        group_totals = {}
+        # key = (requested_date, priority, sequence type)
+        # value = [number of transactions, control sum]
+        line_ids_per_date = {}
+        # key = requested_date, value = ids of the lines to set it on
         # Iterate on payment orders
         today = fields.date.context_today(self, cr, uid, context=context)
         for payment_order in sepa_export.payment_order_ids:
             total_amount = total_amount + payment_order.total
             # Iterate each payment lines
-            for line in payment_order.line_ids:
+            for line in lines_per_order[payment_order.id]:
                 transactions_count_1_6 += 1
                 priority = line.priority
                 if payment_order.date_prefered == 'due':
@@ -279,178 +715,560 @@ class banking_export_sdd_wizard(orm.TransientModel):
                     lines_per_group[key].append(line)
                 else:
                     lines_per_group[key] = [line]
+                    group_totals[key] = [0, 0.0]
+                group_totals[key][0] += 1
+                group_totals[key][1] += line.amount_currency
+                amount_control_sum_1_7 += line.amount_currency
                 # Write requested_exec_date on 'Payment date' of the pay line
                 if requested_date != line.date:
-                    self.pool['payment.line'].write(
-                        cr, uid, line.id,
-                        {'date': requested_date}, context=context)
-
-        for (requested_date, priority, sequence_type), lines in \
-                lines_per_group.items():
-            # B. Payment info
-            payment_info_2_0, nb_of_transactions_2_4, control_sum_2_5 = \
-                self.generate_start_payment_info_block(
-                    cr, uid, pain_root,
-                    "sepa_export.payment_order_ids[0].reference + '-' + "
-                    "sequence_type + '-' + requested_date.replace('-', '')  "
-                    "+ '-' + priority",
-                    priority, 'CORE', sequence_type, requested_date, {
-                        'sepa_export': sepa_export,
-                        'sequence_type': sequence_type,
-                        'priority': priority,
-                        'requested_date': requested_date,
-                    }, gen_args, context=context)
-
-            self.generate_party_block(
-                cr, uid, payment_info_2_0, 'Cdtr', 'B',
-                'sepa_export.payment_order_ids[0].mode.bank_id.partner_id.'
-                'name',
-                'sepa_export.payment_order_ids[0].mode.bank_id.acc_number',
-                'sepa_export.payment_order_ids[0].mode.bank_id.bank.bic',
-                {'sepa_export': sepa_export},
-                gen_args, context=context)
+                    line_ids_per_date.setdefault(
+                        requested_date, []).append(line.id)
+
+        for requested_date, line_ids in line_ids_per_date.iteritems():
+            self.pool['payment.line'].write(
+                cr, uid, line_ids, {'date': requested_date}, context=context)
+
+        # Previous bank accounts of the FRST lines that need amendment info
+        previous_banks = self._get_previous_banks(
+            cr, uid, [line for (requested_date, priority, sequence_type), lines
+                      in lines_per_group.iteritems()
+                      if sequence_type == 'FRST'
+                      for line in lines
+                      if line.sdd_mandate_id.last_debit_date or
+                      not line.sdd_mandate_id.sepa_migrated],
+            context=context)
 
-            charge_bearer_2_24 = etree.SubElement(payment_info_2_0, 'ChrgBr')
-            charge_bearer_2_24.text = sepa_export.charge_bearer
+        # The number of transactions and the control sums are known before
+        # the blocks are generated, so big files can be written to a
+        # temporary file block by block instead of built in memory.
+        stream_threshold = self._get_stream_threshold(
+            cr, uid, context=context)
+        stream = stream_threshold and transactions_count_1_6 >= stream_threshold
+        document_start = "<?xml version='1.0' encoding='UTF-8'?>\n" \
+            '<Document%s>\n<%s>\n' % (
+                ''.join(' xmlns%s="%s"' % (prefix and ':' + prefix or '', ns)
+                        for prefix, ns in sorted(pain_ns.items())),
+                root_xml_tag)
+        document_end = '</%s>\n</Document>\n' % root_xml_tag
+        if stream:
+            xml_file = tempfile.TemporaryFile()
+            xml_file.write(document_start)
 
-            creditor_scheme_identification_2_27 = etree.SubElement(
-                payment_info_2_0, 'CdtrSchmeId')
-            self.generate_creditor_scheme_identification(
-                cr, uid, creditor_scheme_identification_2_27,
-                'sepa_export.payment_order_ids[0].company_id.'
-                'sepa_creditor_identifier',
-                'SEPA Creditor Identifier', {'sepa_export': sepa_export},
-                'SEPA', gen_args, context=context)
+        xml_root = etree.Element('Document', nsmap=pain_ns)
+        pain_root = etree.SubElement(xml_root, root_xml_tag)
 
-            transactions_count_2_4 = 0
-            amount_control_sum_2_5 = 0.0
-            for line in lines:
-                transactions_count_2_4 += 1
-                # C. Direct Debit Transaction Info
-                dd_transaction_info_2_28 = etree.SubElement(
-                    payment_info_2_0, 'DrctDbtTxInf')
-                payment_identification_2_29 = etree.SubElement(
-                    dd_transaction_info_2_28, 'PmtId')
-                end2end_identification_2_31 = etree.SubElement(
-                    payment_identification_2_29, 'EndToEndId')
-                end2end_identification_2_31.text = self._prepare_field(
-                    cr, uid, 'End to End Identification', 'line.name',
-                    {'line': line}, 35,
-                    gen_args=gen_args, context=context)
-                currency_name = self._prepare_field(
-                    cr, uid, 'Currency Code', 'line.currency.name',
-                    {'line': line}, 3, gen_args=gen_args,
-                    context=context)
-                instructed_amount_2_44 = etree.SubElement(
-                    dd_transaction_info_2_28, 'InstdAmt', Ccy=currency_name)
-                instructed_amount_2_44.text = '%.2f' % line.amount_currency
-                amount_control_sum_1_7 += line.amount_currency
-                amount_control_sum_2_5 += line.amount_currency
-                dd_transaction_2_46 = etree.SubElement(
-                    dd_transaction_info_2_28, 'DrctDbtTx')
-                mandate_related_info_2_47 = etree.SubElement(
-                    dd_transaction_2_46, 'MndtRltdInf')
-                mandate_identification_2_48 = etree.SubElement(
-                    mandate_related_info_2_47, 'MndtId')
-                mandate_identification_2_48.text = self._prepare_field(
-                    cr, uid, 'Unique Mandate Reference',
-                    'line.sdd_mandate_id.unique_mandate_reference',
-                    {'line': line}, 35,
-                    gen_args=gen_args, context=context)
-                mandate_signature_date_2_49 = etree.SubElement(
-                    mandate_related_info_2_47, 'DtOfSgntr')
-                mandate_signature_date_2_49.text = self._prepare_field(
-                    cr, uid, 'Mandate Signature Date',
-                    'line.sdd_mandate_id.signature_date',
-                    {'line': line}, 10,
-                    gen_args=gen_args, context=context)
-                if sequence_type == 'FRST' and (
-                        line.sdd_mandate_id.last_debit_date or
-                        not line.sdd_mandate_id.sepa_migrated):
-                    previous_bank = self._get_previous_bank(
-                        cr, uid, line, context=context)
-                    if previous_bank or not line.sdd_mandate_id.sepa_migrated:
-                        amendment_indicator_2_50 = etree.SubElement(
-                            mandate_related_info_2_47, 'AmdmntInd')
-                        amendment_indicator_2_50.text = 'true'
-                        amendment_info_details_2_51 = etree.SubElement(
-                            mandate_related_info_2_47, 'AmdmntInfDtls')
-                    if previous_bank:
-                        if previous_bank.bank.bic == line.bank_id.bank.bic:
-                            ori_debtor_account_2_57 = etree.SubElement(
-                                amendment_info_details_2_51, 'OrgnlDbtrAcct')
-                            ori_debtor_account_id = etree.SubElement(
-                                ori_debtor_account_2_57, 'Id')
-                            ori_debtor_account_iban = etree.SubElement(
-                                ori_debtor_account_id, 'IBAN')
-                            ori_debtor_account_iban.text = self._validate_iban(
-                                cr, uid, self._prepare_field(
-                                    cr, uid, 'Original Debtor Account',
-                                    'previous_bank.acc_number',
-                                    {'previous_bank': previous_bank},
-                                    gen_args=gen_args,
-                                    context=context),
-                                context=context)
-                        else:
-                            ori_debtor_agent_2_58 = etree.SubElement(
-                                amendment_info_details_2_51, 'OrgnlDbtrAgt')
-                            ori_debtor_agent_institution = etree.SubElement(
-                                ori_debtor_agent_2_58, 'FinInstnId')
-                            ori_debtor_agent_bic = etree.SubElement(
-                                ori_debtor_agent_institution, bic_xml_tag)
-                            ori_debtor_agent_bic.text = self._prepare_field(
-                                cr, uid, 'Original Debtor Agent',
-                                'previous_bank.bank.bic',
-                                {'previous_bank': previous_bank},
-                                gen_args=gen_args,
-                                context=context)
-                            ori_debtor_agent_other = etree.SubElement(
-                                ori_debtor_agent_institution, 'Othr')
-                            ori_debtor_agent_other_id = etree.SubElement(
-                                ori_debtor_agent_other, 'Id')
-                            ori_debtor_agent_other_id.text = 'SMNDA'
-                            # SMNDA = Same Mandate New Debtor Agent
-                    elif not line.sdd_mandate_id.sepa_migrated:
-                        ori_mandate_identification_2_52 = etree.SubElement(
-                            amendment_info_details_2_51, 'OrgnlMndtId')
-                        ori_mandate_identification_2_52.text = \
-                            self._prepare_field(
-                                cr, uid, 'Original Mandate Identification',
-                                'line.sdd_mandate_id.'
-                                'original_mandate_identification',
-                                {'line': line},
-                                gen_args=gen_args,
-                                context=context)
-                        ori_creditor_scheme_id_2_53 = etree.SubElement(
-                            amendment_info_details_2_51, 'OrgnlCdtrSchmeId')
-                        self.generate_creditor_scheme_identification(
-                            cr, uid, ori_creditor_scheme_id_2_53,
-                            'sepa_export.payment_order_ids[0].company_id.'
-                            'original_creditor_identifier',
-                            'Original Creditor Identifier',
-                            {'sepa_export': sepa_export},
-                            'SEPA', gen_args, context=context)
-
-                self.generate_party_block(
-                    cr, uid, dd_transaction_info_2_28, 'Dbtr', 'C',
-                    'line.partner_id.name',
-                    'line.bank_id.acc_number',
-                    'line.bank_id.bank.bic',
-                    {'line': line}, gen_args, context=context)
-
-                self.generate_remittance_info_block(
-                    cr, uid, dd_transaction_info_2_28,
-                    line, gen_args, context=context)
-
-            nb_of_transactions_2_4.text = str(transactions_count_2_4)
-            control_sum_2_5.text = '%.2f' % amount_control_sum_2_5
+        # The creditor blocks are the same for all the payment info blocks
+        creditor_blocks = self._generate_creditor_blocks(
+            cr, uid, sepa_export, gen_args, context=context)
+
+        # A. Group header
+        group_header_1_0, nb_of_transactions_1_6, control_sum_1_7 = \
+            self.generate_group_header_block(
+                cr, uid, pain_root, gen_args, context=context)
         nb_of_transactions_1_6.text = str(transactions_count_1_6)
         control_sum_1_7.text = '%.2f' % amount_control_sum_1_7
-
+        if stream:
+            group_header = self._write_xml_block(xml_file, group_header_1_0)
+        else:
+            group_header = etree.tostring(
+                group_header_1_0, pretty_print=True, encoding='UTF-8',
+                xml_declaration=False)
+
+        gen_args['xml_validation'] = self._get_validation_mode(
+            cr, uid, context=context)
+        if stream and gen_args['xml_validation'] == 'full':
+            # a streamed file is never parsed whole, its payment info blocks
+            # are validated while they are written
+            gen_args['xml_validation'] = 'block'
+        validator = None
+        if gen_args['xml_validation'] == 'block':
+            validator = PaymentInfoValidator(
+                lambda xml_string: self._assert_valid_xml(
+                    cr, uid, xml_string, gen_args, context=context),
+                document_start + group_header, document_end)
+
+        # The groups are sorted so the file is the same whether the
+        # transactions are generated here or by worker processes
+        groups = sorted(lines_per_group.items())
+        transaction_fragments = None
+        parallel_workers = self._get_parallel_workers(
+            cr, uid, context=context)
+        if parallel_workers > 1 and \
+                transactions_count_1_6 > PARALLEL_CHUNK_SIZE:
+            transaction_fragments = self._generate_transaction_fragments(
+                cr, uid, groups, previous_banks, sepa_export,
+                creditor_blocks, gen_args, parallel_workers, context=context)
+
+        try:
+            for (requested_date, priority, sequence_type), lines in groups:
+                transactions_count_2_4, amount_control_sum_2_5 = \
+                    group_totals[(requested_date, priority, sequence_type)]
+                # B. Payment info
+                payment_info_2_0 = self._generate_payment_info_block(
+                    cr, uid, pain_root, requested_date, priority,
+                    sequence_type, transactions_count_2_4,
+                    amount_control_sum_2_5, sepa_export, creditor_blocks,
+                    gen_args, context=context)
+                if stream:
+                    xml_file.write('<PmtInf>\n')
+                    payment_info_start = ''.join(
+                        self._write_xml_block(xml_file, child)
+                        for child in list(payment_info_2_0))
+                    if validator:
+                        validator.start_payment_info(payment_info_start)
+
+                if transaction_fragments is not None:
+                    # C. Direct Debit Transaction Info, from the worker
+                    # processes
+                    for start in xrange(0, len(lines), PARALLEL_CHUNK_SIZE):
+                        fragment = transaction_fragments.next()
+                        if stream:
+                            xml_file.write(fragment)
+                            if validator:
+                                validator.add_transactions(
+                                    fragment, len(lines[
+                                        start:start + PARALLEL_CHUNK_SIZE]))
+                        else:
+                            for dd_transaction_info_2_28 in list(
+                                    etree.fromstring(
+                                        '<PmtInf>%s</PmtInf>' % fragment)):
+                                payment_info_2_0.append(
+                                    dd_transaction_info_2_28)
+                else:
+                    for line in lines:
+                        # C. Direct Debit Transaction Info
+                        dd_transaction_info_2_28 = \
+                            self._generate_transaction_info_block(
+                                cr, uid, payment_info_2_0, line, sequence_type,
+                                previous_banks, sepa_export, creditor_blocks,
+                                gen_args, context=context)
+                        if stream:
+                            transaction = self._write_xml_block(
+                                xml_file, dd_transaction_info_2_28)
+                            if validator:
+                                validator.add_transactions(transaction)
+
+                if stream:
+                    xml_file.write('</PmtInf>\n')
+                    pain_root.remove(payment_info_2_0)
+                    if validator:
+                        validator.flush()
+                elif validator:
+                    validator.validate_payment_info(etree.tostring(
+                        payment_info_2_0, pretty_print=True, encoding='UTF-8',
+                        xml_declaration=False))
+        finally:
+            if transaction_fragments is not None:
+                # stops the worker processes when the generation failed
+                transaction_fragments.close()
+
+        if stream:
+            xml_file.write(document_end)
+            return self._finalize_sepa_file_stream(
+                cr, uid, ids, xml_file, total_amount, transactions_count_1_6,
+                gen_args, context=context)
         return self.finalize_sepa_file_creation(
             cr, uid, ids, xml_root, total_amount, transactions_count_1_6,
             gen_args, context=context)
 
+    def _get_stream_threshold(self, cr, uid, context=None):
+        """ Number of transactions from which the SEPA file is streamed to a
+        temporary file, 0 to never stream
+        """
+        icp_obj = self.pool['ir.config_parameter']
+        try:
+            return int(icp_obj.get_param(
+                cr, SUPERUSER_ID,
+                'sp_account_banking_sepa_direct_debit.stream_threshold', 0))
+        except ValueError:
+            return 0
+
+    def _get_parallel_workers(self, cr, uid, context=None):
+        """ Number of processes generating the transactions of big SEPA
+        files, 0 to generate them in the current process.
+
+        Only a server running with worker processes (the workers option) may
+        fork: the processes forked from the threads of a threaded server
+        inherit the locks other threads hold, e.g. of the logging or the
+        database connections.
+        """
+        if not tools.config.get('workers'):
+            return 0
+        icp_obj = self.pool['ir.config_parameter']
+        try:
+            return int(icp_obj.get_param(
+                cr, SUPERUSER_ID,
+                'sp_account_banking_sepa_direct_debit.parallel_workers', 0))
+        except ValueError:
+            return 0
+
+    def _generate_transaction_fragments(
+            self, cr, uid, groups, previous_banks, sepa_export,
+            creditor_blocks, gen_args, workers, context=None):
+        """ Generate the DrctDbtTxInf blocks of the groups with a pool of
+        worker processes.
+
+        The lines of each group are cut in slices of PARALLEL_CHUNK_SIZE
+        lines. The workers don't use the database, so everything they need
+        is read before they are forked.
+
+        :param groups: list of ((requested_date, priority, sequence type),
+                       list of PaymentLineData)
+        :return: iterator on the serialised blocks of the slices, in the
+                 order of the groups and of their lines
+        """
+        for (requested_date, priority, sequence_type), lines in groups:
+            if sequence_type == 'FRST' and any(
+                    not line.sdd_mandate_id.sepa_migrated and
+                    (line.sdd_mandate_id.id, line.bank_id.id or False)
+                    not in previous_banks
+                    for line in lines):
+                self._get_original_creditor_scheme(
+                    cr, uid, sepa_export, creditor_blocks, gen_args,
+                    context=context)
+                break
+        key = _parallel_keys.next()
+        tasks = [(key, group_index, start, start + PARALLEL_CHUNK_SIZE)
+                 for group_index, (group_key, lines) in enumerate(groups)
+                 for start in xrange(0, len(lines), PARALLEL_CHUNK_SIZE)]
+        _parallel_contexts[key] = {
+            'wizard': self,
+            'uid': uid,
+            'groups': [(sequence_type, lines) for
+                       (requested_date, priority, sequence_type), lines
+                       in groups],
+            'previous_banks': previous_banks,
+            'creditor_blocks': creditor_blocks,
+            'gen_args': gen_args,
+            # without the language, the errors of the workers are not
+            # translated there, which would need a cursor
+            'context': dict((name, value) for name, value
+                            in (context or {}).iteritems()
+                            if name != 'lang'),
+        }
+        LOGGER.info('Generating %d SEPA transaction slices with %d processes',
+                    len(tasks), workers)
+        pool = None
+        try:
+            pool = multiprocessing.Pool(
+                workers, initializer=_init_parallel_worker)
+            for task, (error, fragment) in itertools.izip(
+                    tasks, pool.imap(_generate_transactions_fragment, tasks)):
+                if error:
+                    # generate the slice again here, so the error is raised
+                    # with a cursor and translated
+                    group_index, start, stop = task[1:]
+                    (requested_date, priority, sequence_type), lines = \
+                        groups[group_index]
+                    payment_info_2_0 = etree.Element('PmtInf')
+                    for line in lines[start:stop]:
+                        self._generate_transaction_info_block(
+                            cr, uid, payment_info_2_0, line, sequence_type,
+                            previous_banks, sepa_export, creditor_blocks,
+                            gen_args, context=context)
+                    raise orm.except_orm(*error)
+                yield fragment
+            pool.close()
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            del _parallel_contexts[key]
+
+    def _write_xml_block(self, xml_file, node):
+        """ Write node to xml_file and drop it from the document
+
+        :return: the string written
+        """
+        xml_string = etree.tostring(
+            node, pretty_print=True, encoding='UTF-8', xml_declaration=False)
+        xml_file.write(xml_string)
+        node.getparent().remove(node)
+        return xml_string
+
+    def _get_validation_mode(self, cr, uid, context=None):
+        """ How the SEPA files are validated against the XML schema:
+        'full' once complete, 'block' one payment info block at a time while
+        they are generated, 'deferred' by a scheduled action once stored
+        """
+        icp_obj = self.pool['ir.config_parameter']
+        mode = icp_obj.get_param(
+            cr, SUPERUSER_ID,
+            'sp_account_banking_sepa_direct_debit.validation_mode', 'full')
+        if mode not in ('full', 'block', 'deferred'):
+            return 'full'
+        return mode
+
+    def _get_pain_xsd_file(self, pain_flavor):
+        """ Path in the addons of the XML schema of a pain flavour """
+        return 'account_banking_sepa_direct_debit/data/%s.xsd' % pain_flavor
+
+    def _assert_valid_xml(self, cr, uid, xml_string, gen_args, context=None):
+        """ Validate xml_string against the cached XML schema of the pain
+        flavour, raise an error like banking.export.pain when it's invalid
+        """
+        try:
+            get_xml_schema(gen_args['pain_xsd_file']).assertValid(
+                etree.fromstring(xml_string))
+        except Exception, e:
+            LOGGER.warning(
+                "The XML file is invalid against the XML Schema Definition")
+            LOGGER.warning(xml_string)
+            LOGGER.warning(e)
+            raise orm.except_orm(
+                _('Error:'),
+                _("The generated XML file is not valid against the official "
+                    "XML Schema Definition. The generated XML file and the "
+                    "full error have been written in the server logs. Here "
+                    "is the error, which may give you an idea on the cause "
+                    "of the problem : %s")
+                % str(e))
+        return True
+
+    def _validate_xml(self, cr, uid, xml_string, gen_args, context=None):
+        """ Validate the complete file with the cached XML schema, unless it
+        was validated block by block or is validated once stored
+        """
+        if gen_args.get('xml_validation') in ('block', 'deferred'):
+            return True
+        return self._assert_valid_xml(
+            cr, uid, xml_string, gen_args, context=context)
+
+    def _prepare_export_sepa(self, cr, uid, total_amount, transactions_count,
+                             xml_string, gen_args, context=None):
+        vals = super(banking_export_sdd_wizard, self)._prepare_export_sepa(
+            cr, uid, total_amount, transactions_count, xml_string, gen_args,
+            context=context)
+        vals['validation_state'] = \
+            gen_args.get('xml_validation') == 'deferred' and 'pending' \
+            or 'valid'
+        return vals
+
+    def _generate_creditor_blocks(self, cr, uid, sepa_export, gen_args,
+                                  context=None):
+        """ Generate the blocks of the creditor that are the same in all
+        the payment info blocks of the file.
+
+        :return: dict with under 'creditor' the Cdtr, CdtrAcct, CdtrAgt,
+                 ChrgBr and CdtrSchmeId blocks. 'original_creditor_scheme'
+                 is the OrgnlCdtrSchmeId block of the amendments, made on
+                 first use by _get_original_creditor_scheme.
+        """
+        payment_info_2_0 = etree.Element('PmtInf')
+        self.generate_party_block(
+            cr, uid, payment_info_2_0, 'Cdtr', 'B',
+            'sepa_export.payment_order_ids[0].mode.bank_id.partner_id.'
+            'name',
+            'sepa_export.payment_order_ids[0].mode.bank_id.acc_number',
+            'sepa_export.payment_order_ids[0].mode.bank_id.bank.bic',
+            {'sepa_export': sepa_export},
+            gen_args, context=context)
+
+        charge_bearer_2_24 = etree.SubElement(payment_info_2_0, 'ChrgBr')
+        charge_bearer_2_24.text = sepa_export.charge_bearer
+
+        creditor_scheme_identification_2_27 = etree.SubElement(
+            payment_info_2_0, 'CdtrSchmeId')
+        self.generate_creditor_scheme_identification(
+            cr, uid, creditor_scheme_identification_2_27,
+            'sepa_export.payment_order_ids[0].company_id.'
+            'sepa_creditor_identifier',
+            'SEPA Creditor Identifier', {'sepa_export': sepa_export},
+            'SEPA', gen_args, context=context)
+        return {
+            'creditor': list(payment_info_2_0),
+            'original_creditor_scheme': None,
+        }
+
+    def _get_original_creditor_scheme(self, cr, uid, sepa_export,
+                                      creditor_blocks, gen_args,
+                                      context=None):
+        """ OrgnlCdtrSchmeId block of the amendments of the file """
+        if creditor_blocks['original_creditor_scheme'] is None:
+            ori_creditor_scheme_id_2_53 = etree.Element('OrgnlCdtrSchmeId')
+            self.generate_creditor_scheme_identification(
+                cr, uid, ori_creditor_scheme_id_2_53,
+                'sepa_export.payment_order_ids[0].company_id.'
+                'original_creditor_identifier',
+                'Original Creditor Identifier',
+                {'sepa_export': sepa_export},
+                'SEPA', gen_args, context=context)
+            creditor_blocks['original_creditor_scheme'] = \
+                ori_creditor_scheme_id_2_53
+        return creditor_blocks['original_creditor_scheme']
+
+    def _generate_payment_info_block(
+            self, cr, uid, parent_node, requested_date, priority,
+            sequence_type, transactions_count, control_sum, sepa_export,
+            creditor_blocks, gen_args, context=None):
+        """ Generate the PmtInf block of a group of transactions, without the
+        transactions
+        """
+        payment_info_2_0, nb_of_transactions_2_4, control_sum_2_5 = \
+            self.generate_start_payment_info_block(
+                cr, uid, parent_node,
+                "sepa_export.payment_order_ids[0].reference + '-' + "
+                "sequence_type + '-' + requested_date.replace('-', '')  "
+                "+ '-' + priority",
+                priority, 'CORE', sequence_type, requested_date, {
+                    'sepa_export': sepa_export,
+                    'sequence_type': sequence_type,
+                    'priority': priority,
+                    'requested_date': requested_date,
+                }, gen_args, context=context)
+        nb_of_transactions_2_4.text = str(transactions_count)
+        control_sum_2_5.text = '%.2f' % control_sum
+
+        for creditor_block in creditor_blocks['creditor']:
+            payment_info_2_0.append(copy.deepcopy(creditor_block))
+        return payment_info_2_0
+
+    def _generate_transaction_info_block(
+            self, cr, uid, parent_node, line, sequence_type, previous_banks,
+            sepa_export, creditor_blocks, gen_args, context=None):
+        """ Generate the DrctDbtTxInf block of a payment line """
+        bic_xml_tag = gen_args['bic_xml_tag']
+        dd_transaction_info_2_28 = etree.SubElement(
+            parent_node, 'DrctDbtTxInf')
+        payment_identification_2_29 = etree.SubElement(
+            dd_transaction_info_2_28, 'PmtId')
+        end2end_identification_2_31 = etree.SubElement(
+            payment_identification_2_29, 'EndToEndId')
+        end2end_identification_2_31.text = self._prepare_field(
+            cr, uid, 'End to End Identification', 'line.name',
+            {'line': line}, 35,
+            gen_args=gen_args, context=context)
+        currency_name = self._prepare_field(
+            cr, uid, 'Currency Code', 'line.currency.name',
+            {'line': line}, 3, gen_args=gen_args,
+            context=context)
+        instructed_amount_2_44 = etree.SubElement(
+            dd_transaction_info_2_28, 'InstdAmt', Ccy=currency_name)
+        instructed_amount_2_44.text = '%.2f' % line.amount_currency
+        dd_transaction_2_46 = etree.SubElement(
+            dd_transaction_info_2_28, 'DrctDbtTx')
+        mandate_related_info_2_47 = etree.SubElement(
+            dd_transaction_2_46, 'MndtRltdInf')
+        mandate_identification_2_48 = etree.SubElement(
+            mandate_related_info_2_47, 'MndtId')
+        mandate_identification_2_48.text = self._prepare_field(
+            cr, uid, 'Unique Mandate Reference',
+            'line.sdd_mandate_id.unique_mandate_reference',
+            {'line': line}, 35,
+            gen_args=gen_args, context=context)
+        mandate_signature_date_2_49 = etree.SubElement(
+            mandate_related_info_2_47, 'DtOfSgntr')
+        mandate_signature_date_2_49.text = self._prepare_field(
+            cr, uid, 'Mandate Signature Date',
+            'line.sdd_mandate_id.signature_date',
+            {'line': line}, 10,
+            gen_args=gen_args, context=context)
+        if sequence_type == 'FRST' and (
+                line.sdd_mandate_id.last_debit_date or
+                not line.sdd_mandate_id.sepa_migrated):
+            previous_bank = previous_banks.get(
+                (line.sdd_mandate_id.id, line.bank_id.id or False), False)
+            if previous_bank or not line.sdd_mandate_id.sepa_migrated:
+                amendment_indicator_2_50 = etree.SubElement(
+                    mandate_related_info_2_47, 'AmdmntInd')
+                amendment_indicator_2_50.text = 'true'
+                amendment_info_details_2_51 = etree.SubElement(
+                    mandate_related_info_2_47, 'AmdmntInfDtls')
+            if previous_bank:
+                if previous_bank.bank.bic == line.bank_id.bank.bic:
+                    ori_debtor_account_2_57 = etree.SubElement(
+                        amendment_info_details_2_51, 'OrgnlDbtrAcct')
+                    ori_debtor_account_id = etree.SubElement(
+                        ori_debtor_account_2_57, 'Id')
+                    ori_debtor_account_iban = etree.SubElement(
+                        ori_debtor_account_id, 'IBAN')
+                    ori_debtor_account_iban.text = self._validate_iban(
+                        cr, uid, self._prepare_field(
+                            cr, uid, 'Original Debtor Account',
+                            'previous_bank.acc_number',
+                            {'previous_bank': previous_bank},
+                            gen_args=gen_args,
+                            context=context),
+                        context=context)
+                else:
+                    ori_debtor_agent_2_58 = etree.SubElement(
+                        amendment_info_details_2_51, 'OrgnlDbtrAgt')
+                    ori_debtor_agent_institution = etree.SubElement(
+                        ori_debtor_agent_2_58, 'FinInstnId')
+                    ori_debtor_agent_bic = etree.SubElement(
+                        ori_debtor_agent_institution, bic_xml_tag)
+                    ori_debtor_agent_bic.text = self._prepare_field(
+                        cr, uid, 'Original Debtor Agent',
+                        'previous_bank.bank.bic',
+                        {'previous_bank': previous_bank},
+                        gen_args=gen_args,
+                        context=context)
+                    ori_debtor_agent_other = etree.SubElement(
+                        ori_debtor_agent_institution, 'Othr')
+                    ori_debtor_agent_other_id = etree.SubElement(
+                        ori_debtor_agent_other, 'Id')
+                    ori_debtor_agent_other_id.text = 'SMNDA'
+                    # SMNDA = Same Mandate New Debtor Agent
+            elif not line.sdd_mandate_id.sepa_migrated:
+                ori_mandate_identification_2_52 = etree.SubElement(
+                    amendment_info_details_2_51, 'OrgnlMndtId')
+                ori_mandate_identification_2_52.text = \
+                    self._prepare_field(
+                        cr, uid, 'Original Mandate Identification',
+                        'line.sdd_mandate_id.'
+                        'original_mandate_identification',
+                        {'line': line},
+                        gen_args=gen_args,
+                        context=context)
+                amendment_info_details_2_51.append(copy.deepcopy(
+                    self._get_original_creditor_scheme(
+                        cr, uid, sepa_export, creditor_blocks, gen_args,
+                        context=context)))
+
+        self.generate_party_block(
+            cr, uid, dd_transaction_info_2_28, 'Dbtr', 'C',
+            'line.partner_id.name',
+            'line.bank_id.acc_number',
+            'line.bank_id.bank.bic',
+            {'line': line}, gen_args, context=context)
+
+        self.generate_remittance_info_block(
+            cr, uid, dd_transaction_info_2_28,
+            line, gen_args, context=context)
+        return dd_transaction_info_2_28
+
+    def _finalize_sepa_file_stream(self, cr, uid, ids, xml_file, total_amount,
+                                   transactions_count, gen_args, context=None):
+        """ Same as finalize_sepa_file_creation, for a SEPA file written to
+        the temporary file xml_file. The file was validated block by block,
+        and it's encoded for the export from the temporary file, so the
+        XML string is never in memory.
+        """
+        LOGGER.info('Generated SEPA XML file in format %s of %s bytes',
+                    gen_args['pain_flavor'], xml_file.tell())
+        xml_file.seek(0)
+        encoded_file = tempfile.TemporaryFile()
+        base64.encode(xml_file, encoded_file)
+        xml_file.close()
+        vals = self._prepare_export_sepa(
+            cr, uid, total_amount, transactions_count, '', gen_args,
+            context=context)
+        encoded_file.seek(0)
+        vals['file'] = encoded_file.read()
+        encoded_file.close()
+        file_id = gen_args['file_obj'].create(cr, uid, vals, context=context)
+        self.write(cr, uid, ids, {'file_id': file_id, 'state': 'finish'},
+                   context=context)
+        return {
+            'name': 'SEPA File',
+            'type': 'ir.actions.act_window',
+            'view_type': 'form',
+            'view_mode': 'form,tree',
+            'res_model': self._name,
+            'res_id': ids[0],
+            'target': 'new',
+        }
+
     def cancel_sepa(self, cr, uid, ids, context=None):
         '''
         Cancel the SEPA file: just drop the file
@@ -486,7 +1304,14 @@ class banking_export_sdd_wizard(orm.TransientModel):
         line_obj = self.pool.get('payment.line')
 
         sepa_export = self.browse(cr, uid, ids[0], context=context)
-        LOGGER.info('sepa_export context:' + str(context))
+        LOGGER.debug('sepa_export context: %s', context)
+        if sepa_export.file_id.validation_state == 'invalid':
+            raise orm.except_orm(
+                _('Error:'),
+                _("The SEPA file '%s' is not valid against the official XML "
+                  "Schema Definition: %s")
+                % (sepa_export.file_id.filename,
+                   sepa_export.file_id.validation_error))
 
         # Stap 1
         self.pool.get('banking.export.sdd').write(
@@ -508,15 +1333,13 @@ class banking_export_sdd_wizard(orm.TransientModel):
                     partner_id=line.sdd_mandate_id.partner_id.id,
                     line_id=line.id, )
 
-            line_nbr = len(order.line_ids)
-
             if not order.sdd_move_id:
                 # If we do not have a ssd move, create one.
                 sdd_move_id = self._create_batch_booking(cr, uid, order, context=context)
-                LOGGER.info("New sdd_move_id id %s" % (sdd_move_id,))
+                LOGGER.info("New sdd_move_id id %s", sdd_move_id)
             else:
                 sdd_move_id = order.sdd_move_id.id
-                LOGGER.info("sdd_move_id already in database: id: %s, reference: %s" % (sdd_move_id, order.sdd_move_id.ref,))
+                LOGGER.info("sdd_move_id already in database: id: %s, reference: %s", sdd_move_id, order.sdd_move_id.ref)
 
             # Commit, because the first invoice could fail and then we miss the first account move
             cr.commit()
@@ -527,54 +1350,35 @@ class banking_export_sdd_wizard(orm.TransientModel):
             amount_first = 0.0
             amount_rcur = 0.0
             total_amount = 0.0
-            confirm_errors = []
             for line in order.line_ids:
-                try:
-                    total_amount += line.amount_currency
-                    if line.sdd_mandate_id.type == 'oneoff':
+                total_amount += line.amount_currency
+                if line.sdd_mandate_id.type == 'oneoff':
+                    to_expire_ids.append(line.sdd_mandate_id.id)
+                    amount_rcur += line.amount_currency
+                elif line.sdd_mandate_id.type == 'recurrent':
+                    seq_type = line.sdd_mandate_id.recurrent_sequence_type
+                    if seq_type == 'final':
+                        amount_rcur += line.amount_currency
                         to_expire_ids.append(line.sdd_mandate_id.id)
+                    elif seq_type == 'first':
+                        amount_first += line.amount_currency
+                        first_mandate_ids.append(line.sdd_mandate_id.id)
+                    elif seq_type == 'recurring':
                         amount_rcur += line.amount_currency
-                    elif line.sdd_mandate_id.type == 'recurrent':
-                        seq_type = line.sdd_mandate_id.recurrent_sequence_type
-                        if seq_type == 'final':
-                            amount_rcur += line.amount_currency
-                            to_expire_ids.append(line.sdd_mandate_id.id)
-                        elif seq_type == 'first':
-                            amount_first += line.amount_currency
-                            first_mandate_ids.append(line.sdd_mandate_id.id)
-                        elif seq_type == 'recurring':
-                            amount_rcur += line.amount_currency
-
-                    # Stap 5 - validate_crm_payment per invoice
-                    if line.ml_inv_ref:
-                        LOGGER.info("invoice %s status: %s" % (line.ml_inv_ref.number, line.ml_inv_ref.state))
-                        if line.ml_inv_ref.state == 'open':
-                            # Stap 5 - validate_crm_payment, per invoice!
-                            # Doet ook Stap 6, add booking to sdd_move_id
-                            inv = self.pool.get('account.invoice').validate_crm_payment(cr, uid, [line.ml_inv_ref.id], order, context=context)
-                        else:
-                            LOGGER.info('Invoice %s is already paid' % (line.ml_inv_ref.number,))
-                        line_nbr -= 1
-                        # Stap 7 -- *commit* to database so we can restart in case of errors
-                        line_obj.write(cr, uid, line.id, {'sdd_state': '3-done'})
-                        cr.commit()
-
-                        LOGGER.info('Direct Debit Order %s invoice preocessed : %s' % (order.id, line.ml_inv_ref.number))
-                    LOGGER.info('Direct Debit Order %s lines left to process : %s' % (order.id, line_nbr))
-                except BaseException as e:
-                    # Confirm error for this line and mark it as failed
-                    cr.rollback()
-                    try:
-                        # Update the error directly in the database.
-                        # We cannot use the normal Odoo ways because we raised an error.
-                        cr.execute("""UPDATE payment_line SET sdd_state = '1-fail' where id =%s""", (line.id,))
-                        cr.commit()
-                    except psycopg2.Error as sql_err:
-                        # If we get an error here that's more fatal then normal, bailing out
-                        cr.rollback()
-                        raise osv.except_osv(_("ORM bypass error"), sql_err.pgerror)
-                    confirm_errors.append(e)
 
+            # Stap 5, 6 en 7, per chunk of lines with a checkpoint
+            confirm_errors = self._confirm_payment_lines(
+                cr, uid, order, context=context)
+            # ml_inv_ref can't be searched, count the lines without an
+            # invoice or not confirmed on freshly browsed lines
+            line_nbr = len([
+                line for line in line_obj.browse(
+                    cr, uid, [line.id for line in order.line_ids],
+                    context=context)
+                if not line.ml_inv_ref or line.sdd_state != '3-done'])
+
+            LOGGER.info('Direct Debit Order %s: %s lines confirmed, %s failed, %s left',
+                        order.id, len(order.line_ids) - line_nbr, len(confirm_errors), line_nbr)
             if line_nbr >= 1 or confirm_errors:
                 error_txt = ""
                 for exception in confirm_errors:
@@ -610,17 +1414,17 @@ class banking_export_sdd_wizard(orm.TransientModel):
                     invoice_ids.append(lines.ml_inv_ref.id)
 
             # After the validated invoices, create two new bookings to the incasso debit account and journal
-            LOGGER.info("Creating move for first amount: %s" % (amount_first,))
+            LOGGER.info("Creating move for first amount: %s", amount_first)
             if amount_first > 0.0:
                 debit_move_first = self.create_debit_move(cr, uid, order, amount_first, "FRST", context=context)
-                LOGGER.info("move voor first %s" % (debit_move_first,))
+                LOGGER.info("move voor first %s", debit_move_first)
                 result = self.createreconcile(cr, uid, order, debit_move_first, sdd_move_id, old_mandate_info, type="FRST", context=context)
                 self.pool.get('payment.order').write(cr, uid, order.id, {'first_move_id': debit_move_first}, context=context)
 
-            LOGGER.info("Creating move for recurring amount: %s" % (amount_rcur,))
+            LOGGER.info("Creating move for recurring amount: %s", amount_rcur)
             if amount_rcur > 0.0:
                 debit_move_rcur = self.create_debit_move(cr, uid, order, amount_rcur, "RCUR", context=context)
-                LOGGER.info("move voor rcur %s" % (debit_move_rcur,))
+                LOGGER.info("move voor rcur %s", debit_move_rcur)
                 result = self.createreconcile(cr, uid, order, debit_move_rcur, sdd_move_id, old_mandate_info, type="RCUR", context=context)
                 self.pool.get('payment.order').write(cr, uid, order.id, {'rcur_move_id': debit_move_rcur}, context=context)
 
@@ -630,7 +1434,7 @@ class banking_export_sdd_wizard(orm.TransientModel):
             for line in order.line_ids:
                 move_ids.append(line.move_line_id.move_id.id)
             invoice_ids = self.pool.get('account.invoice').search(cr, uid, [('move_id','in',move_ids)])
-            print "invoice_ids:",invoice_ids
+            LOGGER.debug('Setting sdd_payment_sent on invoices %s', invoice_ids)
             self.pool.get('account.invoice').write(cr, uid, invoice_ids, {'sdd_payment_sent':True})
 
             self.pool['sdd.mandate'].write(cr, uid, to_expire_ids, {'state': 'expired'}, context=context)
@@ -644,13 +1448,120 @@ class banking_export_sdd_wizard(orm.TransientModel):
                 context=context)
             wf_service.trg_validate(uid, 'payment.order', order.id, 'done', cr)
 
-            LOGGER.info('Direct Debit Order %s processed' % (order.id,))
+            LOGGER.info('Direct Debit Order %s processed', order.id)
 
 
         # raise "Ik wil nog neit committen error :)"
 
         return {'type': 'ir.actions.act_window_close'}
 
+    def _get_confirm_chunk_size(self, cr, uid, context=None):
+        """ Number of payment lines confirmed per commit by save_sepa """
+        icp_obj = self.pool['ir.config_parameter']
+        try:
+            chunk_size = int(icp_obj.get_param(
+                cr, SUPERUSER_ID,
+                'sp_account_banking_sepa_direct_debit.confirm_chunk_size',
+                200))
+        except ValueError:
+            chunk_size = 200
+        return max(chunk_size, 1)
+
+    def _confirm_payment_lines(self, cr, uid, order, context=None):
+        """ Stap 5, 6 and 7 of save_sepa: validate_crm_payment for the
+        invoices of the lines of order that are not confirmed yet.
+
+        The lines are confirmed by chunks with one commit per chunk. A
+        confirmed line is in sdd_state 3-done and the order keeps the id of
+        the last line of the last chunk committed, so a new run starts after
+        it, retrying only the lines that failed before. The lines of a chunk
+        that fails are confirmed one by one.
+
+        :return: list of the errors of the lines that failed
+        """
+        line_obj = self.pool['payment.line']
+        order_obj = self.pool['payment.order']
+        chunk_size = self._get_confirm_chunk_size(cr, uid, context=context)
+        checkpoint = order.sdd_checkpoint_line_id
+        # ml_inv_ref is a function field without fnct_search, so the lines
+        # without an invoice are left out here rather than in the domain
+        line_ids = [line.id for line in line_obj.browse(
+            cr, uid, line_obj.search(cr, uid, [
+                ('order_id', '=', order.id),
+                ('sdd_state', '!=', '3-done'),
+                '|', ('id', '>', checkpoint), ('sdd_state', '=', '1-fail'),
+            ], order='id', context=context), context=context)
+            if line.ml_inv_ref]
+        if checkpoint:
+            LOGGER.info('Direct Debit Order %s: resuming after line %s, %s '
+                        'lines to confirm', order.id, checkpoint,
+                        len(line_ids))
+
+        confirm_errors = []
+        for index in xrange(0, len(line_ids), chunk_size):
+            chunk_ids = line_ids[index:index + chunk_size]
+            lines = line_obj.browse(cr, uid, chunk_ids, context=context)
+            try:
+                self.pool.get('account.invoice').validate_crm_payment(
+                    cr, uid, [line.ml_inv_ref.id for line in lines
+                              if line.ml_inv_ref.state == 'open'],
+                    order, context=context)
+                line_obj.write(cr, uid, chunk_ids, {'sdd_state': '3-done'})
+            except BaseException:
+                cr.rollback()
+                LOGGER.warning('Direct Debit Order %s: chunk of lines %s to '
+                               '%s failed, confirming its lines one by one',
+                               order.id, chunk_ids[0], chunk_ids[-1],
+                               exc_info=True)
+                confirm_errors.extend(self._confirm_payment_lines_one_by_one(
+                    cr, uid, order, lines, context=context))
+            # Stap 7 -- *commit* to database so we can restart in case of errors
+            order_obj.write(
+                cr, uid, order.id,
+                {'sdd_checkpoint_line_id': max(checkpoint, chunk_ids[-1])},
+                context=context)
+            cr.commit()
+            LOGGER.debug('Direct Debit Order %s lines left to process: %s',
+                         order.id, len(line_ids) - index - len(chunk_ids))
+        return confirm_errors
+
+    def _confirm_payment_lines_one_by_one(self, cr, uid, order, lines,
+                                          context=None):
+        """ Confirm the payment lines with a commit per line, marking the
+        ones that fail
+
+        :return: list of the errors of the lines that failed
+        """
+        line_obj = self.pool['payment.line']
+        confirm_errors = []
+        for line in lines:
+            try:
+                LOGGER.debug("invoice %s status: %s", line.ml_inv_ref.number, line.ml_inv_ref.state)
+                if line.ml_inv_ref.state == 'open':
+                    # Stap 5 - validate_crm_payment, per invoice!
+                    # Doet ook Stap 6, add booking to sdd_move_id
+                    self.pool.get('account.invoice').validate_crm_payment(cr, uid, [line.ml_inv_ref.id], order, context=context)
+                else:
+                    LOGGER.debug('Invoice %s is already paid', line.ml_inv_ref.number)
+                line_obj.write(cr, uid, line.id, {'sdd_state': '3-done'})
+                cr.commit()
+
+                LOGGER.debug('Direct Debit Order %s invoice processed: %s', order.id, line.ml_inv_ref.number)
+            except BaseException as e:
+                # Confirm error for this line and mark it as failed
+                cr.rollback()
+                try:
+                    # Update the error directly in the database.
+                    # We cannot use the normal Odoo ways because we raised an error.
+                    cr.execute("""UPDATE payment_line SET sdd_state = '1-fail' where id =%s""", (line.id,))
+                    cr.commit()
+                except psycopg2.Error as sql_err:
+                    # If we get an error here that's more fatal then normal, bailing out
+                    cr.rollback()
+                    raise osv.except_osv(_("ORM bypass error"), sql_err.pgerror)
+                confirm_errors.append(e)
+        return confirm_errors
+
     def _create_batch_booking(self, cr, uid, order, context=None):
         move_pool = self.pool.get('account.move')
         local_ctx = dict(context or {}, account_period_prefer_normal=True)
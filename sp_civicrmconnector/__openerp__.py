@@ -15,7 +15,8 @@ Connector to connect Odoo with CiviCRM
      'view/product.xml',
      'view/paymentterm.xml',
      'view/backend_model_view.xml',
-     'view/partnerextend.xml'],
+     'view/partnerextend.xml',
+     'data/civicrm_cron.xml'],
  'installable': True,
  'application': False,
  }
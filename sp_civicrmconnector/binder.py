@@ -3,10 +3,82 @@ from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.addons.connector.connector import Binder
 from backend import civicrm
 
+# number of bindings written per UPDATE statement by bind_many, and of
+# external IDs resolved per query by to_openerp_many
+BIND_MANY_CHUNK_SIZE = 1000
+
+
+def create_binding_index(cr, table):
+    """ Create the (backend_id, civicrm_id) index on a bound table used by
+    the binder lookups, when it doesn't exist yet. To call from _auto_init.
+    """
+    index_name = '%s_backend_civicrm_id_index' % table
+    cr.execute("SELECT 1 FROM pg_indexes WHERE indexname = %s",
+                (index_name,))
+    if not cr.fetchone():
+        cr.execute('CREATE INDEX "%s" ON "%s" (backend_id, civicrm_id)'
+                   % (index_name, table))
+
 
 @civicrm
 class CivicrmBinder(Binder):
     _model_name = ['res.partner.position', 'account.invoice']
+
+    def __init__(self, environment):
+        super(CivicrmBinder, self).__init__(environment)
+        # external ID -> binding ID, only kept once use_memo() is called
+        self._memo = None
+
+    def use_memo(self, enabled=True):
+        """ Remember the external IDs resolved and bound by this binder, so a
+        job looking up the same IDs again doesn't query them twice.
+        """
+        self._memo = {} if enabled else None
+
+    def _backend_domain(self):
+        """ Domain restricting the bindings to the backend of the
+        environment
+        """
+        return [('backend_id', '=', self.backend_record.id)]
+
+    def _backend_clause(self):
+        """ SQL condition and parameters restricting the bindings to the
+        backend of the environment, same as _backend_domain()
+        """
+        return 'backend_id = %s', [self.backend_record.id]
+
+    def to_openerp_many(self, external_ids):
+        """ Give the OpenERP IDs of many external IDs at once
+
+        :param external_ids: external IDs for which we want the OpenERP IDs
+        :return: dict external ID -> binding ID, the external IDs not
+                 mapped are not in the dict
+        :rtype: dict
+        """
+        external_ids = set(int(external_id) for external_id in external_ids)
+        result = {}
+        if self._memo is not None:
+            for external_id in external_ids:
+                if external_id in self._memo:
+                    result[external_id] = self._memo[external_id]
+            external_ids.difference_update(result)
+        external_ids = sorted(external_ids)
+        clause, params = self._backend_clause()
+        cr = self.session.cr
+        for start in xrange(0, len(external_ids), BIND_MANY_CHUNK_SIZE):
+            chunk = external_ids[start:start + BIND_MANY_CHUNK_SIZE]
+            cr.execute('SELECT civicrm_id, id FROM "%s" '
+                       'WHERE %s AND civicrm_id IN %%s'
+                       % (self.model._table, clause),
+                       params + [tuple(chunk)])
+            for external_id, binding_id in cr.fetchall():
+                assert external_id not in result, (
+                    "Several records found for %s" % external_id)
+                result[external_id] = binding_id
+        if self._memo is not None:
+            self._memo.update(result)
+        return result
+
     # To openerp nog niet getest en/f nodig gehad.
     def to_openerp(self, external_id, unwrap=False):
         """ Give the OpenERP ID for an external ID
@@ -18,10 +90,12 @@ class CivicrmBinder(Binder):
                  or None if the external_id is not mapped
         :rtype: int
         """
+        if (not unwrap and self._memo is not None and
+                int(external_id) in self._memo):
+            return self._memo[int(external_id)]
         binding_ids = self.session.search(
             self.model._name,
-            [('civicrm_id', '=', external_id),
-             ('backend_id', '=', self.backend_record.id)])
+            [('civicrm_id', '=', external_id)] + self._backend_domain())
         if not binding_ids:
             return None
         assert len(binding_ids) == 1, "Several records found: %s" % binding_ids
@@ -65,3 +139,52 @@ class CivicrmBinder(Binder):
             {'civicrm_id': external_id,
              'sync_date': now_fmt},
             context=context)
+        if self._memo is not None:
+            self._memo[int(external_id)] = binding_id
+
+    def bind_many(self, bindings):
+        """ Create the links between many external IDs and OpenERP IDs and
+        update their last synchronization date, in a few set-based UPDATE
+        statements.
+
+        The columns are written in SQL, bypassing the ORM, so like with
+        ``connector_no_export`` in bind() no export is triggered.
+
+        :param bindings: list of (external_id, binding_id) tuples
+        """
+        if not bindings:
+            return
+        cr = self.session.cr
+        now_fmt = datetime.now().strftime(DEFAULT_SERVER_DATETIME_FORMAT)
+        for start in xrange(0, len(bindings), BIND_MANY_CHUNK_SIZE):
+            chunk = bindings[start:start + BIND_MANY_CHUNK_SIZE]
+            values = ','.join(
+                cr.mogrify('(%s, %s)', (int(binding_id), int(external_id)))
+                for external_id, binding_id in chunk)
+            cr.execute(
+                'UPDATE "%s" AS binding '
+                'SET civicrm_id = v.civicrm_id, sync_date = %%s, '
+                "write_uid = %%s, write_date = now() at time zone 'UTC' "
+                'FROM (VALUES %s) AS v(id, civicrm_id) '
+                'WHERE binding.id = v.id' % (self.model._table, values),
+                (now_fmt, self.session.uid))
+        if self._memo is not None:
+            self._memo.update((int(external_id), binding_id)
+                              for external_id, binding_id in bindings)
+
+
+@civicrm
+class CivicrmPartnerBinder(CivicrmBinder):
+    """ Binder of res.partner. Partners have no backend_id, their civicrm_id
+    is unique over all the backends.
+
+    The civicrm_id of a partner is written when it is created by the
+    contact import, partners have no sync_date so bind() is not used.
+    """
+    _model_name = ['res.partner']
+
+    def _backend_domain(self):
+        return []
+
+    def _backend_clause(self):
+        return 'TRUE', []
@@ -13,14 +13,41 @@ from openerp.addons.connector.connector import Binder
 from datetime import datetime
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.addons.connector.queue.job import job
+from openerp.addons.connector.exception import RetryableJobError
 from binder import CivicrmBinder
 
-from civicrm import Civicrm
+from civicrm import Civicrm, get_civicrm, get_lookup_cache
 from pythoncivicrm import *
 import time
 import pprint
+import functools
+
+
+def retry_when_unavailable(func):
+    """ Postpone the decorated job while CiviCRM is unavailable
+
+    Place it below ``@job``. A call refused by the circuit breaker of the
+    CiviCRM client is turned into a RetryableJobError, so the job is
+    retried later instead of failing.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except CivicrmUnavailable as err:
+            raise RetryableJobError(unicode(err))
+    return wrapper
+
 
 class CiviCRMExportSynchronizer(ExportSynchronizer):
+    def _civicrm(self, backend):
+        """ Shared CiviCRM client of this worker for ``backend`` """
+        return get_civicrm(backend)
+
+    def _lookup(self, backend):
+        """ Shared LookupCache of this worker for ``backend`` """
+        return get_lookup_cache(backend)
+
     def _makecivitime(self, importTime):
         date_obj = time.strptime(importTime, "%Y-%m-%d")
         civitime = time.strftime("%Y%m%d000000", date_obj )
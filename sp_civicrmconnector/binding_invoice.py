@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 from openerp.osv import fields, orm
+from openerp import sql_db
 from openerp.addons.connector.event import on_record_write
 from openerp.addons.connector.event import on_record_create
 from openerp.addons.connector.event import on_record_unlink
@@ -13,12 +14,16 @@ from openerp.addons.connector.connector import Binder
 from datetime import datetime
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.addons.connector.queue.job import job
-from binder import CivicrmBinder
-from binding import CiviCRMExportSynchronizer
+from openerp.addons.connector.queue.job import OpenERPJobStorage
+from openerp.addons.connector.queue.job import PENDING, ENQUEUED
+from openerp.addons.connector.exception import RetryableJobError
+from binder import CivicrmBinder, create_binding_index
+from binding import CiviCRMExportSynchronizer, retry_when_unavailable
 
 from civicrm import Civicrm
 from pythoncivicrm import *
 import pprint
+import psycopg2
 
 class civicrm_acount_invoice(orm.Model):
     _inherit = 'account.invoice'
@@ -27,6 +32,10 @@ class civicrm_acount_invoice(orm.Model):
         'civicrm_id': fields.integer('ID on Civicrm'),
         'sync_date': fields.datetime('Last synchronization date'),
         'betalingsregeling': fields.boolean('Betalingsregeling op deze factuur'),
+        'civicrm_pending': fields.boolean(
+            'Civicrm export pending', readonly=True, select=True,
+            help="The state of the invoice changed and is not exported "
+                 "to its Civicrm contribution yet."),
     }
 
     def _get_backend(self, cr, uid, context=None):
@@ -40,66 +49,252 @@ class civicrm_acount_invoice(orm.Model):
         'backend_id': _get_backend,
     }
 
+    def _auto_init(self, cr, context=None):
+        res = super(civicrm_acount_invoice, self)._auto_init(cr, context=context)
+        create_binding_index(cr, self._table)
+        return res
+
+    def copy_data(self, cr, uid, id, default=None, context=None):
+        default = dict(default or {}, civicrm_pending=False)
+        return super(civicrm_acount_invoice, self).copy_data(
+            cr, uid, id, default=default, context=context)
+
+# Civicrm contribution_status_id of the exported invoice states
+CONTRIBUTION_STATUS = {
+    'open': 2,  # Pending
+    'paid': 1,  # Completed
+    'cancel': 3,  # Cancelled
+}
+# Seconds the state changes of invoices are collected before they are
+# exported together by export_account_invoice_batch
+CONTRIBUTION_EXPORT_DELAY = 60
+# Number of invoices exported per export_account_invoice_chunk job
+CONTRIBUTION_EXPORT_CHUNK = 200
+# Keys of the advisory locks of the contribution export, per backend
+CONTRIBUTION_FLUSH_LOCK = 73101
+CONTRIBUTION_EXPORT_LOCK = 73102
+
+def _delay_export_contribution(session, model_name, record_id):
+    """ Mark the invoice to be exported and make sure an
+    export_account_invoice_batch job is waiting for its backend.
+
+    Nothing happens when the backend doesn't export contributions.
+    """
+    invoice = session.browse(model_name, record_id)
+    backend = invoice.backend_id
+    if not backend or not backend.export_contributions:
+        return
+    # in SQL, an invoicing run changes the state of many invoices at once
+    session.cr.execute("UPDATE account_invoice SET civicrm_pending = TRUE "
+                       "WHERE id = %s", (record_id,))
+    session.cr.execute("SELECT job_uuid FROM civicrm_contribution_job "
+                       "WHERE backend_id = %s", (backend.id,))
+    row = session.cr.fetchone()
+    if row and row[0]:
+        storage = OpenERPJobStorage(session)
+        if (storage.exists(row[0]) and
+                storage.load(row[0]).state in (PENDING, ENQUEUED)):
+            return
+    job_uuid = export_account_invoice_batch.delay(
+        session, model_name, backend.id, eta=CONTRIBUTION_EXPORT_DELAY)
+    _set_contribution_job(session.cr.dbname, backend.id, job_uuid)
+
+def _set_contribution_job(dbname, backend_id, job_uuid):
+    """ Store the uuid of the export_account_invoice_batch job of the
+    backend, in a short transaction of its own.
+
+    When the transaction that delayed the job is rolled back, the uuid
+    points to a job that doesn't exist and the next state change just
+    delays a new one.
+    """
+    cr = sql_db.db_connect(dbname).cursor()
+    try:
+        cr.execute("UPDATE civicrm_contribution_job SET job_uuid = %s "
+                   "WHERE backend_id = %s", (job_uuid, backend_id))
+        if not cr.rowcount:
+            cr.execute("INSERT INTO civicrm_contribution_job "
+                       "(backend_id, job_uuid) VALUES (%s, %s)",
+                       (backend_id, job_uuid))
+        cr.commit()
+    except psycopg2.IntegrityError:
+        # inserted at the same time for another invoice, its job will do
+        cr.rollback()
+    finally:
+        cr.close()
+
 @on_record_write(model_names=['account.invoice'])
 def delay_export_account_invoice_write(session, model_name, record_id, vals):
-    print "In delay_export_account_invoice_write"
-    print "session", session
-    print "model_name", model_name
-    print "record_id", record_id
-    print "fields", vals
+    """ Export the new state of the invoice to its civicrm contribution """
+    if session.context.get('connector_no_export'):
+        return
     if 'state' in vals:
-        # We are editing state
-        export_account_invoice_write.delay(session, model_name, record_id, vals)
+        _delay_export_contribution(session, model_name, record_id)
+
+@on_record_create(model_names=['account.invoice'])
+def delay_export_account_invoice_create(session, model_name, record_id, vals):
+    """ Export the invoice to a new civicrm contribution """
+    if session.context.get('connector_no_export'):
+        return
+    if vals.get('state') in CONTRIBUTION_STATUS:
+        _delay_export_contribution(session, model_name, record_id)
 
 @job
-def export_account_invoice_write(session, model_name, record_id, vals):
-    print "in export_account_invoice_write"
+@retry_when_unavailable
+def export_account_invoice_batch(session, model_name, backend_id):
+    """ Export the pending invoices of the backend to civicrm, with one
+    export_account_invoice_chunk job per CONTRIBUTION_EXPORT_CHUNK invoices.
+    """
+    cr = session.cr
+    cr.execute("SELECT pg_try_advisory_xact_lock(%s, %s)",
+               (CONTRIBUTION_FLUSH_LOCK, backend_id))
+    if not cr.fetchone()[0]:
+        raise RetryableJobError('The invoices of the backend are '
+                                'already being collected')
+    cr.execute("UPDATE account_invoice SET civicrm_pending = FALSE "
+               "WHERE backend_id = %s AND civicrm_pending "
+               "RETURNING id", (backend_id,))
+    record_ids = sorted(row[0] for row in cr.fetchall())
+    for start in xrange(0, len(record_ids), CONTRIBUTION_EXPORT_CHUNK):
+        export_account_invoice_chunk.delay(
+            session, model_name, backend_id,
+            record_ids[start:start + CONTRIBUTION_EXPORT_CHUNK])
+    return '%d invoices in %d chunks' % (
+        len(record_ids),
+        (len(record_ids) + CONTRIBUTION_EXPORT_CHUNK - 1) // CONTRIBUTION_EXPORT_CHUNK)
+
+@job
+@retry_when_unavailable
+def export_account_invoice_chunk(session, model_name, backend_id, record_ids):
+    """ Export a chunk of invoices to their civicrm contributions """
+    env = get_environment(session, model_name, backend_id)
+    batch_exporter = env.get_connector_unit(CiviCRMContributionBatchExporter)
+    return batch_exporter.run(record_ids)
 
+# The jobs below are not enqueued anymore, they are kept for the jobs that
+# are still in the queue.
+
+@job
+@retry_when_unavailable
+def export_account_invoice_write(session, model_name, record_id, vals):
     account_invoice = session.browse(model_name, record_id)
     backend_id = account_invoice.backend_id.id
     env = get_environment(session, model_name, backend_id)
     account_invoice_updater = env.get_connector_unit(CiviCRMInvoiceUpdater)
     return account_invoice_updater.run(record_id, vals)
 
-@on_record_create(model_names=['account.invoice'])
-def delay_export_account_invoice_create(session, model_name, record_id, vals):
-    print "In delay_export_account_invoice_write"
-    print "session", session
-    print "model_name", model_name
-    print "record_id", record_id
-    print "fields", vals
-    if 'state' in vals:
-        # We are editing state
-        export_account_invoice_create.delay(session, model_name, record_id, vals)
-
 @job
+@retry_when_unavailable
 def export_account_invoice_create(session, model_name, record_id, vals):
-    print "in export_account_invoice_create"
-
     account_invoice = session.browse(model_name, record_id)
     backend_id = account_invoice.backend_id.id
     env = get_environment(session, model_name, backend_id)
-    partner_location_exporter = env.get_connector_unit(CiviCRMInvoiceCreator)
-    return partner_location_exporter.run(record_id, vals)
+    account_invoice_creator = env.get_connector_unit(CiviCRMInvoiceCreator)
+    return account_invoice_creator.run(record_id, vals)
+
+
+class CiviCRMContributionExporter(CiviCRMExportSynchronizer):
+    """ Shared code of the exports of invoices to civicrm contributions """
+
+    def _contribution_params(self, invoice, status):
+        """ Parameters of the new civicrm Contribution of invoice """
+        if not invoice.partner_id.civicrm_id:
+            raise ValueError('The contact %s (%s) has no civicrm_id' % (invoice.partner_id.name, invoice.partner_id))
+        financial_type_ids = [line.product_id.financial_type_id
+                              for line in invoice.invoice_line
+                              if line.product_id.financial_type_id]
+        if not financial_type_ids:
+            raise ValueError('The invoice %s has no product with a financial type' % invoice.id)
+        params = {
+            'contact_id': invoice.partner_id.civicrm_id,
+            'financial_type_id': financial_type_ids[0],
+            'total_amount': invoice.amount_total,
+            'currency': invoice.currency_id.name,
+            'contribution_status_id': status,
+        }
+        if invoice.date_invoice:
+            params['receive_date'] = self._makecivitime(invoice.date_invoice)
+        if invoice.number:
+            params['invoice_id'] = invoice.number
+        if invoice.payment_term and invoice.payment_term.instrument_id:
+            params['payment_instrument_id'] = invoice.payment_term.instrument_id
+        return params
+
+    def _export(self, binding_ids):
+        """ Create or update the contributions of the invoices ``binding_ids``
+        with their current state, with batched API calls.
+
+        Invoices that can not be exported are marked pending again and
+        reported in the result, the others are still exported and bound.
+        """
+        sess = self.session
+        backend = self.backend_record
+        if not backend.export_contributions:
+            return 'The backend does not export contributions'
+        # one export at a time per backend, so a contribution is never
+        # created twice by exports running side by side
+        sess.cr.execute("SELECT pg_advisory_xact_lock(%s, %s)",
+                        (CONTRIBUTION_EXPORT_LOCK, backend.id))
+        civicrmconnector = self._civicrm(backend)
+        errors = []
 
+        batch = civicrmconnector.batch()
+        queued = []
+        for invoice in sess.browse(self.model._name, binding_ids):
+            status = CONTRIBUTION_STATUS.get(invoice.state)
+            if status is None:
+                continue
+            if invoice.civicrm_id:
+                batch.update('Contribution', invoice.civicrm_id,
+                             contribution_status_id=status)
+            else:
+                try:
+                    params = self._contribution_params(invoice, status)
+                except ValueError as err:
+                    errors.append((invoice.id, err))
+                    continue
+                batch.create('Contribution', **params)
+            queued.append(invoice.id)
+
+        bindings = []
+        for binding_id, result in zip(queued, batch.execute()):
+            if isinstance(result, CivicrmError):
+                errors.append((binding_id, result))
+                continue
+            bindings.append((result[0]['id'], binding_id))
+        self.binder.bind_many(bindings)
+
+        message = '%d invoices exported' % len(bindings)
+        if errors:
+            sess.cr.execute("UPDATE account_invoice SET civicrm_pending = TRUE "
+                            "WHERE id IN %s",
+                            (tuple(binding_id for binding_id, err in errors),))
+            message += ', %d failed:\n%s' % (len(errors), '\n'.join(
+                '%s: %s' % (binding_id, err) for binding_id, err in errors))
+        return message
+
+
+@civicrm
+class CiviCRMContributionBatchExporter(CiviCRMContributionExporter):
+    """ Export many invoices to civicrm contributions at once """
+    _model_name = ['account.invoice']
+
+    def run(self, binding_ids):
+        return self._export(binding_ids)
 
 
 @civicrm
-class CiviCRMInvoiceUpdater(CiviCRMExportSynchronizer):
-    """ Export partners to civicrm """
+class CiviCRMInvoiceUpdater(CiviCRMContributionExporter):
+    """ Export the state of an invoice to its civicrm contribution """
     _model_name = ['account.invoice']
 
     def run(self, binding_id, vals):
-        print "We are in run", binding_id
-        print "en vals", vals
-        pass
+        return self._export([binding_id])
+
 
 @civicrm
-class CiviCRMInvoiceCreator(CiviCRMExportSynchronizer):
-    """ Export partners to civicrm """
+class CiviCRMInvoiceCreator(CiviCRMContributionExporter):
+    """ Export an invoice to a civicrm contribution """
     _model_name = ['account.invoice']
 
     def run(self, binding_id, vals):
-        print "We are in run", binding_id
-        print "en vals", vals
-        pass
+        return self._export([binding_id])
@@ -8,15 +8,18 @@ from openerp.addons.connector.event import on_record_unlink
 from connector import get_environment
 from openerp.addons.connector.connector import ConnectorUnit
 from openerp.addons.connector.unit.synchronizer import ExportSynchronizer
+from openerp.addons.connector.unit.synchronizer import ImportSynchronizer
 from backend import civicrm
 from openerp.addons.connector.connector import Binder
 from datetime import datetime
 from openerp.tools import DEFAULT_SERVER_DATETIME_FORMAT
 from openerp.addons.connector.queue.job import job
-from binder import CivicrmBinder
-from binding import CiviCRMExportSynchronizer
+from openerp.addons.connector.queue.job import OpenERPJobStorage
+from openerp.addons.connector.queue.job import PENDING, ENQUEUED
+from binder import CivicrmBinder, create_binding_index
+from binding import CiviCRMExportSynchronizer, retry_when_unavailable
 
-from civicrm import Civicrm
+from civicrm import Civicrm, get_civicrm
 from pythoncivicrm import *
 import time
 import pprint
@@ -55,6 +58,8 @@ class civicrm_res_partner_position(orm.Model):
         'backend_id': fields.many2one('civicrm.backend', 'Civicrm Backend', ondelete='restrict'),
         'civicrm_id': fields.integer('ID on Civicrm'),
         'sync_date': fields.datetime('Last synchronization date'),
+        'civicrm_write_job_uuid': fields.char(
+            'UUID of the Job exporting the last changes', readonly=True),
     }
 
     def _get_backend(self, cr, uid, context=None):
@@ -68,6 +73,16 @@ class civicrm_res_partner_position(orm.Model):
         'backend_id': _get_backend,
     }
 
+    def _auto_init(self, cr, context=None):
+        res = super(civicrm_res_partner_position, self)._auto_init(cr, context=context)
+        create_binding_index(cr, self._table)
+        return res
+
+    def copy_data(self, cr, uid, id, default=None, context=None):
+        default = dict(default or {}, civicrm_write_job_uuid=False)
+        return super(civicrm_res_partner_position, self).copy_data(
+            cr, uid, id, default=default, context=context)
+
 
 class res_partner_position_appointment(orm.Model):
     _inherit = 'res.partner.position.appointment'
@@ -117,10 +132,16 @@ class res_partner_position_appointment(orm.Model):
 def delay_export_res_partner_location(session, model_name, record_id, fields=None):
     """
     Delay the job to export the delay_export_res_partner_location.
+
+    Bulk imports create the positions with ``connector_no_export`` and
+    export them afterwards with export_res_partner_position_batch.
     """
+    if session.context.get('connector_no_export'):
+        return
     export_res_partner_position.delay(session, model_name, record_id)
 
 @job
+@retry_when_unavailable
 def export_res_partner_position(session, model_name, record_id):
     """ Export a new partner position to civicrm """
     if session.context.get('connector_no_export'):
@@ -132,11 +153,67 @@ def export_res_partner_position(session, model_name, record_id):
     partner_location_exporter = env.get_connector_unit(CiviCRMLocationSynchronizer)
     return partner_location_exporter.run(record_id)
 
+@job
+@retry_when_unavailable
+def export_res_partner_position_batch(session, model_name, backend_id, domain, chunk_size=200):
+    """ Export the positions of the backend matching domain to civicrm,
+    with one export_res_partner_position_chunk job per chunk_size positions.
+    """
+    domain = [('backend_id', '=', backend_id)] + domain
+    record_ids = session.search(model_name, domain)
+    for start in xrange(0, len(record_ids), chunk_size):
+        export_res_partner_position_chunk.delay(
+            session, model_name, backend_id, record_ids[start:start + chunk_size])
+    return '%d positions in %d chunks' % (
+        len(record_ids), (len(record_ids) + chunk_size - 1) // chunk_size)
+
+@job
+@retry_when_unavailable
+def export_res_partner_position_chunk(session, model_name, backend_id, record_ids):
+    """ Export a chunk of new partner positions to civicrm """
+    env = get_environment(session, model_name, backend_id)
+    batch_exporter = env.get_connector_unit(CiviCRMLocationBatchExporter)
+    return batch_exporter.run(record_ids)
+
+# Fields of res.partner.position exported by CiviCRMLocationUpdater
+POSITION_EXPORT_FIELDS = ('start_date', 'stop_date')
+# Seconds a position write export waits, so later writes are coalesced in it
+POSITION_WRITE_DELAY = 10
+
 @on_record_write(model_names=['res.partner.position'])
 def delay_export_res_partner_location_write(session, model_name, record_id, vals):
-    export_res_partner_position_write.delay(session, model_name, record_id, vals)
+    """
+    Delay the job to export the changed dates of an exported position.
+
+    The job exports the values the position has when it runs, so while a
+    job is still waiting for a position no other one is enqueued: a burst
+    of writes results in a single update in civicrm.
+    """
+    if session.context.get('connector_no_export'):
+        return
+    if not set(vals).intersection(POSITION_EXPORT_FIELDS):
+        return
+    position = session.browse(model_name, record_id)
+    if not position.civicrm_id:
+        # the export of the new position will send the current dates
+        return
+    job_uuid = position.civicrm_write_job_uuid
+    if job_uuid:
+        storage = OpenERPJobStorage(session)
+        if (storage.exists(job_uuid) and
+                storage.load(job_uuid).state in (PENDING, ENQUEUED)):
+            return
+    export_vals = dict((field, vals[field]) for field in POSITION_EXPORT_FIELDS
+                       if field in vals)
+    job_uuid = export_res_partner_position_write.delay(
+        session, model_name, record_id, export_vals, eta=POSITION_WRITE_DELAY)
+    context = dict(session.context, connector_no_export=True)
+    session.pool[model_name].write(
+        session.cr, session.uid, [record_id],
+        {'civicrm_write_job_uuid': job_uuid}, context=context)
 
 @job
+@retry_when_unavailable
 def export_res_partner_position_write(session, model_name, record_id, vals):
     partner_position = session.browse(model_name, record_id)
     backend_id = partner_position.backend_id.id
@@ -150,66 +227,71 @@ class CiviCRMLocationUpdater(CiviCRMExportSynchronizer):
     """ Export partners to civicrm """
     _model_name = ['res.partner.position']
     def run(self, binding_id, vals):
-        """ Run the job to export the validated/paid invoice """
+        """ Export the dates of the position to its civicrm Relationship.
+
+        The current dates of the position are exported rather than the
+        ones in ``vals``, so one run covers all the writes done since the
+        job was enqueued.
+        """
         sess = self.session
         position = sess.browse(self.model._name, binding_id)
+        if not position.civicrm_id:
+            return
         backend = position.backend_id
-        civicrmconnector = CiviCRM(backend.url, backend.site_key, backend.api_key)
-
-        params = {}
-        for val in vals:
-            if val == 'start_date':
-                params['start_date'] = self._makecivitime(vals[val])
+        civicrmconnector = self._civicrm(backend)
 
-            elif val == 'stop_date':
-                params['end_date'] = self._makecivitime(vals[val])
+        # an empty date clears the date of the relationship in civicrm,
+        # e.g. to reopen it when the stop date was removed
+        params = {'start_date': '', 'end_date': ''}
+        if position.start_date:
+            params['start_date'] = self._makecivitime(position.start_date)
+        if position.stop_date:
+            params['end_date'] = self._makecivitime(position.stop_date)
 
-        if len(params) == 0:
-            return
         result = civicrmconnector.update('Relationship', db_id=position.civicrm_id, **params)
         self.binder.bind(result[0]['id'], binding_id)
 
 
-@civicrm
-class CiviCRMLocationSynchronizer(CiviCRMExportSynchronizer):
-    """ Export partners to civicrm """
-    _model_name = ['res.partner.position']
+class CiviCRMPositionExporter(CiviCRMExportSynchronizer):
+    """ Shared code of the exports of new positions to civicrm """
 
-    def run(self, binding_id):
-        """ Run the job to export the validated/paid invoice """
-        sess = self.session
-        position = sess.browse(self.model._name, binding_id)
+    def _civicrm_subtypes(self):
+        """ Contact subtypes of the organisations positions link to """
+        appointment_obj = self.session.pool['res.partner.position.appointment']
+        return set(item[2] for item in appointment_obj._civiCRMType)
 
-        backend = position.backend_id
-        civicrmconnector = CiviCRM(backend.url, backend.site_key, backend.api_key)
+    def _check_position(self, position):
+        """ Raise ValueError when the position can not be exported """
         # Civi ID zoeken:
         if position.partner_id.civicrm_id == 0:
             raise ValueError('The contact %s (%s) has no civicrm_id' % (position.partner_id.name,position.partner_id))
+        if not position.appointment_id.civicrm_relation and not position.appointment_id.location_type_id:
+            raise ValueError('The concact %s (%s) has no Location' % (position.partner_id.name, position.partner_id))
 
-        person = civicrmconnector.getsingle('Contact', id=position.partner_id.civicrm_id)
-
+    def _relationship_params(self, civicrmconnector, position, contact_id_a):
+        """ Parameters of the Relationship to create for ``position`` """
+        backend = position.backend_id
         if position.appointment_id.civicrm_relation:
             civicrm_relation = position.appointment_id.civicrm_relation
         else:
-            if not position.appointment_id.location_type_id:
-                raise ValueError('The concact %s (%s) has no Location' % (position.partner_id.name, position.partner_id))
+            prefix = position.appointment_id.getcivilocationprefix(position.appointment_id.civicrm_relationshiptype)
+            if prefix:
+                civicrm_relation = prefix + " " + position.location_id.name
             else:
-                prefix = position.appointment_id.getcivilocationprefix(position.appointment_id.civicrm_relationshiptype)
-                if prefix:
-                    civicrm_relation = prefix + " " + position.location_id.name
-                else:
-                    civicrm_relation = position.location_id.name
+                civicrm_relation = position.location_id.name
 
         subtype_b = position.appointment_id.getcivilocationtype(position.appointment_id.civicrm_relationshiptype)
         str_relation = str(civicrm_relation)
-        contact_b = civicrmconnector.getsingle('Contact', contact_sub_type=subtype_b, organization_name=str_relation)
+        lookup = self._lookup(backend)
+        subtypes = self._civicrm_subtypes()
+        contact_b = lookup.organisation(civicrmconnector, subtype_b, str_relation, subtypes)
 
         # Relationship id:
-        relationtype = civicrmconnector.getsingle('RelationshipType', name_a_b=position.appointment_id.civicrm_relationshiptype)
+        relationtype = lookup.relationship_type(civicrmconnector, position.appointment_id.civicrm_relationshiptype, subtypes)
 
         params = {
             'relationship_type_id': relationtype['id'],
-            'contact_id_a': person['id'],
+            'contact_id_a': contact_id_a,
             'contact_id_b': contact_b['id'],
         }
         if position.start_date:
@@ -217,8 +299,225 @@ class CiviCRMLocationSynchronizer(CiviCRMExportSynchronizer):
 
         if position.stop_date:
             params['stop_date'] = self._makecivitime(position.stop_date)
+        return params
+
+
+@civicrm
+class CiviCRMLocationSynchronizer(CiviCRMPositionExporter):
+    """ Export partners to civicrm """
+    _model_name = ['res.partner.position']
+
+    def run(self, binding_id):
+        """ Run the job to export the validated/paid invoice """
+        sess = self.session
+        position = sess.browse(self.model._name, binding_id)
+
+        backend = position.backend_id
+        civicrmconnector = self._civicrm(backend)
+        self._check_position(position)
+
+        person = civicrmconnector.getsingle('Contact', id=position.partner_id.civicrm_id)
+        params = self._relationship_params(civicrmconnector, position, person['id'])
 
         result = civicrmconnector.create('Relationship', **params)
 
         # use the ``binder`` to write the external ID
         self.binder.bind(result[0]['id'], binding_id)
+
+
+@civicrm
+class CiviCRMLocationBatchExporter(CiviCRMPositionExporter):
+    """ Export many new positions to civicrm at once """
+    _model_name = ['res.partner.position']
+
+    def _existing_contacts(self, civicrmconnector, contact_ids):
+        """ Return the subset of contact_ids that exist in civicrm """
+        contacts = civicrmconnector.get(
+            'Contact', limit=len(contact_ids),
+            **{'id[IN][]': contact_ids, 'return': 'id'})
+        return set(int(contact['id']) for contact in contacts)
+
+    def run(self, binding_ids):
+        """ Export the positions ``binding_ids`` of the backend, that are not
+        exported yet, with batched API calls.
+
+        Positions that can not be exported are skipped and reported in the
+        result, the others are still exported and bound.
+        """
+        sess = self.session
+        backend = self.backend_record
+        civicrmconnector = self._civicrm(backend)
+        positions = [position for position
+                     in sess.browse(self.model._name, binding_ids)
+                     if not position.civicrm_id]
+        errors = []
+
+        contact_ids = list(set(position.partner_id.civicrm_id
+                               for position in positions
+                               if position.partner_id.civicrm_id))
+        existing = set()
+        if contact_ids:
+            existing = self._existing_contacts(civicrmconnector, contact_ids)
+
+        batch = civicrmconnector.batch()
+        queued = []
+        for position in positions:
+            try:
+                self._check_position(position)
+                if position.partner_id.civicrm_id not in existing:
+                    raise ValueError('The contact %s (%s) does not exist in civicrm' % (position.partner_id.name, position.partner_id))
+                params = self._relationship_params(civicrmconnector, position, position.partner_id.civicrm_id)
+            except (ValueError, KeyError, CivicrmError) as err:
+                errors.append((position.id, err))
+                continue
+            batch.create('Relationship', **params)
+            queued.append(position.id)
+
+        bindings = []
+        for binding_id, result in zip(queued, batch.execute()):
+            if isinstance(result, CivicrmError):
+                errors.append((binding_id, result))
+                continue
+            bindings.append((result[0]['id'], binding_id))
+        self.binder.bind_many(bindings)
+
+        message = '%d positions exported' % len(bindings)
+        if errors:
+            message += ', %d failed:\n%s' % (len(errors), '\n'.join(
+                '%s: %s' % (binding_id, err) for binding_id, err in errors))
+        return message
+
+
+# Contact fields read by the contact import
+CONTACT_IMPORT_RETURN = ('id,contact_type,display_name,email,phone,'
+                         'street_address,postal_code,city,modified_date')
+# Number of contacts imported per import_civicrm_contact_chunk job
+CONTACT_IMPORT_CHUNK = 500
+# Contacts read per request by import_civicrm_contact_chunk, their ids are
+# passed in the URL
+CONTACT_FETCH_SIZE = 100
+
+@job
+@retry_when_unavailable
+def import_civicrm_contacts(session, model_name, backend_id):
+    """ Import the contacts changed in civicrm since the last import of the
+    backend, with one import_civicrm_contact_chunk job per
+    CONTACT_IMPORT_CHUNK contacts.
+
+    Only the ids of the contacts are read here and passed to the jobs, which
+    read the contacts themselves. The import starts from the latest
+    modified_date of the previous one. Contacts changed while the contacts
+    are read are imported again by the next import, none are missed.
+    """
+    backend = session.browse('civicrm.backend', backend_id)
+    civicrmconnector = get_civicrm(backend)
+    latest = civicrmconnector.get(
+        'Contact', **{'options[sort]': 'modified_date DESC',
+                      'options[limit]': 1, 'return': 'id,modified_date'})
+    if not latest:
+        return 'No contacts in civicrm'
+    high_water_mark = latest[0]['modified_date']
+
+    params = {'return': 'id'}
+    if backend.contacts_modified_since:
+        params['modified_date[>=]'] = backend.contacts_modified_since
+    count = chunks = 0
+    chunk = []
+    for contact in civicrmconnector.iter_get('Contact', page_size=CONTACT_IMPORT_CHUNK,
+                                             prefetch=True, **params):
+        chunk.append(int(contact['id']))
+        if len(chunk) == CONTACT_IMPORT_CHUNK:
+            import_civicrm_contact_chunk.delay(
+                session, model_name, backend_id, chunk, high_water_mark)
+            count += len(chunk)
+            chunks += 1
+            chunk = []
+    if chunk:
+        import_civicrm_contact_chunk.delay(
+            session, model_name, backend_id, chunk, high_water_mark)
+        count += len(chunk)
+        chunks += 1
+    session.write('civicrm.backend', [backend_id],
+                  {'contacts_modified_since': high_water_mark})
+    return '%d contacts in %d chunks, changed until %s' % (
+        count, chunks, high_water_mark)
+
+@job
+@retry_when_unavailable
+def import_civicrm_contact_chunk(session, model_name, backend_id, contact_ids,
+                                 high_water_mark):
+    """ Create or update the partners of a chunk of civicrm contacts """
+    env = get_environment(session, model_name, backend_id)
+    importer = env.get_connector_unit(CiviCRMContactImporter)
+    return importer.run(
+        importer.fetch_contacts(contact_ids, high_water_mark))
+
+
+@civicrm
+class CiviCRMContactImporter(ImportSynchronizer):
+    """ Create or update partners from civicrm contacts """
+    _model_name = ['res.partner']
+
+    def _map_contact(self, contact):
+        """ Values of the partner of a civicrm contact """
+        return {
+            'name': contact.get('display_name') or contact['id'],
+            'is_company': contact.get('contact_type') == 'Organization',
+            'email': contact.get('email') or False,
+            'phone': contact.get('phone') or False,
+            'street': contact.get('street_address') or False,
+            'zip': contact.get('postal_code') or False,
+            'city': contact.get('city') or False,
+        }
+
+    def fetch_contacts(self, contact_ids, high_water_mark):
+        """ Read the contacts contact_ids from civicrm.
+
+        The contacts changed after high_water_mark, the modified_date up to
+        which the import delaying the job read the contacts, are left out:
+        the next import starts from there and imports them.
+        """
+        civicrmconnector = get_civicrm(self.backend_record)
+        contacts = []
+        for start in xrange(0, len(contact_ids), CONTACT_FETCH_SIZE):
+            ids = contact_ids[start:start + CONTACT_FETCH_SIZE]
+            contacts.extend(civicrmconnector.get(
+                'Contact', limit=len(ids),
+                **{'id[IN][]': ids, 'modified_date[<=]': high_water_mark,
+                   'return': CONTACT_IMPORT_RETURN}))
+        return contacts
+
+    def run(self, contacts):
+        """ Create the partners of the contacts that are new and update the
+        others. The partners are looked up with one query and only the
+        changed ones are written.
+
+        :param contacts: civicrm Contact records, as returned by get
+        """
+        sess = self.session
+        context = dict(sess.context, connector_no_export=True)
+        partner_obj = sess.pool[self.model._name]
+        existing = self.binder.to_openerp_many(
+            contact['id'] for contact in contacts)
+        fields = self._map_contact(contacts[0]).keys() if contacts else []
+        current = dict((partner['id'], partner) for partner
+                       in sess.read(self.model._name, existing.values(), fields))
+
+        created = updated = 0
+        for contact in contacts:
+            vals = self._map_contact(contact)
+            partner_id = existing.get(int(contact['id']))
+            if partner_id is None:
+                vals['civicrm_id'] = int(contact['id'])
+                partner_obj.create(sess.cr, sess.uid, vals, context=context)
+                created += 1
+                continue
+            partner = current[partner_id]
+            changed = dict((field, value) for field, value in vals.iteritems()
+                           if partner[field] != value)
+            if changed:
+                partner_obj.write(sess.cr, sess.uid, [partner_id], changed,
+                                  context=context)
+                updated += 1
+        return '%d partners created, %d updated, %d unchanged' % (
+            created, updated, len(contacts) - created - updated)
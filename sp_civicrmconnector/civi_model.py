@@ -2,6 +2,8 @@ from openerp.osv import fields, orm
 
 from openerp.addons.connector.session import ConnectorSession
 
+from civicrm import invalidate_civicrm, civicrm_metrics
+
 
 class civicrm_backend(orm.Model):
     _name = 'civicrm.backend'
@@ -17,6 +19,14 @@ class civicrm_backend(orm.Model):
         """
         return [('7.0', '7.0')]
 
+    def _get_api_metrics(self, cr, uid, ids, name, arg, context=None):
+        res = {}
+        for backend_id in ids:
+            metrics = civicrm_metrics(cr.dbname, backend_id)
+            res[backend_id] = '\n'.join(
+                '%s: %s' % (key, metrics[key]) for key in sorted(metrics))
+        return res
+
     _columns = {
         'version': fields.selection(
             _select_versions,
@@ -27,7 +37,132 @@ class civicrm_backend(orm.Model):
         'password': fields.char('Password', required=False),
         'site_key': fields.char('Site api key', required=True),
         'api_key': fields.char('User api key', required=True),
+        'retries': fields.integer(
+            'Retries',
+            help="Number of times a CiviCRM call is retried when CiviCRM "
+                 "does not respond or answers with a server error."),
+        'breaker_threshold': fields.integer(
+            'Failures before pausing',
+            help="After this many failed calls in a row, calls to CiviCRM "
+                 "are stopped and the jobs are postponed."),
+        'breaker_reset': fields.integer(
+            'Pause (seconds)',
+            help="How long calls to CiviCRM are stopped after too many "
+                 "failures, before trying again."),
+        'rate_limit': fields.float(
+            'Requests per second',
+            help="Maximum average number of calls per second to CiviCRM. "
+                 "0 means no limit."),
+        'rate_burst': fields.integer(
+            'Burst',
+            help="Number of calls that may be made at once before the "
+                 "limit per second applies."),
+        'rate_limit_shared': fields.boolean(
+            'Limit shared by all servers',
+            help="Apply the limit to all server processes together, "
+                 "through the database, instead of to each process."),
+        'contacts_modified_since': fields.char(
+            'Import contacts changed since', size=19,
+            help="Latest modified_date of the contacts imported from "
+                 "CiviCRM, in the time of the CiviCRM server. The next "
+                 "import starts from there, empty imports all contacts."),
+        'export_contributions': fields.boolean(
+            'Export invoices as contributions',
+            help="Export the invoices and their state changes to "
+                 "contributions in CiviCRM."),
+        'api_metrics': fields.function(
+            _get_api_metrics, type='text', string='API metrics',
+            help="Request counters and state of this server process."),
     }
     _defaults = {
         'version': '7.0',
+        'retries': 3,
+        'breaker_threshold': 5,
+        'breaker_reset': 60,
+        'rate_limit': 0.0,
+        'rate_burst': 5,
+    }
+
+    def export_positions(self, cr, uid, ids, context=None):
+        """ Export all positions of the backends that are not exported yet,
+        in bulk.
+        """
+        from binding_partner import export_res_partner_position_batch
+        session = ConnectorSession(cr, uid, context=context)
+        domain = ['|', ('civicrm_id', '=', False), ('civicrm_id', '=', 0)]
+        for backend_id in ids:
+            export_res_partner_position_batch.delay(
+                session, 'res.partner.position', backend_id, domain)
+        return True
+
+    def import_contacts(self, cr, uid, ids, context=None):
+        """ Import the contacts changed in CiviCRM since the last import """
+        from binding_partner import import_civicrm_contacts
+        session = ConnectorSession(cr, uid, context=context)
+        for backend_id in ids:
+            import_civicrm_contacts.delay(session, 'res.partner', backend_id)
+        return True
+
+    def _scheduler_import_contacts(self, cr, uid, domain=None, context=None):
+        ids = self.search(cr, uid, domain or [], context=context)
+        return self.import_contacts(cr, uid, ids, context=context)
+
+    def write(self, cr, uid, ids, vals, context=None):
+        res = super(civicrm_backend, self).write(
+            cr, uid, ids, vals, context=context)
+        if set(vals) & set(['url', 'site_key', 'api_key', 'retries',
+                            'breaker_threshold', 'breaker_reset']):
+            if isinstance(ids, (int, long)):
+                ids = [ids]
+            invalidate_civicrm(cr.dbname, ids)
+        return res
+
+    def unlink(self, cr, uid, ids, context=None):
+        res = super(civicrm_backend, self).unlink(cr, uid, ids, context=context)
+        if isinstance(ids, (int, long)):
+            ids = [ids]
+        invalidate_civicrm(cr.dbname, ids)
+        return res
+
+
+class civicrm_rate_bucket(orm.Model):
+    """ Token bucket state of the rate limit of a backend, shared by the
+    server processes. Maintained by civicrm.DatabaseTokenBucket in raw SQL.
+    """
+    _name = 'civicrm.rate.bucket'
+    _description = 'civicrm Rate Limit Bucket'
+    _log_access = False
+    _rec_name = 'backend_id'
+
+    _columns = {
+        'backend_id': fields.many2one('civicrm.backend', 'Civicrm Backend',
+                                      required=True, ondelete='cascade'),
+        'tokens': fields.float('Tokens'),
+        'updated': fields.float('Updated (epoch)'),
+    }
+    _sql_constraints = [
+        ('backend_uniq', 'unique(backend_id)',
+         'There is one rate bucket per backend.')
+    ]
+
+
+class civicrm_contribution_job(orm.Model):
+    """ Job exporting the pending invoices of a backend. Maintained by
+    binding_invoice._delay_export_contribution in raw SQL, in transactions
+    of its own, so the users changing invoices don't write on the backend.
+    """
+    _name = 'civicrm.contribution.job'
+    _description = 'civicrm Contribution Export Job'
+    _log_access = False
+    _rec_name = 'backend_id'
+
+    _columns = {
+        'backend_id': fields.many2one('civicrm.backend', 'Civicrm Backend',
+                                      required=True, ondelete='cascade'),
+        'job_uuid': fields.char('UUID of the Job exporting the pending '
+                                'invoices'),
     }
+    _sql_constraints = [
+        ('backend_uniq', 'unique(backend_id)',
+         'There is one contribution export job per backend.')
+    ]
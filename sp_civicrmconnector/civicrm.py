@@ -1,7 +1,270 @@
 # -*- coding: utf-8 -*-
 
+import psycopg2
+import threading
+import time
+
+from openerp import sql_db
+
 from pythoncivicrm import *
 
 class Civicrm:
     pass
 
+
+# The registries below are per (database name, civicrm.backend id): a server
+# can serve several databases, whose backends have the same ids.
+# Long-lived CiviCRM clients of this worker process. Each entry is
+# (options, client), options being the _client_options() the client was
+# built with.
+_clients = {}
+# Circuit breakers, they outlive the clients so a configuration change
+# doesn't reset the state of a CiviCRM that is down.
+_breakers = {}
+# Rate limiters.
+_limiters = {}
+# LookupCaches.
+_lookups = {}
+_clients_lock = threading.Lock()
+
+
+def _registry_key(backend):
+    return (backend._cr.dbname, backend.id)
+
+
+def _client_options(backend):
+    return (backend.url, backend.site_key, backend.api_key,
+            backend.retries, backend.breaker_threshold, backend.breaker_reset)
+
+
+def _get_breaker(backend):
+    key = _registry_key(backend)
+    breaker = _breakers.get(key)
+    if breaker is None:
+        breaker = _breakers[key] = CircuitBreaker()
+    breaker.failure_threshold = backend.breaker_threshold
+    breaker.reset_timeout = backend.breaker_reset
+    return breaker
+
+
+class DatabaseTokenBucket:
+    """ Token bucket stored in the civicrm_rate_bucket table, shared by all
+    the server processes using the database. Same interface as
+    pythoncivicrm.TokenBucket.
+
+    Every acquire() uses a short transaction of its own, so it never waits
+    on the transaction of the job that makes the call.
+    """
+
+    def __init__(self, dbname, backend_id, rate, burst=1):
+        self.dbname = dbname
+        self.backend_id = backend_id
+        self.rate = rate
+        self.burst = burst
+
+    def _take(self, cr):
+        """ Take a token, return 0 or the seconds to wait for one """
+        cr.execute("SELECT extract(epoch FROM clock_timestamp())")
+        now = cr.fetchone()[0]
+        cr.execute("SELECT tokens, updated FROM civicrm_rate_bucket "
+                   "WHERE backend_id = %s FOR UPDATE", (self.backend_id,))
+        row = cr.fetchone()
+        if row is None:
+            tokens = float(self.burst)
+            cr.execute("INSERT INTO civicrm_rate_bucket "
+                       "(backend_id, tokens, updated) VALUES (%s, %s, %s)",
+                       (self.backend_id, tokens, now))
+        else:
+            tokens = min(float(self.burst),
+                         row[0] + (now - row[1]) * self.rate)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / self.rate
+        cr.execute("UPDATE civicrm_rate_bucket SET tokens = %s, updated = %s "
+                   "WHERE backend_id = %s", (tokens, now, self.backend_id))
+        return wait
+
+    def acquire(self):
+        while True:
+            cr = sql_db.db_connect(self.dbname).cursor()
+            try:
+                wait = self._take(cr)
+                cr.commit()
+            except psycopg2.IntegrityError:
+                # another process inserted the bucket of the backend at the
+                # same time, take the token from its row
+                cr.rollback()
+                continue
+            finally:
+                cr.close()
+            if not wait:
+                return
+            time.sleep(wait)
+
+
+def _get_limiter(backend):
+    """ Rate limiter configured on the backend, or None """
+    key = _registry_key(backend)
+    if not backend.rate_limit:
+        _limiters.pop(key, None)
+        return None
+    burst = max(backend.rate_burst, 1)
+    limiter = _limiters.get(key)
+    if backend.rate_limit_shared:
+        if not isinstance(limiter, DatabaseTokenBucket) or \
+                limiter.dbname != backend._cr.dbname or \
+                limiter.backend_id != backend.id:
+            limiter = DatabaseTokenBucket(backend._cr.dbname, backend.id,
+                                          backend.rate_limit, burst)
+    elif not isinstance(limiter, TokenBucket):
+        limiter = TokenBucket(backend.rate_limit, burst)
+    limiter.rate = backend.rate_limit
+    limiter.burst = burst
+    _limiters[key] = limiter
+    return limiter
+
+
+def get_civicrm(backend):
+    """ Return the shared CiviCRM client for a civicrm.backend record.
+
+    The client is created on first use and reused by every job of this
+    process afterwards. A new client is made when the url, keys or retry
+    settings of the backend no longer match the ones the cached client was
+    built with. The replaced client is not closed, as other threads may
+    still be using it: its connections are closed when it is garbage
+    collected.
+    """
+    key = _registry_key(backend)
+    options = _client_options(backend)
+    with _clients_lock:
+        cached = _clients.get(key)
+        limiter = _get_limiter(backend)
+        if cached is not None and cached[0] == options:
+            cached[1].rate_limiter = limiter
+            return cached[1]
+        client = CiviCRM(backend.url, backend.site_key, backend.api_key,
+                         retries=backend.retries,
+                         circuit_breaker=_get_breaker(backend),
+                         rate_limiter=limiter)
+        _clients[key] = (options, client)
+    return client
+
+
+def invalidate_civicrm(dbname, backend_ids=None):
+    """ Drop the cached clients and lookups of the given backend ids of the
+    database dbname, or all of them. The clients are left open for the
+    threads still using them, see get_civicrm.
+    """
+    with _clients_lock:
+        if backend_ids is None:
+            keys = [key for key in _clients.keys() + _lookups.keys()
+                    if key[0] == dbname]
+        else:
+            keys = [(dbname, backend_id) for backend_id in backend_ids]
+        for key in keys:
+            _lookups.pop(key, None)
+            _clients.pop(key, None)
+
+
+def civicrm_metrics(dbname, backend_id):
+    """ Return the request counters and circuit breaker state of this
+    process for a backend id of the database dbname, as a dict.
+    """
+    metrics = {}
+    with _clients_lock:
+        cached = _clients.get((dbname, backend_id))
+        breaker = _breakers.get((dbname, backend_id))
+    if cached is not None:
+        metrics.update(cached[1].get_metrics())
+    if breaker is not None:
+        metrics.update({'breaker_state': breaker.state,
+                        'breaker_open_count': breaker.open_count})
+    return metrics
+
+
+class LookupCache:
+    """ Relationship types and organisation contacts of a CiviCRM.
+
+    Both are small and rarely change, so they are loaded in bulk on first
+    use and again ttl seconds later. A name that is not found in the cache
+    is looked up in CiviCRM directly (and added), so new records are
+    found before the next refresh.
+    """
+
+    def __init__(self, ttl=3600):
+        self.ttl = ttl
+        self.loaded_at = None
+        self.relationship_types = {}
+        self.organisations = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _organisation_key(subtype, name):
+        # CiviCRM compares names case insensitively
+        return (subtype, name.lower())
+
+    def warm_up(self, civicrm, subtypes):
+        """ Load all relationship types and all organisations of the
+        contact subtypes, replacing the cached ones.
+        """
+        relationship_types = {}
+        for relation_type in civicrm.iter_get(
+                'RelationshipType', page_size=200,
+                **{'return': 'id,name_a_b'}):
+            relationship_types[relation_type['name_a_b']] = relation_type
+        organisations = {}
+        subtypes = set(subtypes)
+        for contact in civicrm.iter_get(
+                'Contact', page_size=500, contact_type='Organization',
+                **{'contact_sub_type[IN][]': sorted(subtypes),
+                   'return': 'id,organization_name,contact_sub_type'}):
+            contact_subtypes = contact.get('contact_sub_type') or []
+            if not isinstance(contact_subtypes, list):
+                contact_subtypes = [contact_subtypes]
+            for subtype in subtypes.intersection(contact_subtypes):
+                key = self._organisation_key(
+                    subtype, contact['organization_name'])
+                organisations[key] = contact
+        with self._lock:
+            self.relationship_types = relationship_types
+            self.organisations = organisations
+            self.loaded_at = time.time()
+
+    def _ensure_loaded(self, civicrm, subtypes):
+        if self.loaded_at is None or time.time() - self.loaded_at > self.ttl:
+            self.warm_up(civicrm, subtypes)
+
+    def relationship_type(self, civicrm, name_a_b, subtypes):
+        """ Return the RelationshipType record named name_a_b """
+        self._ensure_loaded(civicrm, subtypes)
+        relation_type = self.relationship_types.get(name_a_b)
+        if relation_type is None:
+            relation_type = civicrm.getsingle('RelationshipType',
+                                              name_a_b=name_a_b)
+            with self._lock:
+                self.relationship_types[name_a_b] = relation_type
+        return relation_type
+
+    def organisation(self, civicrm, subtype, name, subtypes):
+        """ Return the organisation Contact of subtype called name """
+        self._ensure_loaded(civicrm, subtypes)
+        key = self._organisation_key(subtype, name)
+        contact = self.organisations.get(key)
+        if contact is None:
+            contact = civicrm.getsingle('Contact', contact_sub_type=subtype,
+                                        organization_name=name)
+            with self._lock:
+                self.organisations[key] = contact
+        return contact
+
+
+def get_lookup_cache(backend):
+    """ Return the LookupCache of this process for a civicrm.backend """
+    key = _registry_key(backend)
+    with _clients_lock:
+        lookup = _lookups.get(key)
+        if lookup is None:
+            lookup = _lookups[key] = LookupCache()
+        return lookup
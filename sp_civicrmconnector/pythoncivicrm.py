@@ -55,6 +55,30 @@ The following optional values can be supplied when intializing:
                             the connection timesout.
                             Defaults to None, this means the connection will
                             hang until closed.
+    pool_connections=N      Number of per-host connection pools to keep,
+                            defaults to 1 (we only talk to one host).
+    pool_maxsize=N          Maximum number of keep-alive connections kept
+                            per host, defaults to 10.
+    max_retries=N           Number of times a failed connection is retried
+                            by the transport, defaults to 0.
+    retries=N               Number of times a call is retried when CiviCRM
+                            does not respond or answers with a server error,
+                            defaults to 0. Only connection errors and
+                            502/503 responses are retried for calls that
+                            change data (POST): after a 504 the call may
+                            have been processed.
+    backoff_factor=N        Retry number n waits a random time of up to
+    backoff_max=N           backoff_factor * 2 ** n seconds, at most
+                            backoff_max. Default 0.5 and 30.
+    circuit_breaker=cb      A CircuitBreaker to stop calling a CiviCRM that
+                            is down. Defaults to None, no breaker.
+    rate_limiter=limiter    A TokenBucket (or anything with an acquire()
+                            method) every request has to pass, to keep the
+                            load on CiviCRM within what it can handle.
+                            Defaults to None, no limit.
+    metadata_cache=cache    Cache for getoptions and getfields results,
+                            defaults to a MetadataCache(). Pass False to
+                            disable caching.
 
 e.g.
     url = 'www.example.org/path/to/civi/codebase/civicrm/extern/rest.php'
@@ -64,6 +88,13 @@ e.g.
 
     Connections will timeout after 5 seconds, and raise an error.
 
+The client keeps its HTTP connections open between calls, so reuse one
+instance for as long as possible. Call close() when done with it, or use it
+as a context manager::
+
+    with CiviCRM(url, site_key, api_key) as civicrm:
+        civicrm.get('Contact', city='Gotham City')
+
 .. _things-to-note:
 
 Things to note
@@ -102,6 +133,16 @@ numeric id is supplied, so that id is not checked for validity (though a
 Civicrm Error will still be raised if its not) as it is assumed you know
 what you are doing in this case, and we can save an extra API call for speed.
 
+* Use AsyncCiviCRM to have many calls in flight at once, e.g. for bulk
+exports.
+
+* Use iter_get rather than get with growing offsets to walk large result
+sets, e.g. all contacts.
+
+* getoptions, getfields and is_valid_option results are cached in process
+(see MetadataCache), as option lists rarely change. Call
+invalidate_metadata() after changing them in CiviCRM.
+
 * The  replace API call is undocumented, AFAIK, so not implemented, use
 getaction if you must.
 """
@@ -109,7 +150,12 @@ getaction if you must.
 from __future__ import absolute_import, unicode_literals
 
 import re
+import time
+import random
+import threading
+import collections
 import requests
+import requests.adapters
 import json
 
 
@@ -117,16 +163,158 @@ class CivicrmError(Exception):
     pass
 
 
+class CivicrmUnavailable(CivicrmError):
+    """Raised without calling the API while the circuit breaker is open."""
+    pass
+
+
+class CircuitBreaker:
+    """
+    .. class::CircuitBreaker([failure_threshold=5], [reset_timeout=60])
+    Stops calls to a CiviCRM that is down. After failure_threshold
+    consecutive failed calls the breaker opens and calls fail right away
+    with CivicrmUnavailable. After reset_timeout seconds one trial call is
+    let through (half-open): the breaker closes if it succeeds and opens
+    again if it fails. Another trial call is let through if the first one
+    gave no answer after reset_timeout seconds.
+    The breaker can be shared by several clients of the same CiviCRM.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=60):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.half_opened_at = None
+        self.open_count = 0
+        self._lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CivicrmUnavailable if the call may not be made."""
+        with self._lock:
+            if self.state == 'closed':
+                return
+            now = time.time()
+            if ((self.state == 'open' and
+                    now - self.opened_at >= self.reset_timeout) or
+                    (self.state == 'half-open' and
+                     now - self.half_opened_at >= self.reset_timeout)):
+                self.state = 'half-open'
+                self.half_opened_at = now
+                return
+            raise CivicrmUnavailable(
+                'CiviCRM is unavailable, retry after %s seconds'
+                % self.reset_timeout)
+
+    def success(self):
+        with self._lock:
+            self.state = 'closed'
+            self.failures = 0
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if (self.state == 'half-open' or
+                    self.failures >= self.failure_threshold):
+                if self.state != 'open':
+                    self.open_count += 1
+                self.state = 'open'
+                self.opened_at = time.time()
+
+
+class MetadataCache:
+    """
+    .. class::MetadataCache([ttl=3600], [size=256])
+    In process cache for entity metadata, keyed by (kind, entity, field).
+    Entries expire ttl seconds after they were stored, and the least
+    recently used entries are dropped when more than size are stored.
+    Anything with the same get/set/invalidate methods can be passed to
+    CiviCRM as metadata_cache instead.
+    """
+
+    def __init__(self, ttl=3600, size=256):
+        self.ttl = ttl
+        self.size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the value stored for key or None."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires < time.time():
+                return None
+            # re-insert as most recently used
+            self._entries[key] = entry
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time() + self.ttl, value)
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, entity=None, field=None):
+        """Drops the entries for entity (and field), or everything."""
+        with self._lock:
+            if entity is None:
+                self._entries.clear()
+                return
+            for key in list(self._entries):
+                if key[1] == entity and field in (None, key[2]):
+                    del self._entries[key]
+
+
+class TokenBucket:
+    """
+    .. class::TokenBucket(rate, [burst=1])
+    Rate limiter allowing on average rate calls per second, with bursts
+    of up to burst calls. acquire() blocks until a call may be made.
+    Share one bucket between the clients of a CiviCRM to limit them
+    together.
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.time()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self.tokens = min(float(self.burst), self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
 class CiviCRM:
     """
     .. class::CiviCRM(
-                    self, url, site_key, api_key,[use_ssl=True], [timeout=None]
+                    self, url, site_key, api_key,[use_ssl=True], [timeout=None],
+                    [pool_connections=1], [pool_maxsize=10], [max_retries=0]
                     )
     Make calls against the Civicrm API.
     """
 
-    def __init__(self, url, site_key, api_key, use_ssl=True, timeout=None):
-        """Set url,api keys, ssl usage, timeout"""
+    def __init__(self, url, site_key, api_key, use_ssl=True, timeout=None,
+                 pool_connections=1, pool_maxsize=10, max_retries=0,
+                 metadata_cache=None, retries=0, backoff_factor=0.5,
+                 backoff_max=30, circuit_breaker=None, rate_limiter=None):
+        """Set url,api keys, ssl usage, timeout, connection pool,
+        metadata cache, retries, circuit breaker and rate limiter"""
 
         # strip http(s):// off url
         regex = re.compile('^https?://')
@@ -144,6 +332,50 @@ class CiviCRM:
         else:
             start = 'http://'
         self.url = "%s%s/extern/rest.php" % (start, self.urlstring)
+        self.session = self._make_session(
+            pool_connections, pool_maxsize, max_retries)
+        if metadata_cache is None:
+            metadata_cache = MetadataCache()
+        elif metadata_cache is False:
+            metadata_cache = None
+        self.metadata_cache = metadata_cache
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.backoff_max = backoff_max
+        self.circuit_breaker = circuit_breaker
+        self.rate_limiter = rate_limiter
+        # counters of requests, retries, failures and calls refused by the
+        # circuit breaker
+        self.metrics = collections.Counter()
+        self._metrics_lock = threading.Lock()
+
+    def _make_session(self, pool_connections, pool_maxsize, max_retries):
+        """Return a requests session with a keep-alive connection pool
+        mounted for both http and https.
+        """
+        session = requests.Session()
+        session.verify = False
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_connections,
+            pool_maxsize=pool_maxsize,
+            max_retries=max_retries
+        )
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        """Close all pooled connections. The client can not be used
+        afterwards.
+        """
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
 
     def _get(self, action, entity, parameters=None):
         """Internal method to make api calls using GET."""
@@ -151,11 +383,7 @@ class CiviCRM:
         if not parameters:
             parameters = {}
         payload = self._construct_url_payload(action, entity, parameters)
-        api_call = requests.get(self.url, params=payload, timeout=self.timeout, verify=False)
-        if api_call.status_code != 200:
-                raise CivicrmError('request to %s failed with status code %s'
-                                   % (self.url, api_call.status_code))
-        results = json.loads(api_call.content)
+        results = self._request('GET', params=payload)
         return self._check_results(results)
 
     def _post(self, action, entity, parameters=None):
@@ -164,13 +392,7 @@ class CiviCRM:
         if not parameters:
             parameters = {}
         postdata = self._construct_post_data(action, entity, parameters)
-        api_call = requests.post(
-            self.url, data=postdata, timeout=self.timeout, verify=False
-        )
-        if api_call.status_code != 200:
-            raise CivicrmError('request to %s failed with status code %s'
-                               % (self.url, api_call.status_code))
-        results = json.loads(api_call.content)
+        results = self._send_post(postdata)
         # Some entities return things in the values field
         # that don't conform to the normal use elsewhere
         # Here we check for this and just return straight results
@@ -180,6 +402,87 @@ class CiviCRM:
         else:
             return self._check_results(results)
 
+    def _send_post(self, postdata):
+        """Internal method to POST postdata, returns the decoded response."""
+        return self._request('POST', data=postdata)
+
+    def _request(self, method, **kwargs):
+        """Internal method sending a request to the API, with retries and
+        through the circuit breaker. Returns the decoded response.
+        """
+        if self.circuit_breaker is not None:
+            try:
+                self.circuit_breaker.before_call()
+            except CivicrmUnavailable:
+                self._count('refused')
+                raise
+        attempt = 0
+        # the circuit breaker must learn the outcome of every call,
+        # whatever the error, or a half-open breaker waits for it
+        recorded = False
+        try:
+            while True:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                self._count('requests')
+                error = None
+                try:
+                    api_call = self.session.request(
+                        method, self.url, timeout=self.timeout, **kwargs)
+                except (requests.exceptions.ConnectionError,
+                        requests.exceptions.Timeout) as exc:
+                    error = exc
+                    retry = method == 'GET' or not isinstance(
+                        exc, requests.exceptions.ReadTimeout)
+                except requests.exceptions.RequestException as exc:
+                    error = exc
+                    retry = False
+                else:
+                    if api_call.status_code == 200:
+                        break
+                    error = CivicrmError(
+                        'request to %s failed with status code %s'
+                        % (self.url, api_call.status_code))
+                    if api_call.status_code < 500:
+                        # the server is up, the request is wrong
+                        recorded = True
+                        self._breaker_success()
+                        raise error
+                    # after a 504 the request may have been processed, only
+                    # retry the POSTs that certainly were not
+                    retry = method == 'GET' or api_call.status_code in (
+                        502, 503)
+                if not retry or attempt >= self.retries:
+                    self._count('failures')
+                    recorded = True
+                    if self.circuit_breaker is not None:
+                        self.circuit_breaker.failure()
+                    raise error
+                self._count('retries')
+                time.sleep(random.uniform(
+                    0, min(self.backoff_max,
+                           self.backoff_factor * 2 ** attempt)))
+                attempt += 1
+            recorded = True
+            self._breaker_success()
+        finally:
+            if not recorded and self.circuit_breaker is not None:
+                self.circuit_breaker.failure()
+        return json.loads(api_call.content)
+
+    def _breaker_success(self):
+        if self.circuit_breaker is not None:
+            self.circuit_breaker.success()
+
+    def _count(self, name):
+        with self._metrics_lock:
+            self.metrics[name] += 1
+
+    def get_metrics(self):
+        """Returns a copy of the metrics counters."""
+        with self._metrics_lock:
+            return dict(self.metrics)
+
     def _payload_template(self, action, entity):
         """Return the base payload items.
         :param action: What to do with the payload
@@ -294,15 +597,12 @@ class CiviCRM:
         label, Returns the (corresponding) id if valid, otherwise
         raises a CivicrmError.
         """
-        # keys are id's
+        # keys are id's, labels are the swapped keys & values
         try:
-            options = self.getoptions(entity, field)
+            options, labels = self._getoptions_labels(entity, field)
         except CivicrmError:
             raise CivicrmError("%s has no defined options for %s"
                                % (entity, field))
-        # swap keys & values for lookup keys are labels
-        labels = dict((value, key) for key, value
-                      in options.items())
         if type(value) is int and str(value) in options:
             return value
         elif value in labels:
@@ -326,6 +626,43 @@ class CiviCRM:
         params = self._add_options(kwargs, limit=limit, offset=offset)
         return self._get('get', entity, params)
 
+    def iter_get(self, entity, page_size=100, prefetch=False, **kwargs):
+        """Generator over all results of a get, fetched page_size records
+        at a time. Pages are sorted by id and selected with id > last id
+        seen (keyset pagination), so every page costs the server the same
+        whatever the position in the result set, and only one page (two
+        with prefetch) is held in memory.
+        With prefetch=True the next page is requested in a background
+        thread while the current one is consumed.
+        Search terms are passed as in get; id, limit, offset and sort can
+        not be used.
+        """
+        for reserved in ['id', 'limit', 'offset', 'options[sort]']:
+            if reserved in kwargs:
+                raise CivicrmError('%s can not be used with iter_get'
+                                   % reserved)
+        kwargs.update({'options[sort]': 'id ASC',
+                       'options[limit]': page_size})
+
+        def fetch(last_id):
+            params = dict(kwargs)
+            if last_id is not None:
+                params['id[>]'] = last_id
+            return self._get('get', entity, params)
+
+        page = fetch(None)
+        while page:
+            following = None
+            if len(page) >= page_size:
+                last_id = page[-1]['id']
+                if prefetch:
+                    following = CiviCRMFuture(fetch, last_id).result
+                else:
+                    following = lambda last_id=last_id: fetch(last_id)
+            for record in page:
+                yield record
+            page = following and following()
+
     def getsingle(self, entity, **kwargs):
         """Simple implementation of getsingle action.
         Returns a dictionary.
@@ -401,7 +738,13 @@ class CiviCRM:
         keys (and key['name']) are names of field and the value
         is a dictionary describing that field.
         """
-        return self._get('getfields', entity, parameters={'sequential': 0})
+        key = ('getfields', entity, None)
+        fields = self._cache_get(key)
+        if fields is None:
+            fields = self._get('getfields', entity,
+                               parameters={'sequential': 0})
+            self._cache_set(key, fields)
+        return fields
 
     def getoptions(self, entity, field):
         """Returns a dictionary of options for fields
@@ -409,9 +752,37 @@ class CiviCRM:
         (though sometimes appear to be synonyms? e.g. 1: Yes)
         Raises CivicrmError if a field has no associated options
         or is not present etc.
+        The result is cached and shared, don't modify it.
         """
-        parameters = {'field': field, 'sequential': 0}
-        return self._get('getoptions', entity, parameters)
+        return self._getoptions_labels(entity, field)[0]
+
+    def _getoptions_labels(self, entity, field):
+        """Returns the options of field and the label to id mapping."""
+        key = ('getoptions', entity, field)
+        cached = self._cache_get(key)
+        if cached is None:
+            parameters = {'field': field, 'sequential': 0}
+            options = self._get('getoptions', entity, parameters)
+            labels = dict((value, key) for key, value in options.items())
+            cached = (options, labels)
+            self._cache_set(key, cached)
+        return cached
+
+    def _cache_get(self, key):
+        if self.metadata_cache is None:
+            return None
+        return self.metadata_cache.get(key)
+
+    def _cache_set(self, key, value):
+        if self.metadata_cache is not None:
+            self.metadata_cache.set(key, value)
+
+    def invalidate_metadata(self, entity=None, field=None):
+        """Forget cached getoptions/getfields results for entity (and field),
+        or all of them.
+        """
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(entity, field)
 
     def doaction(self, action, entity, **kwargs):
         """There are other actions for some entities, but
@@ -420,6 +791,30 @@ class CiviCRM:
         """
         return self._post(action, entity, kwargs)
 
+    def batch(self, size=50, parent=None):
+        """Returns a CiviCRMBatch collecting calls to be sent together,
+        size calls per request. See CiviCRMBatch.
+        """
+        return CiviCRMBatch(self, size=size, parent=parent)
+
+    def _post_chained(self, parent, chained):
+        """Internal method to send a parent call with chained api.* calls
+        in a single POST. parent is an (entity, action, params) tuple that
+        must match exactly one record; chained maps api.Entity.action keys
+        to parameter dictionaries.
+        Returns a dictionary of the raw chained results by key.
+        """
+        entity, action, parameters = parent
+        parameters = dict(parameters, sequential=1)
+        parameters.update(chained)
+        postdata = self._construct_post_data(action, entity, {})
+        postdata['json'] = json.dumps(parameters)
+        values = self._check_results(self._send_post(postdata))
+        if len(values) != 1:
+            raise CivicrmError('chained call on %s %s returned %s records'
+                               % (entity, action, len(values)))
+        return values[0]
+
     def add_contact(self, contact_type, **kwargs):
         """Creates a contact from supplied dictionary params.
         Raises a CivicrmError if a required field is not supplied:
@@ -629,6 +1024,240 @@ class CiviCRM:
         return self.create('Address', **kwargs)[0]
 
 
+class CiviCRMFuture:
+    """
+    .. class::CiviCRMFuture(function, *args, **kwargs)
+    Calls function(*args, **kwargs) in a daemon thread. result() waits for
+    the call and returns its result or raises its exception.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        self._result = self._error = None
+        self._callbacks = []
+        self._thread = threading.Thread(target=self._run,
+                                        args=(function, args, kwargs))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self, function, args, kwargs):
+        try:
+            self._result = function(*args, **kwargs)
+        except Exception as error:
+            self._error = error
+
+    def done(self):
+        return not self._thread.is_alive()
+
+    def result(self, timeout=None):
+        self._thread.join(timeout)
+        if not self.done():
+            raise CivicrmError('call did not finish in %s seconds' % timeout)
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+class AsyncCiviCRM:
+    """
+    .. class::AsyncCiviCRM(civicrm, [concurrency=10])
+    Runs the calls of a CiviCRM client concurrently. It has the same
+    methods as CiviCRM, but they return a CiviCRMFuture immediately
+    instead of waiting for the response. At most concurrency calls are in
+    flight at once, further calls block until one finishes. Usage::
+
+        async_civicrm = AsyncCiviCRM(civicrm, concurrency=20)
+        futures = [async_civicrm.create('Relationship', **params)
+                   for params in relationships]
+        results = gather(futures)
+
+    The calls use the connection pool of the wrapped client, so create it
+    with pool_maxsize >= concurrency to keep all connections alive.
+    """
+
+    methods = [
+        'get', 'getsingle', 'getvalue', 'create', 'update', 'setvalue',
+        'delete', 'getcount', 'getfields', 'getoptions', 'doaction',
+        'is_valid_option', 'add_contact', 'add_relationship',
+        'add_activity_type', 'add_activity', 'add_contribution',
+        'add_email', 'add_note', 'add_tag', 'add_entity_tag', 'add_group',
+        'add_group_contact', 'add_phone', 'add_address',
+    ]
+
+    def __init__(self, civicrm, concurrency=10):
+        self.civicrm = civicrm
+        self.semaphore = threading.BoundedSemaphore(concurrency)
+
+    def __getattr__(self, name):
+        if name not in self.methods:
+            raise AttributeError(name)
+        method = getattr(self.civicrm, name)
+
+        def submit(*args, **kwargs):
+            return self.submit(method, *args, **kwargs)
+        return submit
+
+    def submit(self, function, *args, **kwargs):
+        """Runs function(*args, **kwargs) once a slot is free,
+        returns its CiviCRMFuture.
+        """
+        self.semaphore.acquire()
+        return CiviCRMFuture(self._release_after, function, args, kwargs)
+
+    def _release_after(self, function, args, kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            self.semaphore.release()
+
+
+def gather(futures, return_exceptions=False):
+    """Waits for all futures, returns their results in the same order.
+    With return_exceptions the exception of a failed call is returned in
+    its place, otherwise the first one is raised.
+    """
+    results = []
+    for future in futures:
+        try:
+            results.append(future.result())
+        except Exception as error:
+            if not return_exceptions:
+                raise
+            results.append(error)
+    return results
+
+
+class CiviCRMBatch:
+    """
+    .. class::CiviCRMBatch(civicrm, [size=50], [parent=None])
+    Collects API calls and sends them in as few requests as possible, using
+    the api.<Entity>.<action> chaining of the REST API. Usage::
+
+        batch = civicrm.batch()
+        for params in relationships:
+            batch.create('Relationship', **params)
+        for result in batch.execute():
+            if isinstance(result, CivicrmError):
+                ...
+
+    Every call method returns the index of the call. execute() returns a
+    list with, per call in the order they were added, what the equivalent
+    CiviCRM method would have returned, or the CivicrmError for a call that
+    failed. Errors of the request as a whole are raised.
+
+    The chained calls hang off a parent call that must match exactly one
+    record, by default the current Domain. size limits the number of calls
+    per request to keep the requests within the server limits.
+
+    CiviCRM fills parameters of every chained call from the parent record:
+    entity_id, entity_table and <parent>_id for all entities but Contact,
+    and id when the entity is the one of the parent or the parent record
+    has an <entity>_id (the Domain has the contact_id of its organisation).
+    Parameters given in the call take precedence, so a call that the
+    filled in parameters would change, e.g. a Contact get or create without
+    an id under the Domain, is refused with a CivicrmError when it is
+    added. Pass these parameters explicitly or use the CiviCRM methods.
+    """
+
+    default_parent = ('Domain', 'get', {'current_domain': 1})
+
+    def __init__(self, civicrm, size=50, parent=None):
+        self.civicrm = civicrm
+        self.size = size
+        self.parent = parent or self.default_parent
+        self.calls = []
+
+    def __len__(self):
+        return len(self.calls)
+
+    def add(self, action, entity, **kwargs):
+        """Queues an action on entity, returns the index of the call.
+        Raises a CivicrmError if CiviCRM would fill parameters of the call
+        from the parent record, see above.
+        """
+        injected = self._injected_params(entity, kwargs)
+        if injected:
+            raise CivicrmError(
+                '%s %s can not be chained to %s without %s, CiviCRM would '
+                'take them from the parent record'
+                % (entity, action, self.parent[0], ', '.join(injected)))
+        kwargs.setdefault('sequential', 1)
+        self.calls.append((action, entity, kwargs))
+        return len(self.calls) - 1
+
+    def _injected_params(self, entity, params):
+        """Returns the names of the parameters CiviCRM would set from the
+        parent record on a chained call on entity, that params don't give.
+        """
+        parent = api_entity_name(self.parent[0])
+        child = api_entity_name(entity)
+        injected = set()
+        if child == parent or (
+                parent != 'contact' and
+                '%s_id' % child in self.civicrm.getfields(self.parent[0])):
+            injected.add('id')
+        if child != 'contact':
+            fields = self.civicrm.getfields(entity)
+            injected.update(
+                name for name in ['entity_id', 'entity_table',
+                                  '%s_id' % parent]
+                if name in fields)
+        return sorted(name for name in injected if name not in params)
+
+    def get(self, entity, **kwargs):
+        """Queues a get, limit and offset are supported as in CiviCRM.get."""
+        limit = kwargs.pop('limit', None)
+        offset = kwargs.pop('offset', None)
+        kwargs = self.civicrm._add_options(kwargs, limit=limit, offset=offset)
+        return self.add('get', entity, **kwargs)
+
+    def getsingle(self, entity, **kwargs):
+        return self.add('getsingle', entity, **kwargs)
+
+    def create(self, entity, **kwargs):
+        return self.add('create', entity, **kwargs)
+
+    def update(self, entity, db_id, **kwargs):
+        return self.add('create', entity, id=db_id, **kwargs)
+
+    def delete(self, entity, db_id, skip_undelete=False):
+        if skip_undelete is True:
+            return self.add('delete', entity, id=db_id, skip_undelete=1)
+        return self.add('delete', entity, id=db_id)
+
+    def execute(self):
+        """Sends the queued calls and returns their results, see above.
+        The queue is emptied.
+        """
+        calls, self.calls = self.calls, []
+        results = []
+        for start in range(0, len(calls), self.size):
+            chunk = calls[start:start + self.size]
+            chained = {}
+            for index, (action, entity, params) in enumerate(chunk):
+                chained['api.%s.%s.%s' % (entity, action, index)] = params
+            values = self.civicrm._post_chained(self.parent, chained)
+            for index, (action, entity, params) in enumerate(chunk):
+                result = values.get('api.%s.%s.%s' % (entity, action, index))
+                results.append(self._check_result(result))
+        return results
+
+    def _check_result(self, result):
+        """Returns the result of one chained call or the CivicrmError."""
+        if result is None:
+            return CivicrmError('no result returned for chained call')
+        try:
+            return self.civicrm._check_results(result)
+        except CivicrmError as error:
+            return error
+
+
+def api_entity_name(entity):
+    """Returns the name CiviCRM uses for entity in parameter names,
+    e.g. loc_block for LocBlock.
+    """
+    return re.sub(r'(?<!^)([A-Z])', r'_\1', entity).lower()
+
+
 def matches_required(required, params):
     """if none of the fields in the list required are in params,
     returns a list of missing fields, or None
@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+
+from . import test_binder
+from . import test_pythoncivicrm
+
+checks = [
+    test_binder,
+    test_pythoncivicrm,
+]
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+from openerp.tests import common
+from openerp.addons.connector.connector import Binder
+from openerp.addons.connector.session import ConnectorSession
+
+from .. import binder
+from ..connector import get_environment
+
+
+class test_binder(common.TransactionCase):
+    """ bind_many and to_openerp_many split their queries in chunks of
+    BIND_MANY_CHUNK_SIZE records
+    """
+
+    def setUp(self):
+        super(test_binder, self).setUp()
+        cr, uid = self.cr, self.uid
+        data_obj = self.registry('ir.model.data')
+
+        def ref(xml_id):
+            module, name = xml_id.split('.')
+            return data_obj.get_object_reference(cr, uid, module, name)[1]
+
+        self.invoice_obj = self.registry('account.invoice')
+        self.backend_id = self.registry('civicrm.backend').create(cr, uid, {
+            'name': 'Test CiviCRM',
+            'url': 'http://civicrm.invalid/sites/all/modules/civicrm',
+            'site_key': 'site key',
+            'api_key': 'api key',
+        })
+        context = {'connector_no_export': True}
+        self.invoice_ids = [
+            self.invoice_obj.create(cr, uid, {
+                'partner_id': ref('base.res_partner_2'),
+                'account_id': ref('account.a_recv'),
+                'journal_id': ref('account.sales_journal'),
+                'type': 'out_invoice',
+                'backend_id': self.backend_id,
+            }, context=context)
+            for index in range(5)]
+        self.session = ConnectorSession(cr, uid, context=context)
+        self.chunk_size = binder.BIND_MANY_CHUNK_SIZE
+        binder.BIND_MANY_CHUNK_SIZE = 2
+
+    def tearDown(self):
+        binder.BIND_MANY_CHUNK_SIZE = self.chunk_size
+        super(test_binder, self).tearDown()
+
+    def _get_binder(self, model_name):
+        env = get_environment(self.session, model_name, self.backend_id)
+        return env.get_connector_unit(Binder)
+
+    def test_bind_many(self):
+        invoice_binder = self._get_binder('account.invoice')
+        bindings = [(1000 + index, invoice_id)
+                    for index, invoice_id in enumerate(self.invoice_ids)]
+        invoice_binder.bind_many(bindings)
+        for invoice in self.invoice_obj.browse(self.cr, self.uid,
+                                               self.invoice_ids):
+            self.assertEqual(
+                invoice.civicrm_id,
+                1000 + self.invoice_ids.index(invoice.id))
+            self.assertTrue(invoice.sync_date)
+        self.assertEqual(
+            invoice_binder.to_openerp_many(
+                [external_id for external_id, binding_id in bindings] +
+                [999]),
+            dict(bindings))
+
+    def test_to_openerp_many_memo(self):
+        """ The memo answers the IDs already resolved, the others are
+        queried
+        """
+        invoice_binder = self._get_binder('account.invoice')
+        invoice_binder.bind_many([(2000 + index, invoice_id)
+                                  for index, invoice_id
+                                  in enumerate(self.invoice_ids)])
+        invoice_binder.use_memo()
+        invoice_binder._memo[2000] = -1
+        result = invoice_binder.to_openerp_many(['2000', 2001, 2002])
+        self.assertEqual(result, {2000: -1,
+                                  2001: self.invoice_ids[1],
+                                  2002: self.invoice_ids[2]})
+        self.assertEqual(invoice_binder._memo[2002], self.invoice_ids[2])
+
+    def test_partner_binder(self):
+        """ Partners are found whatever backend they came from """
+        partner_obj = self.registry('res.partner')
+        partner_ids = [
+            partner_obj.create(self.cr, self.uid, {
+                'name': 'Contact %s' % index,
+                'civicrm_id': 3000 + index,
+            })
+            for index in range(3)]
+        partner_binder = self._get_binder('res.partner')
+        self.assertEqual(
+            partner_binder.to_openerp_many([3000, 3001, 3002]),
+            dict(zip([3000, 3001, 3002], partner_ids)))
@@ -0,0 +1,566 @@
+# -*- coding: utf-8 -*-
+import json
+import threading
+
+import requests
+import unittest2
+
+from .. import pythoncivicrm
+from ..pythoncivicrm import (
+    AsyncCiviCRM, CiviCRM, CiviCRMBatch, CircuitBreaker, CivicrmError,
+    CivicrmUnavailable, MetadataCache, TokenBucket, gather)
+
+
+class FakeResponse(object):
+    """ HTTP response of the API """
+
+    def __init__(self, status_code=200, values=None, **results):
+        self.status_code = status_code
+        results.setdefault('is_error', 0)
+        if values is not None:
+            results['values'] = values
+        self.content = json.dumps(results)
+
+
+class FakeSession(object):
+    """ Stands in for the requests session of a CiviCRM client. Answers the
+    requests with the responses given, in order, or raises them when they
+    are exceptions. A callable response is called with the method and the
+    arguments of the request to give the response.
+    """
+
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+        self.closed = False
+        self._lock = threading.Lock()
+
+    def request(self, method, url, timeout=None, **kwargs):
+        with self._lock:
+            self.requests.append((method, kwargs))
+            response = self.responses.pop(0)
+        if callable(response):
+            response = response(method, kwargs)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def close(self):
+        self.closed = True
+
+
+class FakeClock(object):
+    """ Replaces the time module of pythoncivicrm: time() only moves when
+    sleep() is called
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def make_client(*responses, **kwargs):
+    """ CiviCRM client answered by a FakeSession with responses """
+    kwargs.setdefault('backoff_factor', 0)
+    client = CiviCRM('example.org/civicrm', 'site key', 'api key', **kwargs)
+    client.session = FakeSession(*responses)
+    return client
+
+
+class FakeClockCase(unittest2.TestCase):
+    """ Runs the tests with a FakeClock as the time of pythoncivicrm """
+
+    def setUp(self):
+        super(FakeClockCase, self).setUp()
+        self.clock = FakeClock()
+        self._time = pythoncivicrm.time
+        pythoncivicrm.time = self.clock
+
+    def tearDown(self):
+        pythoncivicrm.time = self._time
+        super(FakeClockCase, self).tearDown()
+
+
+class test_session(unittest2.TestCase):
+
+    def test_pooled_session(self):
+        """ The client keeps one session with a keep-alive pool """
+        client = CiviCRM('https://example.org/civicrm', 'site key', 'api key',
+                         pool_maxsize=20)
+        self.assertIsInstance(client.session, requests.Session)
+        self.assertEqual(client.url,
+                         'https://example.org/civicrm/extern/rest.php')
+        for url in ('https://example.org', 'http://example.org'):
+            adapter = client.session.get_adapter(url)
+            self.assertEqual(adapter._pool_maxsize, 20)
+        client.close()
+
+    def test_calls_share_the_session(self):
+        client = make_client(FakeResponse(values=[{'id': 1}]),
+                             FakeResponse(values=[{'id': 2}]))
+        session = client.session
+        self.assertEqual(client.get('Contact', id=1), [{'id': 1}])
+        self.assertEqual(client.create('Contact', id=2), [{'id': 2}])
+        self.assertEqual([method for method, kwargs in session.requests],
+                         ['GET', 'POST'])
+        self.assertEqual(session.requests[0][1]['params']['id'], 1)
+        self.assertEqual(session.requests[1][1]['data']['id'], 2)
+
+    def test_context_manager_closes(self):
+        client = make_client()
+        with client as entered:
+            self.assertIs(entered, client)
+        self.assertTrue(client.session.closed)
+
+
+class test_batch(unittest2.TestCase):
+
+    def make_batch(self, *responses, **kwargs):
+        """ Batch of a client that knows the fields of Domain, Contact and
+        Relationship, answered with responses
+        """
+        client = make_client(*responses)
+        for entity, fields in [
+                ('Domain', ['id', 'name', 'contact_id']),
+                ('Contact', ['id', 'display_name']),
+                ('Relationship', ['id', 'contact_id_a', 'contact_id_b'])]:
+            client.metadata_cache.set(
+                ('getfields', entity, None),
+                dict((field, {'name': field}) for field in fields))
+        return client.batch(**kwargs)
+
+    def chained(self, request):
+        """ Parameters of the chained calls sent by a batch request """
+        method, kwargs = request
+        self.assertEqual(method, 'POST')
+        self.assertEqual(kwargs['data']['entity'], 'Domain')
+        return json.loads(kwargs['data']['json'])
+
+    def test_keys_and_results(self):
+        """ Each call is chained under a key of its own, its result or its
+        error is returned in the order of the calls
+        """
+        batch = self.make_batch(FakeResponse(values=[{
+            'id': 1,
+            'api.Relationship.create.0': {'is_error': 0,
+                                          'values': [{'id': 11}]},
+            'api.Relationship.create.1': {'is_error': 1,
+                                          'error_message': 'Duplicate'},
+            'api.Contact.get.2': {'is_error': 0, 'values': []},
+        }]))
+        self.assertEqual(batch.create('Relationship', contact_id_a=1), 0)
+        self.assertEqual(batch.create('Relationship', contact_id_a=2), 1)
+        self.assertEqual(batch.get('Contact', id=3, limit=5), 2)
+        self.assertEqual(len(batch), 3)
+
+        results = batch.execute()
+
+        self.assertEqual(results[0], [{'id': 11}])
+        self.assertIsInstance(results[1], CivicrmError)
+        self.assertEqual(results[2], [])
+        self.assertEqual(len(batch), 0)
+        chained = self.chained(batch.civicrm.session.requests[0])
+        self.assertEqual(chained['current_domain'], 1)
+        self.assertEqual(chained['api.Relationship.create.0'],
+                         {'contact_id_a': 1, 'sequential': 1})
+        self.assertEqual(chained['api.Contact.get.2'],
+                         {'id': 3, 'options[limit]': 5, 'sequential': 1})
+
+    def test_size(self):
+        """ The calls are sent size at a time """
+        batch = self.make_batch(
+            FakeResponse(values=[{
+                'api.Relationship.create.0': {'values': [{'id': 10}]},
+                'api.Relationship.create.1': {'values': [{'id': 11}]}}]),
+            FakeResponse(values=[{
+                'api.Relationship.create.0': {'values': [{'id': 12}]}}]),
+            size=2)
+        for contact_id in range(3):
+            batch.create('Relationship', contact_id_a=contact_id)
+
+        results = batch.execute()
+
+        self.assertEqual([result[0]['id'] for result in results],
+                         [10, 11, 12])
+        requests_sent = batch.civicrm.session.requests
+        self.assertEqual(len(requests_sent), 2)
+        self.assertEqual(
+            self.chained(requests_sent[1])['api.Relationship.create.0'],
+            {'contact_id_a': 2, 'sequential': 1})
+
+    def test_missing_result(self):
+        batch = self.make_batch(FakeResponse(values=[{'id': 1}]))
+        batch.create('Relationship', contact_id_a=1)
+        self.assertIsInstance(batch.execute()[0], CivicrmError)
+
+    def test_parent_must_match_one_record(self):
+        batch = self.make_batch(FakeResponse(values=[]))
+        batch.create('Relationship', contact_id_a=1)
+        self.assertRaises(CivicrmError, batch.execute)
+
+    def test_parent_params_refused(self):
+        """ Calls CiviCRM would fill in from the Domain are refused """
+        batch = self.make_batch()
+        # the Domain has a contact_id, it would be the id of the contact
+        self.assertRaises(CivicrmError, batch.create, 'Contact',
+                          display_name='New')
+        self.assertRaises(CivicrmError, batch.get, 'Contact')
+        self.assertEqual(batch.update('Contact', 5, display_name='Known'), 0)
+        self.assertEqual(len(batch), 1)
+
+
+class test_metadata_cache(FakeClockCase):
+
+    def test_ttl(self):
+        cache = MetadataCache(ttl=60)
+        cache.set(('getfields', 'Contact', None), {'id': {}})
+        self.clock.sleep(59)
+        self.assertEqual(cache.get(('getfields', 'Contact', None)),
+                         {'id': {}})
+        self.clock.sleep(2)
+        self.assertIsNone(cache.get(('getfields', 'Contact', None)))
+
+    def test_least_recently_used_dropped(self):
+        cache = MetadataCache(size=2)
+        cache.set(('getfields', 'Contact', None), 'contact')
+        cache.set(('getfields', 'Email', None), 'email')
+        # Contact becomes the most recently used
+        cache.get(('getfields', 'Contact', None))
+        cache.set(('getfields', 'Phone', None), 'phone')
+        self.assertEqual(cache.get(('getfields', 'Contact', None)),
+                         'contact')
+        self.assertIsNone(cache.get(('getfields', 'Email', None)))
+        self.assertEqual(cache.get(('getfields', 'Phone', None)), 'phone')
+
+    def test_invalidate(self):
+        cache = MetadataCache()
+        cache.set(('getoptions', 'Contact', 'prefix_id'), 'prefixes')
+        cache.set(('getoptions', 'Contact', 'gender_id'), 'genders')
+        cache.set(('getfields', 'Email', None), 'email')
+        cache.invalidate('Contact', 'prefix_id')
+        self.assertIsNone(cache.get(('getoptions', 'Contact', 'prefix_id')))
+        self.assertEqual(cache.get(('getoptions', 'Contact', 'gender_id')),
+                         'genders')
+        cache.invalidate('Contact')
+        self.assertIsNone(cache.get(('getoptions', 'Contact', 'gender_id')))
+        self.assertEqual(cache.get(('getfields', 'Email', None)), 'email')
+        cache.invalidate()
+        self.assertIsNone(cache.get(('getfields', 'Email', None)))
+
+    def test_client_caches_metadata(self):
+        """ getoptions and is_valid_option call the API once per field """
+        client = make_client(
+            FakeResponse(values={'1': 'Mr.', '2': 'Mrs.'}),
+            FakeResponse(values={'1': 'Mr.', '3': 'Dr.'}))
+        self.assertEqual(client.getoptions('Contact', 'prefix_id'),
+                         {'1': 'Mr.', '2': 'Mrs.'})
+        self.assertEqual(client.is_valid_option('Contact', 'prefix_id',
+                                                'Mrs.'), '2')
+        self.assertEqual(len(client.session.requests), 1)
+        client.invalidate_metadata('Contact')
+        self.assertEqual(client.is_valid_option('Contact', 'prefix_id', 3),
+                         3)
+        self.assertEqual(len(client.session.requests), 2)
+
+    def test_client_without_cache(self):
+        client = make_client(FakeResponse(values={'id': {}}),
+                             FakeResponse(values={'id': {}}),
+                             metadata_cache=False)
+        client.getfields('Contact')
+        client.getfields('Contact')
+        self.assertEqual(len(client.session.requests), 2)
+
+
+class test_iter_get(unittest2.TestCase):
+
+    def pages(self, prefetch):
+        client = make_client(
+            FakeResponse(values=[{'id': 1}, {'id': 2}]),
+            FakeResponse(values=[{'id': 3}, {'id': 4}]),
+            FakeResponse(values=[{'id': 5}]))
+        records = list(client.iter_get('Contact', page_size=2,
+                                       prefetch=prefetch, city='Gotham'))
+        self.assertEqual([record['id'] for record in records],
+                         [1, 2, 3, 4, 5])
+        params = [kwargs['params'] for method, kwargs
+                  in client.session.requests]
+        self.assertEqual([page.get('id[>]') for page in params],
+                         [None, 2, 4])
+        for page in params:
+            self.assertEqual(page['options[sort]'], 'id ASC')
+            self.assertEqual(page['options[limit]'], 2)
+            self.assertEqual(page['city'], 'Gotham')
+
+    def test_keyset_pages(self):
+        self.pages(False)
+
+    def test_keyset_pages_prefetch(self):
+        self.pages(True)
+
+    def test_last_page_full(self):
+        """ A full last page is followed by an empty one """
+        client = make_client(
+            FakeResponse(values=[{'id': 1}, {'id': 2}]),
+            FakeResponse(values=[]))
+        self.assertEqual(len(list(client.iter_get('Contact', page_size=2))),
+                         2)
+        self.assertEqual(len(client.session.requests), 2)
+
+    def test_pages_fetched_lazily(self):
+        client = make_client(
+            FakeResponse(values=[{'id': 1}, {'id': 2}]),
+            FakeResponse(values=[{'id': 3}]))
+        records = client.iter_get('Contact', page_size=2)
+        self.assertEqual(records.next()['id'], 1)
+        self.assertEqual(len(client.session.requests), 1)
+
+    def test_reserved_params(self):
+        client = make_client()
+        for reserved in ['id', 'limit', 'offset', 'options[sort]']:
+            self.assertRaises(CivicrmError, list, client.iter_get(
+                'Contact', **{reserved: 1}))
+        self.assertEqual(client.session.requests, [])
+
+
+class test_async(unittest2.TestCase):
+
+    def echo(self, method, kwargs):
+        """ Response with the id the request was made for """
+        if kwargs['params']['id'] == 'bad':
+            return FakeResponse(is_error=1, error_message='bad id')
+        return FakeResponse(values=[{'id': kwargs['params']['id']}])
+
+    def test_gather_in_order(self):
+        client = make_client(*[self.echo] * 10)
+        async_civicrm = AsyncCiviCRM(client, concurrency=3)
+        futures = [async_civicrm.get('Contact', id=contact_id)
+                   for contact_id in range(10)]
+        self.assertEqual([result[0]['id'] for result in gather(futures)],
+                         range(10))
+
+    def test_gather_errors(self):
+        client = make_client(*[self.echo] * 3)
+        async_civicrm = AsyncCiviCRM(client)
+        futures = [async_civicrm.get('Contact', id=contact_id)
+                   for contact_id in [1, 'bad', 3]]
+        results = gather(futures, return_exceptions=True)
+        self.assertEqual(results[0], [{'id': 1}])
+        self.assertIsInstance(results[1], CivicrmError)
+        self.assertEqual(results[2], [{'id': 3}])
+        self.assertRaises(CivicrmError, gather, futures)
+
+    def test_concurrency(self):
+        """ No more than concurrency calls are in flight """
+        running = []
+        peak = []
+        lock = threading.Lock()
+        release = threading.Event()
+
+        def call(value):
+            with lock:
+                running.append(value)
+                peak.append(len(running))
+            release.wait(5)
+            with lock:
+                running.remove(value)
+            return value
+
+        async_civicrm = AsyncCiviCRM(make_client(), concurrency=2)
+        futures = [async_civicrm.submit(call, 0),
+                   async_civicrm.submit(call, 1)]
+        # a third call waits for a free slot
+        third = threading.Thread(
+            target=lambda: futures.append(async_civicrm.submit(call, 2)))
+        third.start()
+        third.join(0.1)
+        self.assertTrue(third.is_alive())
+        release.set()
+        third.join(5)
+        self.assertEqual(gather(futures), [0, 1, 2])
+        self.assertEqual(max(peak), 2)
+
+    def test_unknown_method(self):
+        self.assertRaises(AttributeError, getattr,
+                          AsyncCiviCRM(make_client()), 'batch')
+
+
+class test_circuit_breaker(FakeClockCase):
+
+    def open_breaker(self):
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=60)
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        return breaker
+
+    def test_opens_after_threshold(self):
+        breaker = self.open_breaker()
+        self.assertEqual(breaker.open_count, 1)
+        self.assertRaises(CivicrmUnavailable, breaker.before_call)
+
+    def test_success_resets_failures(self):
+        breaker = CircuitBreaker(failure_threshold=2)
+        breaker.failure()
+        breaker.success()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'closed')
+
+    def test_half_open_probe_closes(self):
+        breaker = self.open_breaker()
+        self.clock.sleep(60)
+        breaker.before_call()
+        self.assertEqual(breaker.state, 'half-open')
+        # only one probe at a time
+        self.assertRaises(CivicrmUnavailable, breaker.before_call)
+        breaker.success()
+        self.assertEqual(breaker.state, 'closed')
+        breaker.before_call()
+
+    def test_half_open_probe_fails(self):
+        breaker = self.open_breaker()
+        self.clock.sleep(60)
+        breaker.before_call()
+        breaker.failure()
+        self.assertEqual(breaker.state, 'open')
+        self.assertEqual(breaker.open_count, 2)
+        self.assertRaises(CivicrmUnavailable, breaker.before_call)
+
+    def test_lost_probe_readmitted(self):
+        """ Another probe is let through when the first one gave no answer
+        within reset_timeout
+        """
+        breaker = self.open_breaker()
+        self.clock.sleep(60)
+        breaker.before_call()
+        self.clock.sleep(30)
+        self.assertRaises(CivicrmUnavailable, breaker.before_call)
+        self.clock.sleep(30)
+        breaker.before_call()
+        self.assertEqual(breaker.state, 'half-open')
+
+
+class test_request(FakeClockCase):
+    """ Retries of _request and what the circuit breaker learns """
+
+    def make_client(self, *responses, **kwargs):
+        kwargs.setdefault('retries', 2)
+        kwargs.setdefault('circuit_breaker',
+                          CircuitBreaker(failure_threshold=1))
+        return make_client(*responses, **kwargs)
+
+    def test_get_retried(self):
+        client = self.make_client(
+            requests.exceptions.ConnectionError(),
+            requests.exceptions.ReadTimeout(),
+            FakeResponse(values=[{'id': 1}]))
+        self.assertEqual(client.get('Contact', id=1), [{'id': 1}])
+        self.assertEqual(len(client.session.requests), 3)
+        self.assertEqual(client.metrics['retries'], 2)
+        self.assertEqual(client.circuit_breaker.state, 'closed')
+
+    def test_get_retried_on_504(self):
+        client = self.make_client(FakeResponse(504),
+                                  FakeResponse(values=[]))
+        self.assertEqual(client.get('Contact'), [])
+
+    def test_backoff(self):
+        client = self.make_client(
+            FakeResponse(503), FakeResponse(503), FakeResponse(values=[]),
+            backoff_factor=1, backoff_max=1.5)
+        client.get('Contact')
+        self.assertEqual(len(self.clock.sleeps), 2)
+        self.assertTrue(0 <= self.clock.sleeps[0] <= 1)
+        self.assertTrue(0 <= self.clock.sleeps[1] <= 1.5)
+
+    def test_post_retried_on_connection_error(self):
+        client = self.make_client(requests.exceptions.ConnectionError(),
+                                  FakeResponse(values=[{'id': 1}]))
+        self.assertEqual(client.create('Contact', id=1), [{'id': 1}])
+        self.assertEqual(len(client.session.requests), 2)
+
+    def test_post_retried_on_502_503(self):
+        client = self.make_client(FakeResponse(502), FakeResponse(503),
+                                  FakeResponse(values=[{'id': 1}]))
+        self.assertEqual(client.create('Contact', id=1), [{'id': 1}])
+        self.assertEqual(len(client.session.requests), 3)
+
+    def test_post_not_retried_after_processing(self):
+        """ A POST that may have been processed is not sent again """
+        for response in [FakeResponse(504),
+                         requests.exceptions.ReadTimeout()]:
+            client = self.make_client(response)
+            self.assertRaises((CivicrmError, requests.exceptions.Timeout),
+                              client.create, 'Contact', id=1)
+            self.assertEqual(len(client.session.requests), 1)
+            self.assertEqual(client.metrics['failures'], 1)
+            self.assertEqual(client.circuit_breaker.state, 'open')
+
+    def test_retries_exhausted(self):
+        client = self.make_client(*[FakeResponse(500)] * 3)
+        self.assertRaises(CivicrmError, client.get, 'Contact')
+        self.assertEqual(len(client.session.requests), 3)
+        self.assertEqual(client.circuit_breaker.state, 'open')
+        # the open breaker refuses the next call without a request
+        self.assertRaises(CivicrmUnavailable, client.get, 'Contact')
+        self.assertEqual(len(client.session.requests), 3)
+        self.assertEqual(client.metrics['refused'], 1)
+
+    def test_client_error_not_retried(self):
+        """ A 4xx answer means CiviCRM is up: no retry, no breaker failure """
+        client = self.make_client(FakeResponse(404))
+        self.assertRaises(CivicrmError, client.get, 'Contact')
+        self.assertEqual(len(client.session.requests), 1)
+        self.assertEqual(client.circuit_breaker.state, 'closed')
+
+    def test_other_request_errors(self):
+        """ Errors that are not retried still count for the breaker """
+        for error in [requests.exceptions.InvalidURL(), ValueError()]:
+            client = self.make_client(error)
+            self.assertRaises(type(error), client.get, 'Contact')
+            self.assertEqual(len(client.session.requests), 1)
+            self.assertEqual(client.circuit_breaker.state, 'open')
+
+
+class test_token_bucket(FakeClockCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(rate=2, burst=3)
+        for call in range(3):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        bucket.acquire()
+        self.assertEqual(len(self.clock.sleeps), 1)
+        self.assertAlmostEqual(self.clock.sleeps[0], 0.5)
+
+    def test_refill_capped_at_burst(self):
+        bucket = TokenBucket(rate=1, burst=2)
+        bucket.acquire()
+        bucket.acquire()
+        self.clock.sleep(3600)
+        self.clock.sleeps = []
+        for call in range(2):
+            bucket.acquire()
+        self.assertEqual(self.clock.sleeps, [])
+        bucket.acquire()
+        self.assertAlmostEqual(self.clock.sleeps[0], 1)
+
+    def test_client_acquires_per_request(self):
+        """ Every request, retries included, takes a token """
+        taken = []
+
+        class Limiter(object):
+            def acquire(self):
+                taken.append(True)
+
+        client = make_client(FakeResponse(503), FakeResponse(values=[]),
+                             retries=1, rate_limiter=Limiter())
+        client.get('Contact')
+        self.assertEqual(len(taken), 2)